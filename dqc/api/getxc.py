@@ -6,6 +6,8 @@ except (ImportError, ModuleNotFoundError) as e:
     warnings.warn("Failed to import pylibxc. Might not be able to use xc.")
 from dqc.xc.base_xc import BaseXC
 from dqc.xc.libxc import LibXCLDA, LibXCGGA, LibXCMGGA
+from dqc.xc.torch_xc import TorchXC, TORCH_XC_NAMES
+from dqc.utils.misc import get_option
 
 __all__ = ["get_xc"]
 
@@ -35,7 +37,27 @@ def get_libxc(name: str) -> BaseXC:
     else:
         raise NotImplementedError("LibXC wrapper for family %d has not been implemented" % family)
 
-def get_xc(xcstr: str) -> BaseXC:
+def get_torchxc(name: str) -> BaseXC:
+    """
+    Get the native torch XC object based on its libxc's name, or the libxc
+    object if the xc is not implemented natively.
+
+    Arguments
+    ---------
+    name: str
+        The full libxc name, e.g. "gga_x_pbe"
+
+    Returns
+    -------
+    BaseXC
+        XC object that implements the xc requested
+    """
+    if name in TORCH_XC_NAMES:
+        return TorchXC(name)
+    else:
+        return get_libxc(name)
+
+def get_xc(xcstr: str, backend: str = "libxc") -> BaseXC:
     """
     Returns the XC object based on the expression in xcstr.
 
@@ -44,16 +66,27 @@ def get_xc(xcstr: str) -> BaseXC:
     xcstr: str
         The expression of the xc string, e.g. ``"lda_x + gga_c_pbe"`` where the
         variable name will be replaced by the LibXC object
+    backend: str
+        The implementation of the xc, ``"libxc"`` or ``"torch"``.
+        The ``"torch"`` backend uses the native torch implementation for the
+        xc in ``TORCH_XC_NAMES`` (the potentials and the higher derivatives
+        are calculated with autograd) and libxc for the other xc.
 
     Returns
     -------
     BaseXC
         XC object based on the given expression
     """
-    # wrap the name of xc with "get_libxc"
+    backend_options = {
+        "libxc": get_libxc,
+        "torch": get_torchxc,
+    }
+    get_xcobj = get_option("xc backend", backend, backend_options)
+
+    # wrap the name of xc with "get_xcobj"
     pattern = r"([a-zA-Z_$][a-zA-Z_$0-9]*)"
-    new_xcstr = re.sub(pattern, r'get_libxc("\1")', xcstr)
+    new_xcstr = re.sub(pattern, r'get_xcobj("\1")', xcstr)
 
     # evaluate the expression and return the xc
-    glob = {"get_libxc": get_libxc}
+    glob = {"get_xcobj": get_xcobj}
     return eval(new_xcstr, glob)
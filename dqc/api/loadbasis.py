@@ -74,6 +74,8 @@ def loadbasis(cmd: str, dtype: torch.dtype = _dtype,
         angmoms = _expand_angmoms(desc[0], ncoeffs)
 
         # convert to tensor
+        # the alphas tensor is shared by all the contractions so the contractions
+        # with the same angmom are put in one shell in the integrals
         alpha = torch.tensor(alphas, dtype=dtype, device=device, requires_grad=requires_grad)
         for i in range(ncoeffs):
             coeff = torch.tensor(coeffs[i], dtype=dtype, device=device, requires_grad=requires_grad)
@@ -261,12 +261,13 @@ class DFPBC(BaseDF):
         # returns (nkpts, nao(fuse_wrapper))
 
         # retrieve the parameters needed from the wrapper
-        ao_to_shell = torch.as_tensor(fuse_wrapper.full_ao_to_shell)  # (nao_tot,)
-        shell_to_ao = torch.as_tensor(fuse_wrapper.full_shell_to_aoloc)  # (nshells_tot,)
+        # the gaussians are mapped to the contractions instead of the shells
+        # because a shell can have multiple contractions
+        ao_to_ctr = torch.as_tensor(fuse_wrapper.full_ao_to_ctr)  # (nao_tot,)
         ao_idx0, ao_idx1 = fuse_wrapper.ao_idxs()
         coeffs, alphas, _ = fuse_wrapper.params  # coeffs, alphas: (ngauss_tot,)
         angmoms = torch.as_tensor(fuse_wrapper.full_angmoms)  # (ngauss_tot,)
-        gauss_to_shell = torch.as_tensor(fuse_wrapper.full_gauss_to_shell, dtype=torch.int64)  # (ngauss_tot,)
+        gauss_to_ctr = torch.as_tensor(fuse_wrapper.full_gauss_to_ctr, dtype=torch.int64)  # (ngauss_tot,)
 
         # calculate the vbar for each gauss
         half_sph_norm = 0.5 / np.sqrt(np.pi)
@@ -274,13 +275,13 @@ class DFPBC(BaseDF):
         norms = half_sph_norm / gaussian_int(2, alphas)  # (ngauss_tot,)
         vbar = coeffs * (angmoms == 0) / norms * bar  # (ngauss_tot,)
 
-        # scatter the vbar to the appropriate shell
-        nshells_tot = len(ao_to_shell)
-        vbar_shell = torch.zeros((nshells_tot,), dtype=self.dtype, device=self.device)
-        vbar_shell.scatter_add_(dim=0, index=gauss_to_shell, src=vbar)  # (nshells_tot,)
+        # scatter the vbar to the appropriate contraction
+        nctrs_tot = len(ao_to_ctr)
+        vbar_ctr = torch.zeros((nctrs_tot,), dtype=self.dtype, device=self.device)
+        vbar_ctr.scatter_add_(dim=0, index=gauss_to_ctr, src=vbar)  # (nctrs_tot,)
 
         # gather vbar to ao
-        vbar_ao = torch.gather(vbar_shell, dim=0, index=ao_to_shell)  # (nao_tot,)
+        vbar_ao = torch.gather(vbar_ctr, dim=0, index=ao_to_ctr)  # (nao_tot,)
         vbar_ao = vbar_ao[ao_idx0:ao_idx1]  # (nao,)
         vbar_ao = vbar_ao * (np.pi / self._lattice.volume())
 
@@ -1,7 +1,8 @@
 from abc import abstractmethod, abstractproperty
-from typing import List
+from typing import List, Tuple
 import torch
 import xitorch as xt
+from dqc.grid.spatial_order import get_grid_blocks
 
 class BaseGrid(xt.EditableModule):
     """
@@ -48,6 +49,26 @@ class BaseGrid(xt.EditableModule):
         """
         pass
 
+    def get_blocks(self, blksize: int = 128) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns the metadata of the blocks of ``blksize`` consecutive grid
+        points. The blocks are spatially compact if the grid points are ordered
+        along a space-filling curve.
+
+        Arguments
+        ---------
+        blksize: int
+            The number of grid points in every block, except the last one.
+
+        Returns
+        -------
+        tuple of 2 torch.tensor (nblocks, 2, ndim) and (nblocks, 2)
+            The bounding box of every block given as the minimum and the maximum
+            of the coordinates, and the range of the grid point indices of every
+            block given as ``[start, end)``.
+        """
+        return get_grid_blocks(self.get_rgrid(), blksize)
+
     @abstractmethod
     def getparamnames(self, methodname: str, prefix: str = "") -> List[str]:
         pass
@@ -7,9 +7,11 @@ from dqc.grid.radial_grid import RadialGrid, LogM3Transformation, \
 from dqc.grid.lebedev_grid import LebedevGrid, TruncatedLebedevGrid
 from dqc.grid.multiatoms_grid import BeckeGrid, PBCBeckeGrid
 from dqc.grid.truncation_rules import DasguptaTrunc, NWChemTrunc, NoTrunc
+from dqc.grid.grid_cache import get_cached_atom_grid, get_cached_mol_grid
 from dqc.hamilton.intor.lattice import Lattice
 from dqc.utils.periodictable import atom_bragg_radii, atom_expected_radii, get_period
 from dqc.utils.misc import get_option
+from dqc.utils.config import config
 
 __all__ = ["get_grid", "get_predefined_grid"]
 
@@ -139,9 +141,18 @@ def get_grid(atomzs: Union[List[int], torch.Tensor], atompos: torch.Tensor,
              atom_radii: str = "expected",
              multiatoms_scheme: str = "becke",
              truncate: Optional[str] = "dasgupta",
+             ordering: Optional[str] = None,
              dtype: torch.dtype = _dtype,
              device: torch.device = _device) -> BaseGrid:
     # atompos: (natoms, ndim)
+    # ordering: None to keep the grid points ordered per atom, or the
+    # space-filling curve ("morton" or "hilbert") to order the grid points
+    # multiatoms_scheme: "becke" or "treutler" for Becke's partition (with the
+    # atomic size adjustments), or "stratmann" for the screened
+    # Stratmann-Scuseria-Frisch partition for large systems
+    # the atomic grids are cached per element and grid options (see
+    # dqc.grid.grid_cache), and the whole grid is cached if
+    # config.GRID_CACHE_MOLECULAR is set
     assert atompos.ndim == 2
     assert atompos.shape[-2] == len(atomzs)
 
@@ -202,13 +213,13 @@ def get_grid(atomzs: Union[List[int], torch.Tensor], atompos: torch.Tensor,
     truncate_str = truncate if truncate is not None else "no"
     trunc = get_option("truncation rule", truncate_str, trunc_options)()
 
-    sphgrids: List[BaseGrid] = []
-    sphgrids_dict: Dict[int, BaseGrid] = {}
-    for atz in atomzs_list:
-        if atz in sphgrids_dict:
-            sphgrids.append(sphgrids_dict[atz])
-            continue
+    # the keys of the atomic grids in the grid cache
+    def _get_atom_key(atz: int) -> str:
+        return (f"atomz={atz}, nr={_get_nr(nr, atz)}, prec={_get_nr(prec, atz)}, "
+                f"radgrid_generator={radgrid_generator}, radgrid_transform={radgrid_transform}, "
+                f"atom_radii={atom_radii}, truncate={truncate_str}")
 
+    def _construct_sphgrid(atz: int) -> BaseGrid:
         nr_value = _get_nr(nr, atz)
         radgrid = RadialGrid(nr_value, grid_integrator=radgrid_generator,
                              grid_transform=radgrid_tf(atz), dtype=dtype, device=device)
@@ -216,37 +227,64 @@ def get_grid(atomzs: Union[List[int], torch.Tensor], atompos: torch.Tensor,
             rad_slices = trunc.rad_slices(atz, radgrid)
             radgrids: List[BaseGrid] = [radgrid[sl] for sl in rad_slices]
             precs = trunc.precs(atz, radgrid)
-            sphgrid = TruncatedLebedevGrid(radgrids, precs)
+            return TruncatedLebedevGrid(radgrids, precs)
         else:
-            sphgrid = LebedevGrid(radgrid, prec=_get_nr(prec, atz))
-        sphgrids_dict[atz] = sphgrid
-        sphgrids.append(sphgrid)
+            return LebedevGrid(radgrid, prec=_get_nr(prec, atz))
 
-    # get the multi atoms grid
-    # the values are a function to avoid constructing it unnecessarily
-    if lattice is None:
-        multiatoms_options: Mapping[str, Callable[[], BaseGrid]] = {
-            "becke": lambda: BeckeGrid(sphgrids, atompos, atomradii=atomradii),
-            "treutler": lambda: BeckeGrid(sphgrids, atompos, atomradii=atomradii,
-                                          ratom_adjust="treutler"),
-        }
+    def _construct_grid() -> BaseGrid:
+        # the atomic grids are taken from the cache of the atomic grids
+        sphgrids: List[BaseGrid] = [
+            get_cached_atom_grid(_get_atom_key(atz), lambda: _construct_sphgrid(atz),
+                                 dtype=dtype, device=device)
+            for atz in atomzs_list
+        ]
+
+        # get the multi atoms grid
+        # the values are a function to avoid constructing it unnecessarily
+        if lattice is None:
+            multiatoms_options: Mapping[str, Callable[[], BaseGrid]] = {
+                "becke": lambda: BeckeGrid(sphgrids, atompos, atomradii=atomradii,
+                                           ordering=ordering),
+                "treutler": lambda: BeckeGrid(sphgrids, atompos, atomradii=atomradii,
+                                              ratom_adjust="treutler", ordering=ordering),
+                "stratmann": lambda: BeckeGrid(sphgrids, atompos, ordering=ordering,
+                                               partition="stratmann"),
+            }
+        else:
+            assert isinstance(lattice, Lattice)
+            multiatoms_options = {
+                "becke": lambda: PBCBeckeGrid(sphgrids, atompos, lattice=lattice,  # type: ignore
+                                              ordering=ordering),
+                "treutler": lambda: PBCBeckeGrid(sphgrids, atompos, lattice=lattice,  # type: ignore
+                                                 ratom_adjust="treutler", ordering=ordering),
+                "stratmann": lambda: PBCBeckeGrid(sphgrids, atompos, lattice=lattice,  # type: ignore
+                                                  ordering=ordering, partition="stratmann"),
+            }
+        return get_option("multiatoms scheme", multiatoms_scheme, multiatoms_options)()
+
+    # the molecular grid is only cached if it is not differentiated
+    if config.GRID_CACHE_MOLECULAR and not atompos.requires_grad and \
+            (lattice is None or not lattice.lattice_vectors().requires_grad):
+        atompos_np = atompos.detach().cpu().numpy()
+        lattice_str = "None" if lattice is None else \
+            lattice.lattice_vectors().detach().cpu().numpy().tobytes().hex()
+        mol_key = (f"atoms=[{'; '.join(_get_atom_key(atz) for atz in atomzs_list)}], "
+                   f"atompos={atompos_np.tobytes().hex()}, lattice={lattice_str}, "
+                   f"multiatoms_scheme={multiatoms_scheme}, ordering={ordering}")
+        return get_cached_mol_grid(mol_key, _construct_grid, dtype=dtype, device=device)
     else:
-        assert isinstance(lattice, Lattice)
-        multiatoms_options = {
-            "becke": lambda: PBCBeckeGrid(sphgrids, atompos, lattice=lattice),  # type: ignore
-            "treutler": lambda: PBCBeckeGrid(sphgrids, atompos, lattice=lattice,  # type: ignore
-                                             ratom_adjust="treutler"),
-        }
-    grid = get_option("multiatoms scheme", multiatoms_scheme, multiatoms_options)()
-    return grid
+        return _construct_grid()
 
 def get_predefined_grid(grid_inp: Union[int, str], atomzs: Union[List[int], torch.Tensor],
                         atompos: torch.Tensor,
                         *,
                         lattice: Optional[Lattice] = None,
+                        ordering: Optional[str] = None,
                         dtype: torch.dtype = _dtype, device: torch.device = _device) -> BaseGrid:
     """
     Returns the predefined grid object given the grid name.
+    The grid points are ordered along the space-filling curve given in
+    ``ordering`` ("morton" or "hilbert") if it is not None.
     """
     if isinstance(grid_inp, str):
         if grid_inp == "sg2":
@@ -258,6 +296,7 @@ def get_predefined_grid(grid_inp: Union[int, str], atomzs: Union[List[int], torc
                             atom_radii="expected",
                             multiatoms_scheme="becke",
                             truncate="dasgupta",
+                            ordering=ordering,
                             dtype=dtype, device=device)
         elif grid_inp == "sg3":
             return get_grid(atomzs, atompos, lattice=lattice,
@@ -268,6 +307,7 @@ def get_predefined_grid(grid_inp: Union[int, str], atomzs: Union[List[int], torc
                             atom_radii="expected",
                             multiatoms_scheme="becke",
                             truncate="dasgupta",
+                            ordering=ordering,
                             dtype=dtype, device=device)
         else:
             raise ValueError(f"Unknown grid name: {grid_inp}")
@@ -316,6 +356,7 @@ def get_predefined_grid(grid_inp: Union[int, str], atomzs: Union[List[int], torc
                         atom_radii="bragg",
                         multiatoms_scheme="treutler",
                         truncate="nwchem",
+                        ordering=ordering,
                         dtype=dtype, device=device)
     else:
         raise TypeError("Unknown type of grid_inp: %s" % type(grid_inp))
@@ -0,0 +1,127 @@
+import os
+import hashlib
+import tempfile
+from typing import Callable, Dict, List, Optional
+import torch
+import numpy as np
+from dqc.grid.base_grid import BaseGrid
+from dqc.utils.config import config
+
+# two-level cache of the integration grids:
+# 1. the atomic grids (and the Lebedev angular points) per element and grid
+#    specification, kept in memory and stored as binary files in
+#    config.GRID_CACHE_DIR to be shared (memory-mapped) across processes
+# 2. the full molecular grids keyed by the atoms, positions, and the grid
+#    options, stored in config.GRID_CACHE_DIR if config.GRID_CACHE_MOLECULAR
+
+__all__ = ["ArrayGrid", "get_grid_cache_path", "load_grid_cache", "save_grid_cache",
+           "get_cached_atom_grid", "get_cached_mol_grid"]
+
+class ArrayGrid(BaseGrid):
+    """
+    Grid in Cartesian coordinate with the given grid points and integration
+    weights, e.g. loaded from the grid cache.
+    """
+    def __init__(self, rgrid: torch.Tensor, dvolume: torch.Tensor) -> None:
+        # rgrid: (ngrid, ndim)
+        # dvolume: (ngrid,)
+        self._rgrid = rgrid
+        self._dvolume = dvolume
+
+    @property
+    def dtype(self) -> torch.dtype:
+        return self._rgrid.dtype
+
+    @property
+    def device(self) -> torch.device:
+        return self._rgrid.device
+
+    @property
+    def coord_type(self) -> str:
+        return "cart"
+
+    def get_dvolume(self) -> torch.Tensor:
+        return self._dvolume
+
+    def get_rgrid(self) -> torch.Tensor:
+        return self._rgrid
+
+    def getparamnames(self, methodname: str, prefix: str = "") -> List[str]:
+        if methodname == "get_rgrid":
+            return [prefix + "_rgrid"]
+        elif methodname == "get_dvolume":
+            return [prefix + "_dvolume"]
+        else:
+            raise KeyError("Invalid methodname: %s" % methodname)
+
+# in-memory cache of the atomic grids, the key is the grid key with the dtype
+# and the device
+_ATOM_GRIDS: Dict[str, ArrayGrid] = {}
+
+def get_grid_cache_path(kind: str, key: str) -> Optional[str]:
+    # returns the path of the cache file in config.GRID_CACHE_DIR or None if
+    # the directory is not set, long keys are hashed to get the file name
+    if config.GRID_CACHE_DIR is None:
+        return None
+    if len(key) > 64 or not key.replace("_", "").isalnum():
+        key = hashlib.sha1(key.encode()).hexdigest()
+    return os.path.join(config.GRID_CACHE_DIR, kind, key + ".npy")
+
+def load_grid_cache(path: Optional[str]) -> Optional[np.ndarray]:
+    # load the memory-mapped array from the cache file if it exists
+    if path is None or not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode="r")
+
+def save_grid_cache(path: Optional[str], arr: np.ndarray) -> None:
+    # save the array to the cache file, the file is written to a temporary
+    # file first, so other processes never read an incomplete file
+    if path is None:
+        return
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(dir=dirname, suffix=".npy")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, arr)
+        os.replace(tmppath, path)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+def get_cached_atom_grid(key: str, fcn: Callable[[], BaseGrid],
+                         dtype: torch.dtype, device: torch.device) -> ArrayGrid:
+    # returns the atomic grid from the cache, or construct it with fcn and
+    # store it in the cache
+    mem_key = "%s, dtype=%s, device=%s" % (key, dtype, device)
+    if mem_key not in _ATOM_GRIDS:
+        path = get_grid_cache_path("atoms", "%s, dtype=%s" % (key, dtype))
+        _ATOM_GRIDS[mem_key] = _get_cached_grid(path, fcn, dtype, device)
+    return _ATOM_GRIDS[mem_key]
+
+def get_cached_mol_grid(key: str, fcn: Callable[[], BaseGrid],
+                        dtype: torch.dtype, device: torch.device) -> BaseGrid:
+    # returns the molecular grid from the cache file, or construct it with fcn
+    # and store it in the cache file
+    # the cached grid is not differentiable w.r.t. the atomic positions
+    path = get_grid_cache_path("molecules", "%s, dtype=%s" % (key, dtype))
+    if path is None:
+        return fcn()
+    return _get_cached_grid(path, fcn, dtype, device)
+
+def _get_cached_grid(path: Optional[str], fcn: Callable[[], BaseGrid],
+                     dtype: torch.dtype, device: torch.device) -> ArrayGrid:
+    # load the grid from the file or construct and save it, the grid points
+    # and the weights are stored in an array with shape (ngrid, ndim + 1)
+    arr = load_grid_cache(path)
+    if arr is None:
+        grid = fcn()
+        rgrid = grid.get_rgrid().detach()
+        dvolume = grid.get_dvolume().detach()
+        save_grid_cache(path, torch.cat((rgrid, dvolume.unsqueeze(-1)), dim=-1).cpu().numpy())
+        return ArrayGrid(rgrid, dvolume)
+    else:
+        rgrid = torch.tensor(arr[:, :-1], dtype=dtype, device=device)
+        dvolume = torch.tensor(arr[:, -1], dtype=dtype, device=device)
+        return ArrayGrid(rgrid, dvolume)
@@ -4,22 +4,29 @@ import torch
 import numpy as np
 from dqc.grid.base_grid import BaseGrid
 from dqc.grid.radial_grid import RadialGrid
+from dqc.grid.grid_cache import get_grid_cache_path, load_grid_cache, save_grid_cache
 
 __all__ = ["LebedevGrid", "TruncatedLebedevGrid"]
 
 class LebedevLoader(object):
     # load the lebedev points and save the cache to save time
+    # the parsed points are also stored as binary files in config.GRID_CACHE_DIR
+    # (if set) to be memory-mapped in other processes
     caches: Dict[int, np.ndarray] = {}
 
     @classmethod
     def load(cls, prec: int) -> np.ndarray:
         if prec not in cls.caches:
-            # load the lebedev grid points
-            dset_path = os.path.join(os.path.split(__file__)[0], "..", "datasets",
-                                     "lebedevquad", "lebedev_%03d.txt" % prec)
-            assert os.path.exists(dset_path), "The dataset lebedev_%03d.txt does not exist" % prec
-            lebedev_dsets = np.loadtxt(dset_path)
-            lebedev_dsets[:, :2] *= (np.pi / 180)  # convert the angles to radians
+            cache_path = get_grid_cache_path("lebedev", "lebedev_%03d" % prec)
+            lebedev_dsets = load_grid_cache(cache_path)
+            if lebedev_dsets is None:
+                # load the lebedev grid points
+                dset_path = os.path.join(os.path.split(__file__)[0], "..", "datasets",
+                                         "lebedevquad", "lebedev_%03d.txt" % prec)
+                assert os.path.exists(dset_path), "The dataset lebedev_%03d.txt does not exist" % prec
+                lebedev_dsets = np.loadtxt(dset_path)
+                lebedev_dsets[:, :2] *= (np.pi / 180)  # convert the angles to radians
+                save_grid_cache(cache_path, lebedev_dsets)
             # save to the cache
             cls.caches[prec] = lebedev_dsets
 
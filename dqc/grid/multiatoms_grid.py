@@ -1,19 +1,32 @@
 import torch
 import numpy as np
-from typing import List, Optional, Tuple
+from typing import List, Optional, Tuple, Mapping, Callable
 from dqc.grid.base_grid import BaseGrid
 from dqc.grid.lebedev_grid import LebedevGrid
+from dqc.grid.spatial_order import get_spatial_order
 from dqc.hamilton.intor.lattice import Lattice
+from dqc.utils.config import config
+from dqc.utils.misc import get_option
 
 class BeckeGrid(BaseGrid):
     """
     Using Becke's scheme to construct the 3D grid consists of multiple 3D grids
-    centered on each atom
+    centered on each atom.
+    If ``ordering`` is given ("morton" or "hilbert"), the grid points are
+    reordered along the space-filling curve, so the blocks of consecutive grid
+    points are spatially compact.
+    The atomic partition weights are Becke's (``partition="becke"``) or
+    Stratmann-Scuseria-Frisch's (``partition="stratmann"``) which are
+    calculated only with the neighbouring atoms of every grid point, so the
+    cost scales linearly for large systems. The atomic size adjustments are
+    not used in the latter.
     """
 
     def __init__(self, atomgrid: List[LebedevGrid], atompos: torch.Tensor,
                  atomradii: Optional[torch.Tensor] = None,
-                 ratom_adjust: str = "becke") -> None:
+                 ratom_adjust: str = "becke",
+                 ordering: Optional[str] = None,
+                 partition: str = "becke") -> None:
         # atomgrid: list with length (natoms)
         # atompos: (natoms, ndim)
 
@@ -27,10 +40,13 @@ class BeckeGrid(BaseGrid):
         rgrids, self._rgrid, dvol_atoms = _construct_rgrids(atomgrid, atompos)
 
         # calculate the integration weights
-        weights_atoms = _get_atom_weights(rgrids, atompos, atomradii=atomradii,
-                                          ratom_adjust=ratom_adjust)  # (ngrid,)
+        weights_atoms = _get_partition_weights(rgrids, atompos, partition, atomradii=atomradii,
+                                               ratom_adjust=ratom_adjust)  # (ngrid,)
         self._dvolume = dvol_atoms * weights_atoms
 
+        if ordering is not None:
+            self._rgrid, self._dvolume = _reorder_grid(self._rgrid, self._dvolume, ordering)
+
     @property
     def dtype(self):
         return self._dtype
@@ -63,9 +79,14 @@ class PBCBeckeGrid(BaseGrid):
     to non-pbc BeckeGrid, but in this case, only grid points inside the lattice
     are considered, and atoms corresponds to each grid points are involved in
     calculating the weights.
+    The grid points can be reordered along a space-filling curve with
+    ``ordering`` and the partition weights are chosen by ``partition`` as in
+    ``BeckeGrid``, where ``"stratmann"`` only uses the neighbouring image
+    atoms of every grid point.
     """
     def __init__(self, atomgrid: List[LebedevGrid], atompos: torch.Tensor, lattice: Lattice,
-                 ratom_adjust: str = "becke"):
+                 ratom_adjust: str = "becke", ordering: Optional[str] = None,
+                 partition: str = "becke"):
         # atomgrid: list with length (natoms)
         # atompos: (natoms, ndim)
 
@@ -79,56 +100,52 @@ class PBCBeckeGrid(BaseGrid):
         a = lattice.lattice_vectors()  # (nlvec=ndim, ndim)
         b = lattice.recip_vectors() / (2 * np.pi)  # (ndim, ndim) just the inverse of lattice vector.T
 
-        new_atompos_lst: List[torch.Tensor] = []
-        new_rgrids: List[torch.Tensor] = []
-        new_dvols: List[torch.Tensor] = []
-        for ia, atomgr in enumerate(atomgrid):
-            atpos = atompos[ia]
-            rgrid = atomgr.get_rgrid() + atpos  # (natgrid, ndim)
-            dvols = atomgr.get_dvolume()  # (natgrid)
-
-            # ugrid is the normalized coordinate
-            ugrid = torch.einsum("cd,gd->gc", b, rgrid)  # (natgrid, ndim)
-
-            # get the shift required to make the grid point inside the lattice
-            ns = -ugrid.floor().to(torch.int)  # (natgrid, ndim) # ratoms + ns @ a will be the new atompos
-
-            # ns_unique: (nunique, ndim), ns_unique_idx: (natgrid,), ns_count: (nunique)
-            ns_unique, ns_unique_idx, ns_count = torch.unique(
-                ns, dim=0, return_inverse=True, return_counts=True)
-
-            # ignoring the shifts with only not more than 8 points (following pyscf)
-            significant_uniq_idx = ns_count > 8  # (nunique)
-            significant_idx = significant_uniq_idx[ns_unique_idx]  # (natgrid,)
-            ns_unique = ns_unique[significant_uniq_idx, :]  # (nunique2, ndim)
-            ls_unique = torch.matmul(ns_unique.to(a.dtype), a)  # (nunique2, ndim)
-
-            # flag the unaccepted points with -1
-            flag = -1
-            ns_unique_idx[~significant_idx] = flag  # (natgrid)
-
-            # get the coordinate inside the lattice
-            ls = torch.matmul(ns.to(a.dtype), a)
-            rg = rgrid + ls  # (natgrid, ndim)
-
-            # get the new atom pos
-            new_atpos = atompos[ia] + ls_unique  # (nunique2, ndim)
-            new_atompos_lst.append(new_atpos)
-
-            # separate the grid points that corresponds to the different atoms
-            for idx in torch.unique(ns_unique_idx):
-                if idx == flag:
-                    continue
-                at_idx = ns_unique_idx == idx
-                new_rgrids.append(rg[at_idx, :])  # list of (natgrid2, ndim)
-                new_dvols.append(dvols[at_idx])  # list of (natgrid2,)
-
-        self._rgrid = torch.cat(new_rgrids, dim=0)  # (ngrid, ndim)
-        dvol_atoms = torch.cat(new_dvols, dim=0)  # (ngrid)
-        new_atompos = torch.cat(new_atompos_lst, dim=0)  # (nnewatoms, ndim)
-        watoms = _get_atom_weights(new_rgrids, new_atompos, ratom_adjust=ratom_adjust)  # (ngrid,)
+        # construct all the grid points with the atom index of every point
+        _, rgrid, dvols = _construct_rgrids(atomgrid, atompos)  # (ngrid, ndim), (ngrid,)
+        ngrid = rgrid.shape[0]
+        natgrids = torch.tensor([atgrid.get_rgrid().shape[0] for atgrid in atomgrid],
+                                device=rgrid.device)
+        iatoms = torch.repeat_interleave(torch.arange(len(atomgrid), device=rgrid.device),
+                                         natgrids)  # (ngrid,)
+
+        # ugrid is the normalized coordinate
+        ugrid = torch.einsum("cd,gd->gc", b, rgrid)  # (ngrid, ndim)
+
+        # get the shift required to make the grid point inside the lattice
+        ns = -ugrid.floor().to(torch.long)  # (ngrid, ndim) # ratoms + ns @ a will be the new atompos
+        rgrid = rgrid + torch.matmul(ns.to(a.dtype), a)  # (ngrid, ndim)
+
+        # group the points by their atoms and shifts at once, every group
+        # corresponds to an image atom
+        # keys_unique: (nunique, 1 + ndim), group_idx: (ngrid,), group_count: (nunique,)
+        keys = torch.cat((iatoms.unsqueeze(-1), ns), dim=-1)  # (ngrid, 1 + ndim)
+        keys_unique, group_idx, group_count = torch.unique(
+            keys, dim=0, return_inverse=True, return_counts=True)
+
+        # ignoring the shifts with only not more than 8 points (following pyscf)
+        significant_group = group_count > 8  # (nunique,)
+        keys_unique = keys_unique[significant_group]  # (nunique2, 1 + ndim)
+        group_count = group_count[significant_group]  # (nunique2,)
+
+        # sort the significant points by the groups while keeping the order of
+        # the points in every group
+        sig_idx = torch.nonzero(significant_group[group_idx]).reshape(-1)
+        sig_idx = sig_idx[torch.argsort(group_idx[sig_idx] * ngrid + sig_idx)]
+
+        # get the new atom pos
+        ls_unique = torch.matmul(keys_unique[:, 1:].to(a.dtype), a)  # (nunique2, ndim)
+        new_atompos = atompos[keys_unique[:, 0]] + ls_unique  # (nunique2, ndim)
+
+        self._rgrid = rgrid[sig_idx]  # (ngrid2, ndim)
+        dvol_atoms = dvols[sig_idx]  # (ngrid2,)
+        new_rgrids = list(torch.split(self._rgrid, group_count.tolist(), dim=0))
+        watoms = _get_partition_weights(new_rgrids, new_atompos, partition,
+                                        ratom_adjust=ratom_adjust)  # (ngrid2,)
         self._dvolume = dvol_atoms * watoms
 
+        if ordering is not None:
+            self._rgrid, self._dvolume = _reorder_grid(self._rgrid, self._dvolume, ordering)
+
     @property
     def dtype(self) -> torch.dtype:
         return self._dtype
@@ -155,6 +172,14 @@ class PBCBeckeGrid(BaseGrid):
         else:
             raise KeyError("Invalid methodname: %s" % methodname)
 
+def _reorder_grid(rgrid: torch.Tensor, dvolume: torch.Tensor, ordering: str) \
+        -> Tuple[torch.Tensor, torch.Tensor]:
+    # reorder the grid points along the space-filling curve
+    # rgrid: (ngrid, ndim)
+    # dvolume: (ngrid,)
+    perm = get_spatial_order(rgrid, ordering)  # (ngrid,)
+    return rgrid[perm], dvolume[perm]
+
 def _construct_rgrids(atomgrid: List[LebedevGrid], atompos: torch.Tensor) \
         -> Tuple[List[torch.Tensor], torch.Tensor, torch.Tensor]:
     # construct the grid positions in a 2D tensor, the weights per isolated atom
@@ -170,6 +195,21 @@ def _construct_rgrids(atomgrid: List[LebedevGrid], atompos: torch.Tensor) \
 
     return allpos_lst, rgrid, dvol_atoms
 
+def _get_partition_weights(rgrids: List[torch.Tensor], atompos: torch.Tensor,
+                           partition: str,
+                           atomradii: Optional[torch.Tensor] = None,
+                           ratom_adjust: str = "becke") -> torch.Tensor:
+    # get the atomic partition weights of the grid points with the given scheme
+    # rgrids: list of (natgrid, ndim) with length natoms consisting of absolute position of the grids
+    # atompos: (natoms, ndim)
+    # returns: (ngrid,)
+    partition_options: Mapping[str, Callable[[], torch.Tensor]] = {
+        "becke": lambda: _get_atom_weights(rgrids, atompos, atomradii=atomradii,
+                                           ratom_adjust=ratom_adjust),
+        "stratmann": lambda: _get_atom_weights_ssf(rgrids, atompos),
+    }
+    return get_option("partition", partition, partition_options)()
+
 def _get_atom_weights(rgrids: List[torch.Tensor], atompos: torch.Tensor,
                       atomradii: Optional[torch.Tensor] = None,
                       ratom_adjust: str = "becke") -> torch.Tensor:
@@ -271,3 +311,97 @@ def _get_atom_weights(rgrids: List[torch.Tensor], atompos: torch.Tensor,
 
     w = torch.cat(w_list, dim=-1)  # (ngrid)
     return w
+
+# the parameter of the Stratmann-Scuseria-Frisch cell function
+SSF_A = 0.64
+# the maximum number of grid points in a chunk to calculate the SSF weights
+SSF_CHUNK_SIZE = 1024
+
+def _get_atom_weights_ssf(rgrids: List[torch.Tensor], atompos: torch.Tensor) -> torch.Tensor:
+    # calculate the atomic partition weights with Stratmann-Scuseria-Frisch
+    # scheme (https://doi.org/10.1016/0009-2614(96)00600-8) where the cell
+    # function of atom B at r is zero if r_B - r_C >= a * R_BC for any atom C.
+    # For a point of atom A at distance r_A, the atoms B with
+    # (1 - a) * R_AB >= 2 * r_A have zero cell functions, and the points with
+    # 2 * r_A < (1 - a) * R_nearest have unit weights.
+    # The cell functions of the other atoms B are only reduced by the atoms C
+    # with r_C < r_B * (1 + a) / (1 - a), so only the atoms within
+    # R_AC < r_A * (1 + ((1 + a) / (1 - a)) ** 2) are considered.
+    # rgrids: list of (natgrid, ndim) with length natoms consisting of absolute position of the grids
+    # atompos: (natoms, ndim)
+    # returns: (ngrid,)
+    assert len(rgrids) == atompos.shape[0]
+    a = SSF_A
+    natoms = atompos.shape[0]
+    cell_fac = 2 / (1 - a)
+    prod_fac = 1 + ((1 + a) / (1 - a)) ** 2
+
+    # the distances between atoms for the neighbour lists
+    atompos_det = atompos.detach()
+    ratoms = torch.norm(atompos_det - atompos_det.unsqueeze(1), dim=-1)  # (natoms, natoms)
+    rnearest = (ratoms + torch.diag(torch.full_like(ratoms[0], float("inf")))).min(dim=-1)[0]  # (natoms,)
+    itemsize = atompos.element_size()
+
+    w_list: List[torch.Tensor] = []
+    for ia in range(natoms):
+        xyz = rgrids[ia]  # (natgrid, ndim)
+        w = torch.ones(xyz.shape[0], dtype=atompos.dtype, device=atompos.device)  # (natgrid,)
+        rga = torch.norm(xyz.detach() - atompos_det[ia], dim=-1)  # (natgrid,)
+
+        # the points close to the nucleus are in its cell, so only the farther
+        # points are calculated, sorted by the distance to get compact
+        # neighbour lists in every chunk
+        far_idx = torch.nonzero(rga * cell_fac >= rnearest[ia]).reshape(-1)
+        far_idx = far_idx[torch.argsort(rga[far_idx])]
+        i = 0
+        while i < far_idx.shape[0]:
+            # get the neighbour lists with the maximum distance in the chunk
+            iend = min(i + SSF_CHUNK_SIZE, far_idx.shape[0])
+            rmax = rga[far_idx[iend - 1]]
+            cell_atoms = torch.nonzero(ratoms[ia] <= rmax * cell_fac).reshape(-1)
+            prod_atoms = torch.nonzero(ratoms[ia] <= rmax * prod_fac).reshape(-1)
+
+            # limit the memory of the (ncell, nprod, nchunk) tensors
+            nmax = config.CHUNK_MEMORY // (itemsize * cell_atoms.shape[0] * prod_atoms.shape[0])
+            iend = min(iend, i + max(nmax, 1))
+            idx = far_idx[i:iend]
+
+            wchunk = _get_ssf_chunk_weights(xyz[idx], atompos, ia, cell_atoms, prod_atoms)
+            w = w.index_copy(0, idx, wchunk)
+            i = iend
+        w_list.append(w)
+
+    return torch.cat(w_list, dim=-1)  # (ngrid,)
+
+def _get_ssf_chunk_weights(xyz: torch.Tensor, atompos: torch.Tensor, ia: int,
+                           cell_atoms: torch.Tensor, prod_atoms: torch.Tensor) -> torch.Tensor:
+    # calculate the SSF weights of atom ia at the given points with the atoms
+    # with possibly non-zero cell functions and the atoms reducing them
+    # xyz: (nchunk, ndim)
+    # atompos: (natoms, ndim)
+    # cell_atoms: (ncell,) indices of the atoms, including ia
+    # prod_atoms: (nprod,) indices of the atoms, including cell_atoms
+    # returns: (nchunk,)
+    a = SSF_A
+    pos_cell = atompos[cell_atoms]  # (ncell, ndim)
+    pos_prod = atompos[prod_atoms]  # (nprod, ndim)
+    rcell = torch.norm(xyz - pos_cell.unsqueeze(1), dim=-1)  # (ncell, nchunk)
+    rprod = torch.norm(xyz - pos_prod.unsqueeze(1), dim=-1)  # (nprod, nchunk)
+
+    # add the same atoms pair to stabilize the gradient calculation
+    same = cell_atoms.unsqueeze(1) == prod_atoms  # (ncell, nprod)
+    rdatoms = pos_cell.unsqueeze(1) - pos_prod + same.unsqueeze(-1).to(atompos.dtype)
+    ratoms = torch.norm(rdatoms, dim=-1)  # (ncell, nprod)
+    mu = (rcell.unsqueeze(1) - rprod) / ratoms.unsqueeze(-1)  # (ncell, nprod, nchunk)
+
+    # SSF cell function, s = (1 - g(mu / a)) / 2
+    z = torch.clamp(mu / a, min=-1.0, max=1.0)
+    z2 = z * z
+    g = z * (35 + z2 * (-35 + z2 * (21 - 5 * z2))) / 16
+    s = 0.5 * (1 - g)
+    s = torch.where(same.unsqueeze(-1), torch.ones_like(s), s)
+    p = s.prod(dim=1)  # (ncell, nchunk)
+
+    # the nearest atom of every point is in cell_atoms with p > 0, so the sum is not zero
+    iatom = int(torch.nonzero(cell_atoms == ia)[0, 0])
+    return p[iatom] / p.sum(dim=0)
@@ -0,0 +1,103 @@
+from typing import Tuple, Callable, Mapping
+import torch
+import numpy as np
+from dqc.utils.misc import get_option
+
+# functions to reorder the grid points along a space-filling curve, so the
+# consecutive grid points are spatially close to each other, and to get the
+# metadata of the blocks of consecutive grid points
+
+__all__ = ["get_spatial_order", "get_grid_blocks"]
+
+NBITS = 10  # number of bits per dimension of the quantized coordinates
+
+def get_spatial_order(rgrid: torch.Tensor, method: str = "morton") -> torch.Tensor:
+    # get the permutation of the grid points that orders them along the
+    # space-filling curve ("morton" or "hilbert")
+    # rgrid: (ngrid, ndim)
+    # returns: (ngrid,) long tensor
+    method_options: Mapping[str, Callable[[np.ndarray], np.ndarray]] = {
+        "morton": _morton_code,
+        "hilbert": _hilbert_code,
+    }
+    code_fcn = get_option("spatial ordering", method, method_options)
+    if rgrid.shape[0] == 0:
+        return torch.zeros((0,), dtype=torch.long, device=rgrid.device)
+
+    # quantize the coordinates to integers in [0, 2 ** NBITS)
+    coords = np.asarray(rgrid.detach().cpu(), dtype=np.float64)
+    cmin = np.min(coords, axis=0)
+    span = np.maximum(np.max(coords, axis=0) - cmin, 1e-12)
+    nmax = (1 << NBITS) - 1
+    q = np.clip(np.floor((coords - cmin) / span * nmax), 0, nmax).astype(np.int64)  # (ngrid, ndim)
+
+    code = code_fcn(q.T.copy())  # (ngrid,)
+    perm = np.argsort(code, kind="stable")
+    return torch.as_tensor(perm, dtype=torch.long, device=rgrid.device)
+
+def get_grid_blocks(rgrid: torch.Tensor, blksize: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    # get the bounding boxes and the index ranges of the blocks of blksize
+    # consecutive grid points
+    # rgrid: (ngrid, ndim)
+    # returns: bounds (nblocks, 2, ndim) as (min, max) and ranges (nblocks, 2) as [start, end)
+    ngrid = rgrid.shape[0]
+    nblocks = (ngrid + blksize - 1) // blksize
+    rgrid = rgrid.detach()
+    starts = torch.arange(nblocks, dtype=torch.long, device=rgrid.device) * blksize
+    ends = torch.clamp(starts + blksize, max=ngrid)
+    ranges = torch.stack((starts, ends), dim=-1)  # (nblocks, 2)
+
+    # pad the last block with its last point to get the bounding boxes at once
+    npad = nblocks * blksize - ngrid
+    if npad > 0:
+        rgrid = torch.cat((rgrid, rgrid[-1:].expand(npad, -1)), dim=0)
+    rblocks = rgrid.reshape(nblocks, blksize, rgrid.shape[-1])  # (nblocks, blksize, ndim)
+    bounds = torch.stack((rblocks.min(dim=1)[0], rblocks.max(dim=1)[0]), dim=1)  # (nblocks, 2, ndim)
+    return bounds, ranges
+
+def _morton_code(q: np.ndarray) -> np.ndarray:
+    # interleave the bits of the quantized coordinates with the first
+    # dimension as the most significant bit at every level
+    # q: (ndim, ngrid) int64
+    # returns: (ngrid,) int64
+    ndim = q.shape[0]
+    code = np.zeros(q.shape[1], dtype=np.int64)
+    for b in range(NBITS):
+        for d in range(ndim):
+            code |= ((q[d] >> b) & 1) << (b * ndim + (ndim - 1 - d))
+    return code
+
+def _hilbert_code(q: np.ndarray) -> np.ndarray:
+    # convert the quantized coordinates into the transposed Hilbert index
+    # (J. Skilling, AIP Conf. Proc. 707, 381 (2004)), then interleave its bits
+    # q: (ndim, ngrid) int64
+    # returns: (ngrid,) int64
+    x = q
+    ndim = x.shape[0]
+
+    # inverse undo excess work
+    m = 1 << (NBITS - 1)
+    qbit = m
+    while qbit > 1:
+        p = qbit - 1
+        x[0] = np.where((x[0] & qbit) != 0, x[0] ^ p, x[0])
+        for i in range(1, ndim):
+            cond = (x[i] & qbit) != 0
+            t = (x[0] ^ x[i]) & p
+            x0 = np.where(cond, x[0] ^ p, x[0] ^ t)
+            x[i] = np.where(cond, x[i], x[i] ^ t)
+            x[0] = x0
+        qbit >>= 1
+
+    # gray encode
+    for i in range(1, ndim):
+        x[i] ^= x[i - 1]
+    t = np.zeros_like(x[0])
+    qbit = m
+    while qbit > 1:
+        t = np.where((x[ndim - 1] & qbit) != 0, t ^ (qbit - 1), t)
+        qbit >>= 1
+    x ^= t
+
+    # the bits of the transposed index are interleaved in the same way as morton
+    return _morton_code(x)
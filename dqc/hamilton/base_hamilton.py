@@ -111,6 +111,22 @@ class BaseHamilton(xt.EditableModule):
         # return: (*BDH, nao, nao)
         pass
 
+    def get_jk(self, dm: torch.Tensor, with_j: bool = True, with_k: bool = True) \
+            -> Tuple[Optional[xt.LinearOperator], Optional[xt.LinearOperator]]:
+        """
+        Obtains the LinearOperators of the Coulomb and the exchange operators
+        (i.e. the ones from ``get_elrep`` and ``get_exchange``) of a batch of
+        density matrices together.
+        Implementations should build both operators in a single pass over the
+        electron repulsion integrals.
+        The operator that is not requested is returned as None.
+        """
+        # dm: (*BD, nao, nao)
+        # return: (*BDH, nao, nao) for both operators
+        elrep = self.get_elrep(dm) if with_j else None
+        exch = self.get_exchange(dm) if with_k else None
+        return elrep, exch
+
     @abstractmethod
     def get_vext(self, vext: torch.Tensor) -> xt.LinearOperator:
         r"""
@@ -153,6 +169,27 @@ class BaseHamilton(xt.EditableModule):
         # return: (*BOWH, nao, nao)
         pass
 
+    @abstractmethod
+    def raw_orb2ao_orb(self, orb: torch.Tensor) -> torch.Tensor:
+        """
+        Convert the orbital coefficients in the raw basis (i.e. the basis
+        given in the system) into the atomic orbital used in the Hamiltonian.
+        """
+        # orb: (*BO, nao_raw, norb)
+        # return: (*BOH, nao, norb)
+        pass
+
+    @abstractmethod
+    def ao_orb2raw_orb(self, orb: torch.Tensor) -> torch.Tensor:
+        """
+        Convert the orbital coefficients in the atomic orbital used in the
+        Hamiltonian into the coefficients in the raw basis (i.e. the basis
+        given in the system).
+        """
+        # orb: (*BO, nao, norb)
+        # return: (*BO, nao_raw, norb)
+        pass
+
     @abstractmethod
     def aodm2dens(self, dm: torch.Tensor, xyz: torch.Tensor) -> torch.Tensor:
         """
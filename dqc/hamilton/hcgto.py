@@ -1,8 +1,9 @@
-from typing import List, Optional, Union, overload, Tuple, Type
+from typing import List, Optional, Union, overload, Tuple, Type, Iterator, Dict
 import warnings
 import torch
 import xitorch as xt
 import dqc.hamilton.intor as intor
+from dqc.hamilton.intor.gtoeval import BLKSIZE
 from dqc.df.base_df import BaseDF
 from dqc.df.dfmol import DFMol
 from dqc.hamilton.base_hamilton import BaseHamilton
@@ -12,7 +13,7 @@ from dqc.utils.datastruct import AtomCGTOBasis, ValGrad, SpinParam, DensityFitIn
 from dqc.grid.base_grid import BaseGrid
 from dqc.xc.base_xc import BaseXC
 from dqc.utils.cache import Cache
-from dqc.utils.mem import chunkify, get_dtype_memsize
+from dqc.utils.mem import get_dtype_memsize
 from dqc.utils.config import config
 from dqc.utils.misc import logger
 
@@ -24,6 +25,16 @@ class HamiltonCGTO(BaseHamilton):
     eigenvalues.
     The advantage of doing this is making the overlap matrix in Roothan's equation
     identity and it could handle overcomplete basis.
+    The electron repulsion integrals are stored according to ``eri_mode``:
+    ``"dense"`` stores the full (nao, nao, nao, nao) tensor, ``"s8"``
+    stores only the 8-fold symmetry unique elements, and ``"direct"`` does not
+    store them, but recomputes the Coulomb and exchange matrices from the
+    screened shell quartets every time they are requested.
+    The basis values in the integration grid are stored according to
+    ``ao_grid_mode``: ``"cache"`` stores them for the whole grid,
+    ``"recompute"`` evaluates them chunk by chunk every time they are needed,
+    and ``"auto"`` recomputes them only if storing them would take more than
+    ``config.THRESHOLD_MEMORY``.
     """
     def __init__(self, atombases: List[AtomCGTOBasis], spherical: bool = True,
                  df: Optional[DensityFitInfo] = None,
@@ -31,7 +42,9 @@ class HamiltonCGTO(BaseHamilton):
                  vext: Optional[torch.Tensor] = None,
                  cache: Optional[Cache] = None,
                  orthozer: bool = True,
-                 aoparamzer: str = "qr") -> None:
+                 aoparamzer: str = "qr",
+                 eri_mode: str = "dense",
+                 ao_grid_mode: str = "auto") -> None:
         self.atombases = atombases
         self.spherical = spherical
         self.libcint_wrapper = intor.LibcintWrapper(atombases, spherical)
@@ -56,6 +69,24 @@ class HamiltonCGTO(BaseHamilton):
             raise RuntimeError(
                 f"Unknown ao parameterizer: {aoparamzer}. Available options are: {aoparam_opts}")
 
+        # set up the storage of the electron repulsion integrals
+        eri_mode_opts = ["dense", "s8", "direct"]
+        if eri_mode not in eri_mode_opts:
+            raise RuntimeError(
+                f"Unknown eri mode: {eri_mode}. Available options are: {eri_mode_opts}")
+        self._eri_mode = eri_mode
+        self._direct_jk: Optional[intor.DirectJK] = None
+        self._direct_with_k = False  # set to True once the exchange is requested
+        self._direct_k_cache: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
+
+        # set up the storage of the basis values in the grid
+        ao_grid_mode_opts = ["auto", "cache", "recompute"]
+        if ao_grid_mode not in ao_grid_mode_opts:
+            raise RuntimeError(
+                f"Unknown ao grid mode: {ao_grid_mode}. Available options are: {ao_grid_mode_opts}")
+        self._ao_grid_mode = ao_grid_mode
+        self._ao_recompute = False  # decided in setup_grid
+
         # set up the density matrix
         self._dfoptions = df
         if df is None:
@@ -76,7 +107,7 @@ class HamiltonCGTO(BaseHamilton):
         # initialize cache
         self._cache = cache if cache is not None else Cache.get_dummy()
         self._cache.add_cacheable_params(["overlap", "kinetic", "nuclattr", "efield0"])
-        if self._df is None:
+        if self._df is None and self._eri_mode != "direct":
             self._cache.add_cacheable_params(["elrep"])
 
     @property
@@ -102,6 +133,7 @@ class HamiltonCGTO(BaseHamilton):
                 "atombases": self.atombases,
                 "spherical": self.spherical,
                 "dfoptions": self._dfoptions,
+                "eri_mode": self._eri_mode,
             })
 
             logger.log("Calculating the overlap matrix")
@@ -124,12 +156,18 @@ class HamiltonCGTO(BaseHamilton):
                     efield_mat = torch.einsum("dab,d->ab", efield_mat_f, self._efield[i])
                     self.kinnucl_mat = self.kinnucl_mat + efield_mat / fac
 
-            if self._df is None:
+            if self._df is None and self._eri_mode == "direct":
+                logger.log("Preparing the direct Coulomb and exchange builder")
+                self._direct_jk = intor.DirectJK(self.libcint_wrapper)
+            elif self._df is None:
                 logger.log("Calculating the electron repulsion matrix")
-                self.el_mat = self._cache.cache("elrep", lambda: intor.elrep(self.libcint_wrapper))  # (nao^4)
+                packed = self._eri_mode == "s8"
+                # (nao^4) or (npair * (npair + 1) // 2) if packed
+                self.el_mat = self._cache.cache(
+                    "elrep", lambda: intor.elrep(self.libcint_wrapper, packed=packed))
                 # TODO: decide whether to precompute the 2-eris in the new basis
                 # based on the memory
-                self.el_mat = self._orthozer.convert4(self.el_mat)
+                self.el_mat = self._orthozer.convert4(self.el_mat, packed=packed)
             else:
                 logger.log("Building the density fitting matrices")
                 self._df.build()
@@ -160,30 +198,61 @@ class HamiltonCGTO(BaseHamilton):
         # save the grid
         self.grid = grid
         self.rgrid = grid.get_rgrid()
+        self.dvolume = self.grid.get_dvolume()
         assert grid.coord_type == "cart"
 
+        # the significance mask of the shells in the blocks of grid points,
+        # taken with the highest derivative so it covers all the basis values
+        # the blocks are spatially compact if the grid is ordered along a
+        # space-filling curve
+        deriv_sname = {1: "", 2: "ip"}.get(self.xcfamily, "lapl")
+        grid_bounds, self._grid_ranges = grid.get_blocks(BLKSIZE)
+        self._non0tab = intor.get_gto_non0tab(self.libcint_wrapper, self.rgrid, deriv_sname,
+                                              bounds=grid_bounds)
+        # (nblocks, nao)
+        self._ao_non0tab = torch.as_tensor(self._non0tab[:, self.libcint_wrapper.ao_to_shell().numpy()] != 0,
+                                           device=self.device)
+
+        # decide whether to store the basis values in the grid or to evaluate
+        # them in chunks every time they are needed
+        self._ao_recompute = self._get_ao_recompute()
+        self._grid_chunks: Dict[int, List[Tuple[int, int, Optional[torch.Tensor]]]] = {}
+        if self._ao_recompute:
+            logger.log("The basis values in the grid will be evaluated on the fly")
+            self.is_ao_set = True
+            self.is_grad_ao_set = self.xcfamily in [2, 4]
+            self.is_lapl_ao_set = self.xcfamily == 4
+            return
+
         # setup the basis as a spatial function
         logger.log("Calculating the basis values in the grid")
         self.is_ao_set = True
-        self.basis = intor.eval_gto(self.libcint_wrapper, self.rgrid, to_transpose=True)  # (ngrid, nao)
-        self.dvolume = self.grid.get_dvolume()
-        self.basis_dvolume = self.basis * self.dvolume.unsqueeze(-1)  # (ngrid, nao)
-
-        if self.xcfamily == 1:  # LDA
-            return
+        aos = [intor.eval_gto(self.libcint_wrapper, self.rgrid, to_transpose=True,
+                              non0tab=self._non0tab).unsqueeze(0)]  # (1, ngrid, nao)
 
-        # setup the gradient of the basis
-        logger.log("Calculating the basis gradient values in the grid")
-        self.is_grad_ao_set = True
-        # (ndim, nao, ngrid)
-        self.grad_basis = intor.eval_gradgto(self.libcint_wrapper, self.rgrid, to_transpose=True)
-        if self.xcfamily == 2:  # GGA
-            return
+        if self.xcfamily in [2, 4]:  # GGA or MGGA
+            # setup the gradient of the basis
+            logger.log("Calculating the basis gradient values in the grid")
+            self.is_grad_ao_set = True
+            aos.append(intor.eval_gradgto(self.libcint_wrapper, self.rgrid, to_transpose=True,
+                                          non0tab=self._non0tab))  # (ndim, ngrid, nao)
 
-        # setup the laplacian of the basis
-        self.is_lapl_ao_set = True
-        logger.log("Calculating the basis laplacian values in the grid")
-        self.lapl_basis = intor.eval_laplgto(self.libcint_wrapper, self.rgrid, to_transpose=True)  # (nao, ngrid)
+        if self.xcfamily == 4:  # MGGA
+            # setup the laplacian of the basis
+            self.is_lapl_ao_set = True
+            logger.log("Calculating the basis laplacian values in the grid")
+            aos.append(intor.eval_laplgto(self.libcint_wrapper, self.rgrid, to_transpose=True,
+                                          non0tab=self._non0tab).unsqueeze(0))  # (1, ngrid, nao)
+
+        # the components are stored stacked once, so the chunks of the xc
+        # calculations are only slices of it, and the individual components
+        # are views of the stacked basis
+        self.ao_stack = aos[0] if len(aos) == 1 else torch.cat(aos, dim=0)  # (ncomp, ngrid, nao)
+        self.basis = self.ao_stack[0]  # (ngrid, nao)
+        if self.is_grad_ao_set:
+            self.grad_basis = self.ao_stack[1:4]  # (ndim, ngrid, nao)
+        if self.is_lapl_ao_set:
+            self.lapl_basis = self.ao_stack[4]  # (ngrid, nao)
 
     ############ fock matrix components ############
     def get_nuclattr(self) -> xt.LinearOperator:
@@ -206,7 +275,8 @@ class HamiltonCGTO(BaseHamilton):
         # elrep_mat: (nao, nao, nao, nao)
         # return: (*BD, nao, nao)
         if self._df is None:
-            mat = torch.einsum("...ij,ijkl->...kl", dm, self.el_mat)
+            mat, _ = self._get_jk_mat(dm, with_j=True, with_k=False)
+            assert mat is not None
             mat = (mat + mat.transpose(-2, -1)) * 0.5  # reduce numerical instability
             return xt.LinearOperator.m(mat, is_hermitian=True)
         else:
@@ -229,10 +299,9 @@ class HamiltonCGTO(BaseHamilton):
         if self._df is not None:
             raise RuntimeError("Exact exchange cannot be computed with density fitting")
         elif isinstance(dm, torch.Tensor):
-            # the einsum form below is to hack PyTorch's bug #57121
-            # mat = -0.5 * torch.einsum("...jk,ijkl->...il", dm, self.el_mat)  # slower
-            mat = -0.5 * torch.einsum("...il,ijkl->...ijk", dm, self.el_mat).sum(dim=-3)  # faster
-
+            _, mat = self._get_jk_mat(dm, with_j=False, with_k=True)
+            assert mat is not None
+            mat = -0.5 * mat
             mat = (mat + mat.transpose(-2, -1)) * 0.5  # reduce numerical instability
             return xt.LinearOperator.m(mat, is_hermitian=True)
         else:  # dm is SpinParam
@@ -240,11 +309,44 @@ class HamiltonCGTO(BaseHamilton):
             return SpinParam(u=self.get_exchange(2 * dm.u),
                              d=self.get_exchange(2 * dm.d))
 
+    def get_jk(self, dm: torch.Tensor, with_j: bool = True, with_k: bool = True) \
+            -> Tuple[Optional[xt.LinearOperator], Optional[xt.LinearOperator]]:
+        # get the coulomb and exchange operators with one pass over the
+        # electron repulsion integrals
+        # dm: (*BD, nao, nao)
+        # return: (*BD, nao, nao) for both operators
+        if self._df is not None:
+            if with_k:
+                raise RuntimeError("Exact exchange cannot be computed with density fitting")
+            return self._df.get_elrep(dm), None
+
+        jmat, kmat = self._get_jk_mat(dm, with_j=with_j, with_k=with_k)
+        elrep: Optional[xt.LinearOperator] = None
+        exch: Optional[xt.LinearOperator] = None
+        if jmat is not None:
+            jmat = (jmat + jmat.transpose(-2, -1)) * 0.5  # reduce numerical instability
+            elrep = xt.LinearOperator.m(jmat, is_hermitian=True)
+        if kmat is not None:
+            kmat = -0.5 * kmat
+            kmat = (kmat + kmat.transpose(-2, -1)) * 0.5
+            exch = xt.LinearOperator.m(kmat, is_hermitian=True)
+        return elrep, exch
+
     def get_vext(self, vext: torch.Tensor) -> xt.LinearOperator:
         # vext: (*BR, ngrid)
         if not self.is_ao_set:
             raise RuntimeError("Please call `setup_grid(grid, xc)` to call this function")
-        mat = torch.einsum("...r,rb,rc->...bc", vext, self.basis_dvolume, self.basis)  # (*BR, nao, nao)
+        nao = self.libcint_wrapper.nao()
+        mat = torch.zeros((*vext.shape[:-1], nao, nao), dtype=self.dtype, device=self.device)
+        for ioff, iend, aoidx in self._get_grid_chunks():
+            basis = _select_ao(self._get_ao_chunk("", ioff, iend), aoidx)  # (nr, nao2)
+            basis_dvolume = basis * self.dvolume[ioff:iend].unsqueeze(-1)
+            # (*BR, nao2, nao2)
+            mat_chunk = torch.einsum("...r,rb,rc->...bc", vext[..., ioff:iend], basis_dvolume, basis)
+            if aoidx is None:
+                mat += mat_chunk
+            else:
+                mat[..., aoidx[:, None], aoidx] += mat_chunk
         mat = self._orthozer.convert2(mat)
         mat = (mat + mat.transpose(-2, -1)) * 0.5  # ensure the symmetricity and reduce numerical instability
         return xt.LinearOperator.m(mat, is_hermitian=True)
@@ -261,13 +363,70 @@ class HamiltonCGTO(BaseHamilton):
         # dm: (*BD, nao, nao)
         assert self.xc is not None, "Please call .setup_grid with the xc object"
 
-        densinfo = SpinParam.apply_fcn(
-            lambda dm_: self._dm2densinfo(dm_), dm)  # value: (*BD, nr)
+        densinfo = self._dm2densinfo_spin(dm)  # value: (*BD, nr)
         potinfo = self.xc.get_vxc(densinfo)  # value: (*BD, nr)
-        vxc_linop = SpinParam.apply_fcn(
-            lambda potinfo_: self._get_vxc_from_potinfo(potinfo_), potinfo)
+        vxc_linop = self._get_vxc_from_potinfo_spin(potinfo)
         return vxc_linop
 
+    def _get_jk_mat(self, dm: torch.Tensor, with_j: bool, with_k: bool) \
+            -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]:
+        # calculate the Coulomb matrix, J_kl = sum_ij D_ij (ij|kl), and the exchange
+        # matrix, K_il = sum_jk D_jk (ij|kl), with one pass over the integrals
+        # dm: (*BD, nao, nao)
+        # return: (*BD, nao, nao) for both matrices, or None if not requested
+        if self._eri_mode == "direct":
+            if with_j and with_k:
+                return self._get_direct_jk(dm)
+            elif with_j:
+                return self._get_direct_j_or_k(dm, with_j=True), None
+            elif with_k:
+                return None, self._get_direct_j_or_k(dm, with_j=False)
+            return None, None
+        elif self._eri_mode == "s8":
+            return _get_jk_s8(dm, self.el_mat, with_j=with_j, with_k=with_k)
+        else:
+            return _get_jk_dense(dm, self.el_mat, with_j=with_j, with_k=with_k)
+
+    def _get_direct_j_or_k(self, dm: torch.Tensor, with_j: bool) -> torch.Tensor:
+        # calculate the Coulomb matrix (if with_j) or the exchange matrix
+        # (otherwise) directly from the integrals
+        # dm: (*BD, nao, nao)
+        # return: (*BD, nao, nao)
+        assert self._direct_jk is not None
+        self._check_direct_grad()
+
+        if not with_j:
+            # the exchange matrix might have been calculated with the Coulomb matrix
+            self._direct_with_k = True
+            if self._direct_k_cache is not None and self._direct_k_cache[0] is dm:
+                return self._direct_k_cache[1]
+
+        # the calculation is done in the original basis
+        dm_ao = self._orthozer.unconvert_dm(dm)
+        with_k = self._direct_with_k
+        jmat, kmat = intor.direct_jk(self._direct_jk, dm_ao, with_j=with_j, with_k=with_k,
+                                     incremental=True)
+        if with_j and with_k:
+            self._direct_k_cache = (dm, self._orthozer.convert2(kmat))
+        return self._orthozer.convert2(jmat if with_j else kmat)
+
+    def _get_direct_jk(self, dm: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # calculate both the Coulomb and the exchange matrices directly from
+        # the integrals
+        # dm: (*BD, nao, nao)
+        # return: (*BD, nao, nao) for both matrices
+        assert self._direct_jk is not None
+        self._check_direct_grad()
+        dm_ao = self._orthozer.unconvert_dm(dm)
+        jmat, kmat = intor.direct_jk(self._direct_jk, dm_ao, with_j=True, with_k=True,
+                                     incremental=True)
+        return self._orthozer.convert2(jmat), self._orthozer.convert2(kmat)
+
+    def _check_direct_grad(self) -> None:
+        if any(p.requires_grad for p in self.libcint_wrapper.params):
+            raise RuntimeError("The gradient w.r.t. the basis parameters or atomic positions "
+                               "is not available in the direct eri mode")
+
     ############### interface to dm ###############
     def ao_orb2dm(self, orb: torch.Tensor, orb_weight: torch.Tensor) -> torch.Tensor:
         # convert the atomic orbital to the density matrix
@@ -280,6 +439,18 @@ class HamiltonCGTO(BaseHamilton):
         orb_w = orb * orb_weight.unsqueeze(-2)  # (*BOW, nao, norb)
         return torch.matmul(orb, orb_w.transpose(-2, -1))  # (*BOW, nao, nao)
 
+    def raw_orb2ao_orb(self, orb: torch.Tensor) -> torch.Tensor:
+        # convert the orbital in the raw basis into the (orthogonalized) basis
+        # orb: (*BO, nao_raw, norb)
+        # return: (*BO, nao, norb)
+        return self._orthozer.convert_orb(orb)
+
+    def ao_orb2raw_orb(self, orb: torch.Tensor) -> torch.Tensor:
+        # convert the orbital in the (orthogonalized) basis into the raw basis
+        # orb: (*BO, nao, norb)
+        # return: (*BO, nao_raw, norb)
+        return self._orthozer.unconvert_orb(orb)
+
     def aodm2dens(self, dm: torch.Tensor, xyz: torch.Tensor) -> torch.Tensor:
         # xyz: (*BR, ndim)
         # dm: (*BD, nao, nao)
@@ -321,8 +492,7 @@ class HamiltonCGTO(BaseHamilton):
         assert self.xc is not None, "Please call .setup_grid with the xc object"
 
         # obtain the energy density per unit volume
-        densinfo = SpinParam.apply_fcn(
-            lambda dm_: self._dm2densinfo(dm_), dm)  # (spin) value: (*BD, nr)
+        densinfo = self._dm2densinfo_spin(dm)  # (spin) value: (*BD, nr)
         edens = self.xc.get_edensityxc(densinfo)  # (*BD, nr)
 
         return torch.sum(self.grid.get_dvolume() * edens, dim=-1)
@@ -368,14 +538,34 @@ class HamiltonCGTO(BaseHamilton):
         return self._orbparam.orb2params(orbq_params)
 
     ################ misc ################
+    def _dm2densinfo_spin(self, dm: Union[torch.Tensor, SpinParam[torch.Tensor]]) \
+            -> Union[ValGrad, SpinParam[ValGrad]]:
+        # calculate the density information of both spins in a single pass
+        # over the basis by stacking them in the batch dimension
+        if not isinstance(dm, SpinParam):
+            return self._dm2densinfo(dm)
+        dm_u, dm_d = torch.broadcast_tensors(dm.u, dm.d)
+        densinfo = self._dm2densinfo(torch.stack((dm_u, dm_d), dim=0))  # value: (2, *BD, nr)
+        return SpinParam(u=_select_valgrad(densinfo, 0), d=_select_valgrad(densinfo, 1))
+
+    def _get_vxc_from_potinfo_spin(self, potinfo: Union[ValGrad, SpinParam[ValGrad]]) \
+            -> Union[xt.LinearOperator, SpinParam[xt.LinearOperator]]:
+        # obtain the vxc operators of both spins in a single pass over the
+        # basis by stacking them in the batch dimension
+        if not isinstance(potinfo, SpinParam):
+            return self._get_vxc_from_potinfo(potinfo)
+        vxc = self._get_vxc_from_potinfo(_stack_valgrad(potinfo.u, potinfo.d)).fullmatrix()  # (2, *BD, nao, nao)
+        return SpinParam(u=xt.LinearOperator.m(vxc[0], is_hermitian=True),
+                         d=xt.LinearOperator.m(vxc[1], is_hermitian=True))
+
     def _dm2densinfo(self, dm: torch.Tensor) -> ValGrad:
         # dm: (*BD, nao, nao), Hermitian
         # family: 1 for LDA, 2 for GGA, 3 for MGGA
-        # self.basis: (ngrid, nao)
-        # self.grad_basis: (ndim, ngrid, nao)
+        # self.ao_stack: (ncomp, ngrid, nao)
 
-        ngrid = self.basis.shape[-2]
+        ngrid = self.rgrid.shape[-2]
         batchshape = dm.shape[:-2]
+        self._check_ao_set()
 
         # dm @ ao will be used in every case
         dmdmt = (dm + dm.transpose(-2, -1)) * 0.5  # (*BD, nao2, nao2)
@@ -394,46 +584,33 @@ class HamiltonCGTO(BaseHamilton):
             lapldens = torch.empty((*batchshape, ngrid), dtype=self.dtype, device=self.device)
             kindens = torch.empty((*batchshape, ngrid), dtype=self.dtype, device=self.device)
 
-        # It is faster to split into chunks than evaluating a single big chunk
-        maxnumel = config.CHUNK_MEMORY // get_dtype_memsize(self.basis)
-        for basis, ioff, iend in chunkify(self.basis, dim=0, maxnumel=maxnumel):
-            # basis: (ngrid2, nao)
+        # the number of the stacked basis components multiplied by the density
+        # matrix: only the values for LDA and GGA, the values and gradients for MGGA
+        nmul = 4 if self.xcfamily == 4 else 1
 
-            dmao = torch.matmul(basis, dmdmt)  # (ngrid2, nao)
-            dens[..., ioff:iend] = torch.einsum("...ri,ri->...r", dmao, basis)
+        # It is faster to split into chunks than evaluating a single big chunk
+        for ioff, iend, aoidx in self._get_grid_chunks():
+            # only take the atomic orbitals that are significant in the chunk
+            ao = self._get_ao_stack_chunk(ioff, iend, aoidx)  # (ncomp, ngrid2, nao2)
+            dm_chunk = dmdmt if aoidx is None else dmdmt[..., aoidx[:, None], aoidx]  # (*BD, nao2, nao2)
+
+            # multiply the stacked basis with the density matrix in a single GEMM
+            nr, nao2 = ao.shape[-2:]
+            dmao = torch.matmul(ao[:nmul].reshape(-1, nao2), dm_chunk)  # (*BD, nmul * ngrid2, nao2)
+            dmao = dmao.reshape(*batchshape, nmul, nr, nao2)
+            dmao0 = dmao[..., 0, :, :]  # (*BD, ngrid2, nao2)
+            dens[..., ioff:iend] = torch.einsum("...ri,ri->...r", dmao0, ao[0])
 
             if self.xcfamily == 2 or self.xcfamily == 4:  # GGA or MGGA
                 assert gdens is not None
-                if not self.is_grad_ao_set:
-                    msg = "Please call `setup_grid(grid, gradlevel>=1)` to calculate the density gradient"
-                    raise RuntimeError(msg)
-
-                # summing it 3 times is faster than applying the d-axis directly
-                grad_basis0 = self.grad_basis[0, ioff:iend, :]  # (ngrid2, nao)
-                grad_basis1 = self.grad_basis[1, ioff:iend, :]
-                grad_basis2 = self.grad_basis[2, ioff:iend, :]
-
-                gdens[..., 0, ioff:iend] = torch.einsum("...ri,ri->...r", dmao, grad_basis0) * 2
-                gdens[..., 1, ioff:iend] = torch.einsum("...ri,ri->...r", dmao, grad_basis1) * 2
-                gdens[..., 2, ioff:iend] = torch.einsum("...ri,ri->...r", dmao, grad_basis2) * 2
+                gdens[..., ioff:iend] = torch.einsum("...ri,dri->...dr", dmao0, ao[1:4]) * 2
 
             if self.xcfamily == 4:
                 assert lapldens is not None
                 assert kindens is not None
                 # calculate the laplacian of the density and kinetic energy density at the grid
-                if not self.is_lapl_ao_set:
-                    msg = "Please call `setup_grid(grid, gradlevel>=2)` to calculate the density gradient"
-                    raise RuntimeError(msg)
-
-                lapl_basis_cat = self.lapl_basis[ioff:iend, :]
-                lapl_basis = torch.einsum("...ri,ri->...r", dmao, lapl_basis_cat)
-                grad_grad = torch.einsum("...ri,ri->...r", torch.matmul(grad_basis0, dmdmt), grad_basis0)
-                grad_grad += torch.einsum("...ri,ri->...r", torch.matmul(grad_basis1, dmdmt), grad_basis1)
-                grad_grad += torch.einsum("...ri,ri->...r", torch.matmul(grad_basis2, dmdmt), grad_basis2)
-                # pytorch's "...ij,ir,jr->...r" is really slow for large matrix
-                # grad_grad = torch.einsum("...ij,ir,jr->...r", dmdmt, self.grad_basis[0], self.grad_basis[0])
-                # grad_grad += torch.einsum("...ij,ir,jr->...r", dmdmt, self.grad_basis[1], self.grad_basis[1])
-                # grad_grad += torch.einsum("...ij,ir,jr->...r", dmdmt, self.grad_basis[2], self.grad_basis[2])
+                lapl_basis = torch.einsum("...ri,ri->...r", dmao0, ao[4])
+                grad_grad = torch.einsum("...dri,dri->...r", dmao[..., 1:4, :, :], ao[1:4])
                 lapldens[..., ioff:iend] = (lapl_basis + grad_grad) * 2
                 kindens[..., ioff:iend] = grad_grad * 0.5
 
@@ -448,45 +625,54 @@ class HamiltonCGTO(BaseHamilton):
         # potinfo.grad: (*BD, ndim, nr)
         # potinfo.lapl: (*BD, nr)
         # potinfo.kin: (*BD, nr)
-        # self.basis: (nr, nao)
-        # self.grad_basis: (ndim, nr, nao)
+        # self.ao_stack: (ncomp, nr, nao)
+        self._check_ao_set()
 
         # prepare the fock matrix component from vxc
-        nao = self.basis.shape[-1]
-        mat = torch.zeros((*potinfo.value.shape[:-1], nao, nao), dtype=self.dtype, device=self.device)
+        nao = self.libcint_wrapper.nao()
+        batchshape = potinfo.value.shape[:-1]
+        mat = torch.zeros((*batchshape, nao, nao), dtype=self.dtype, device=self.device)
 
         # Split the r-dimension into several parts, it is usually faster than
         # evaluating all at once
-        maxnumel = config.CHUNK_MEMORY // get_dtype_memsize(self.basis)
-        for basis, ioff, iend in chunkify(self.basis, dim=0, maxnumel=maxnumel):
-            # basis: (nr, nao)
-            vb = potinfo.value[..., ioff:iend].unsqueeze(-1) * basis  # (*BD, nr, nao)
+        for ioff, iend, aoidx in self._get_grid_chunks():
+            # only take the atomic orbitals that are significant in the chunk
+            ao = self._get_ao_stack_chunk(ioff, iend, aoidx)  # (ncomp, nr, nao2)
+            nao2 = ao.shape[-1]
+            dvol = self.dvolume[ioff:iend]  # (nr,)
+
+            # the matrix is symmetric, V = H + H^T, so only the half H = ao0^T @ aow
+            # is calculated, where aow is the basis components contracted with
+            # the half of their potentials
+            ws = [(0.5 * potinfo.value[..., ioff:iend] * dvol).unsqueeze(-2)]  # list of (*BD, ncomp', nr)
             if self.xcfamily in [2, 4]:  # GGA or MGGA
                 assert potinfo.grad is not None  # (..., ndim, nr)
-                vgrad = potinfo.grad[..., ioff:iend] * 2
-                grad_basis0 = self.grad_basis[0, ioff:iend, :]  # (nr, nao)
-                grad_basis1 = self.grad_basis[1, ioff:iend, :]
-                grad_basis2 = self.grad_basis[2, ioff:iend, :]
-                vb += torch.einsum("...r,ra->...ra", vgrad[..., 0, :], grad_basis0)
-                vb += torch.einsum("...r,ra->...ra", vgrad[..., 1, :], grad_basis1)
-                vb += torch.einsum("...r,ra->...ra", vgrad[..., 2, :], grad_basis2)
+                ws.append(potinfo.grad[..., ioff:iend] * dvol)
             if self.xcfamily == 4:  # MGGA
                 assert potinfo.lapl is not None  # (..., nrgrid)
                 assert potinfo.kin is not None
                 lapl = potinfo.lapl[..., ioff:iend]
                 kin = potinfo.kin[..., ioff:iend]
-                vb += 2 * lapl.unsqueeze(-1) * self.lapl_basis[ioff:iend, :]
-
-            # calculating the matrix from multiplication with the basis
-            mat += torch.matmul(self.basis_dvolume[ioff:iend, :].transpose(-2, -1), vb)
+                ws.append((lapl * dvol).unsqueeze(-2))
+            w = torch.cat(ws, dim=-2)  # (*BD, ncomp, nr)
+            aow = torch.einsum("...cr,cri->...ri", w, ao)  # (*BD, nr, nao2)
 
+            lhs = ao[0]  # (nr, nao2)
+            rhs = aow
             if self.xcfamily == 4:  # MGGA
-                assert potinfo.lapl is not None  # (..., nrgrid)
-                assert potinfo.kin is not None
-                lapl_kin_dvol = (2 * lapl + 0.5 * kin) * self.dvolume[..., ioff:iend]
-                mat += torch.einsum("...r,rb,rc->...bc", lapl_kin_dvol, grad_basis0, grad_basis0)
-                mat += torch.einsum("...r,rb,rc->...bc", lapl_kin_dvol, grad_basis1, grad_basis1)
-                mat += torch.einsum("...r,rb,rc->...bc", lapl_kin_dvol, grad_basis2, grad_basis2)
+                # the term sum_d (d phi)^T diag(wk) (d phi) is added in the same
+                # GEMM by stacking the gradients in the r-dimension
+                wk = 0.5 * (2 * lapl + 0.5 * kin) * dvol  # (*BD, nr)
+                lhs = ao[:4].reshape(-1, nao2)  # (4 * nr, nao2)
+                rhs = torch.cat((aow.unsqueeze(-3), wk.unsqueeze(-2).unsqueeze(-1) * ao[1:4]), dim=-3)
+                rhs = rhs.reshape(*batchshape, -1, nao2)  # (*BD, 4 * nr, nao2)
+            mat_half = torch.matmul(lhs.transpose(-2, -1), rhs)  # (*BD, nao2, nao2)
+            mat_chunk = mat_half + mat_half.transpose(-2, -1)
+
+            if aoidx is None:
+                mat += mat_chunk
+            else:
+                mat[..., aoidx[:, None], aoidx] += mat_chunk
 
         # construct the Hermitian linear operator
         mat = self._orthozer.convert2(mat)
@@ -494,6 +680,93 @@ class HamiltonCGTO(BaseHamilton):
         vxc_linop = xt.LinearOperator.m(mat, is_hermitian=True)
         return vxc_linop
 
+    def _check_ao_set(self) -> None:
+        # check if the basis components required by the xc are available
+        if (self.xcfamily == 2 or self.xcfamily == 4) and not self.is_grad_ao_set:
+            msg = "Please call `setup_grid(grid, gradlevel>=1)` to calculate the density gradient"
+            raise RuntimeError(msg)
+        if self.xcfamily == 4 and not self.is_lapl_ao_set:
+            msg = "Please call `setup_grid(grid, gradlevel>=2)` to calculate the density gradient"
+            raise RuntimeError(msg)
+
+    def _get_ao_stack_chunk(self, ioff: int, iend: int, aoidx: Optional[torch.Tensor]) -> torch.Tensor:
+        # get the basis components required by the xc in the grid points
+        # ioff:iend for the selected atomic orbitals stacked in the first
+        # dimension: the values, then the 3 gradients for GGA and MGGA, then
+        # the laplacian for MGGA
+        # returns: (ncomp, iend - ioff, nao2)
+        if not self._ao_recompute:
+            return _select_ao(self.ao_stack[:, ioff:iend, :], aoidx)
+        aos = [_select_ao(self._get_ao_chunk("", ioff, iend), aoidx).unsqueeze(0)]
+        if self.xcfamily == 2 or self.xcfamily == 4:
+            aos.append(_select_ao(self._get_ao_chunk("ip", ioff, iend), aoidx))
+        if self.xcfamily == 4:
+            aos.append(_select_ao(self._get_ao_chunk("lapl", ioff, iend), aoidx).unsqueeze(0))
+        if len(aos) == 1:
+            return aos[0]
+        return torch.cat(aos, dim=0)
+
+    def _get_ao_recompute(self) -> bool:
+        # decide whether the basis values in the grid are evaluated on the fly
+        if self._ao_grid_mode != "auto":
+            return self._ao_grid_mode == "recompute"
+        # number of (ngrid, nao) tensors stored: basis, 3 for grad_basis, and lapl_basis
+        narrays = {1: 1, 2: 4}.get(self.xcfamily, 5)
+        memsize = narrays * self.rgrid.shape[-2] * self.libcint_wrapper.nao() * get_dtype_memsize(self.rgrid)
+        return memsize > config.THRESHOLD_MEMORY
+
+    def _get_grid_chunks(self) -> List[Tuple[int, int, Optional[torch.Tensor]]]:
+        # split the grid points into chunks of consecutive grid blocks (the
+        # blocks of the significance mask), where the stacked basis components
+        # of a chunk fit in config.CHUNK_MEMORY
+        # returns the list of (ioff, iend, indices of the significant orbitals)
+        # which is shared by the density and the potential calculations
+        if config.CHUNK_MEMORY in self._grid_chunks:
+            return self._grid_chunks[config.CHUNK_MEMORY]
+
+        ncomp = {1: 1, 2: 4}.get(self.xcfamily, 5)
+        rowsize = ncomp * self.libcint_wrapper.nao() * get_dtype_memsize(self.rgrid)
+        nblks = max(config.CHUNK_MEMORY // rowsize // BLKSIZE, 1)
+        nblocks = self._grid_ranges.shape[0]
+        chunks = []
+        for iblk in range(0, nblocks, nblks):
+            ioff = int(self._grid_ranges[iblk, 0])
+            iend = int(self._grid_ranges[min(iblk + nblks, nblocks) - 1, 1])
+            chunks.append((ioff, iend, self._get_chunk_aoidx(ioff, iend)))
+        self._grid_chunks = {config.CHUNK_MEMORY: chunks}
+        return chunks
+
+    def _get_ao_chunk(self, shortname: str, ioff: int, iend: int) -> torch.Tensor:
+        # get the basis values ("", "ip", or "lapl") in the grid points ioff:iend,
+        # ioff must be a multiple of BLKSIZE
+        # returns: (*ncomp, iend - ioff, nao)
+        if not self._ao_recompute:
+            stored = {"": "basis", "ip": "grad_basis", "lapl": "lapl_basis"}[shortname]
+            return getattr(self, stored)[..., ioff:iend, :]
+        non0tab = self._non0tab[ioff // BLKSIZE:(iend + BLKSIZE - 1) // BLKSIZE]
+        return intor.evl(shortname, self.libcint_wrapper, self.rgrid[ioff:iend],
+                         to_transpose=True, non0tab=non0tab)
+
+    def _get_ao_paramnames(self, names: List[str], prefix: str) -> List[str]:
+        # get the parameter names of the basis values in the grid, which are
+        # the grid and the basis parameters if they are evaluated on the fly
+        if not self._ao_recompute:
+            return [prefix + name for name in names]
+        return [prefix + "rgrid", prefix + "dvolume",
+                prefix + "libcint_wrapper._allcoeffs_params",
+                prefix + "libcint_wrapper._allalphas_params",
+                prefix + "libcint_wrapper._allpos_params"]
+
+    def _get_chunk_aoidx(self, ioff: int, iend: int) -> Optional[torch.Tensor]:
+        # get the indices of the atomic orbitals that are significant in any
+        # grid blocks overlapping with the grid points ioff:iend
+        # returns None if most of the orbitals are significant, where the
+        # dense multiplication is faster than gathering the orbitals
+        ao_non0 = self._ao_non0tab[ioff // BLKSIZE:(iend + BLKSIZE - 1) // BLKSIZE].any(dim=0)  # (nao,)
+        if int(ao_non0.sum()) > 0.8 * ao_non0.shape[0]:
+            return None
+        return torch.nonzero(ao_non0, as_tuple=True)[0]
+
     def getparamnames(self, methodname: str, prefix: str = "") -> List[str]:
         if methodname == "get_kinnucl":
             return [prefix + "kinnucl_mat"]
@@ -502,14 +775,30 @@ class HamiltonCGTO(BaseHamilton):
         elif methodname == "get_overlap":
             return [prefix + "olp_mat"]
         elif methodname == "get_elrep":
-            if self._df is None:
-                return [prefix + "el_mat"]
-            else:
+            if self._df is not None:
                 return self._df.getparamnames("get_elrep", prefix=prefix + "_df.")
+            elif self._eri_mode == "direct":
+                return self._orthozer.getparamnames("unconvert_dm", prefix=prefix + "_orthozer.") + \
+                    self._orthozer.getparamnames("convert2", prefix=prefix + "_orthozer.")
+            else:
+                return [prefix + "el_mat"]
         elif methodname == "get_exchange":
-            return [prefix + "el_mat"]
+            if self._eri_mode == "direct":
+                return self._orthozer.getparamnames("unconvert_dm", prefix=prefix + "_orthozer.") + \
+                    self._orthozer.getparamnames("convert2", prefix=prefix + "_orthozer.")
+            else:
+                return [prefix + "el_mat"]
+        elif methodname == "get_jk":
+            if self._df is not None:
+                return self.getparamnames("get_elrep", prefix=prefix)
+            else:
+                return self.getparamnames("get_exchange", prefix=prefix)
         elif methodname == "ao_orb2dm":
             return []
+        elif methodname == "raw_orb2ao_orb":
+            return self._orthozer.getparamnames("convert_orb", prefix=prefix + "_orthozer.")
+        elif methodname == "ao_orb2raw_orb":
+            return self._orthozer.getparamnames("unconvert_orb", prefix=prefix + "_orthozer.")
         elif methodname == "ao_orb_params2dm":
             return self.getparamnames("ao_orb2dm", prefix=prefix) + \
                 self._orthozer.getparamnames("convert_ortho_orb", prefix=prefix + "_orthozer.")
@@ -525,34 +814,130 @@ class HamiltonCGTO(BaseHamilton):
                 self.xc.getparamnames("get_edensityxc", prefix=prefix + "xc.") + \
                 self.grid.getparamnames("get_dvolume", prefix=prefix + "grid.")
         elif methodname == "get_vext":
-            return [prefix + "basis_dvolume", prefix + "basis"] + \
+            return self._get_ao_paramnames(["dvolume", "basis"], prefix=prefix) + \
                 self._orthozer.getparamnames("convert2", prefix=prefix + "_orthozer.")
         elif methodname == "get_grad_vext":
-            return [prefix + "basis_dvolume", prefix + "grad_basis"]
+            return self._get_ao_paramnames(["dvolume", "grad_basis"], prefix=prefix)
         elif methodname == "get_lapl_kin_vext":
-            return [prefix + "dvolume", prefix + "basis", prefix + "grad_basis",
-                    prefix + "lapl_basis"]
+            return self._get_ao_paramnames(["dvolume", "basis", "grad_basis", "lapl_basis"],
+                                           prefix=prefix)
         elif methodname == "get_vxc":
             assert self.xc is not None
             return self.getparamnames("_dm2densinfo", prefix=prefix) + \
                 self.getparamnames("_get_vxc_from_potinfo", prefix=prefix) + \
                 self.xc.getparamnames("get_vxc", prefix=prefix + "xc.")
         elif methodname == "_dm2densinfo":
-            params = [prefix + "basis"] + \
+            return self._get_ao_paramnames(["ao_stack"], prefix=prefix) + \
                 self._orthozer.getparamnames("unconvert_dm", prefix=prefix + "_orthozer.")
-            if self.xcfamily == 2 or self.xcfamily == 4:
-                params += [prefix + "grad_basis"]
-            if self.xcfamily == 4:
-                params += [prefix + "lapl_basis"]
-            return params
         elif methodname == "_get_vxc_from_potinfo":
-            params = [prefix + "basis", prefix + "basis_dvolume"] + \
+            return self._get_ao_paramnames(["ao_stack", "dvolume"], prefix=prefix) + \
                 self._orthozer.getparamnames("convert2", prefix=prefix + "_orthozer.")
-            if self.xcfamily in [2, 4]:
-                params += [prefix + "grad_basis"]
-            if self.xcfamily == 4:
-                params += [prefix + "lapl_basis", prefix + "dvolume"]
-            return params
         else:
             raise KeyError("getparamnames has no %s method" % methodname)
         # TODO: complete this
+
+def _select_valgrad(vg: ValGrad, idx: int) -> ValGrad:
+    # select the index of the first batch dimension of all the components
+    return ValGrad(
+        value=vg.value[idx],
+        grad=vg.grad[idx] if vg.grad is not None else None,
+        lapl=vg.lapl[idx] if vg.lapl is not None else None,
+        kin=vg.kin[idx] if vg.kin is not None else None,
+    )
+
+def _stack_valgrad(vg0: ValGrad, vg1: ValGrad) -> ValGrad:
+    # stack the components of the two ValGrads in a new first batch dimension
+    def _stack(a: Optional[torch.Tensor], b: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+        if a is None or b is None:
+            return None
+        return torch.stack(torch.broadcast_tensors(a, b), dim=0)
+
+    value = _stack(vg0.value, vg1.value)
+    assert value is not None
+    return ValGrad(value=value, grad=_stack(vg0.grad, vg1.grad),
+                   lapl=_stack(vg0.lapl, vg1.lapl), kin=_stack(vg0.kin, vg1.kin))
+
+def _select_ao(basis: torch.Tensor, aoidx: Optional[torch.Tensor]) -> torch.Tensor:
+    # select the significant atomic orbitals in the last dimension
+    # basis: (..., nao)
+    # returns: (..., nao2)
+    if aoidx is None:
+        return basis
+    return basis.index_select(-1, aoidx)
+
+def _get_s8_row_chunks(el_mat: torch.Tensor) -> Iterator[Tuple[torch.Tensor, int, int]]:
+    # iterate over the chunks of the rows of the (npair, npair) matrix from
+    # the 8-fold symmetry packed electron repulsion integrals
+    # el_mat: (npair * (npair + 1) // 2)
+    # yields the rows with shape (nrows, npair), and the rows offset and end
+    nao = intor.get_nao_from_s8(el_mat.shape[-1])
+    npair = nao * (nao + 1) // 2
+    maxnumel = config.CHUNK_MEMORY // get_dtype_memsize(el_mat)
+    nrows = max(1, min(npair, maxnumel // max(npair, nao * nao)))
+    for ioff in range(0, npair, nrows):
+        iend = min(ioff + nrows, npair)
+        yield intor.get_s8_rows(el_mat, ioff, iend), ioff, iend
+
+def _get_jk_dense(dm: torch.Tensor, el_mat: torch.Tensor, with_j: bool, with_k: bool) \
+        -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]:
+    # calculate the coulomb and exchange matrices from the full electron repulsion
+    # integrals in one sweep over the blocks of the first index, i, with GEMMs
+    # dm: (*BD, nao, nao)
+    # el_mat: (nao, nao, nao, nao)
+    # return: (*BD, nao, nao) for both matrices, or None if not requested
+    nao = dm.shape[-1]
+    batch_shape = dm.shape[:-2]
+    dmflat = dm.reshape(-1, nao * nao)  # (nbatch, nao * nao)
+    nbatch = dmflat.shape[0]
+    maxnumel = config.CHUNK_MEMORY // get_dtype_memsize(el_mat)
+    nrows = max(1, min(nao, maxnumel // (nao * max(nao * nao, nbatch))))
+
+    jmat: Optional[torch.Tensor] = None
+    kmats: List[torch.Tensor] = []
+    for ioff in range(0, nao, nrows):
+        iend = min(ioff + nrows, nao)
+        eri = el_mat[ioff:iend]  # (ni, nao, nao, nao)
+        if with_j:
+            # J_kl += sum_j D_ij (ij|kl) for i in the block
+            jblk = torch.matmul(dmflat[:, ioff * nao:iend * nao], eri.reshape(-1, nao * nao))
+            jmat = jblk if jmat is None else jmat + jblk
+        if with_k:
+            # K_il = sum_jk D_jk (ij|kl) for i in the block
+            kblk = torch.matmul(dmflat, eri.reshape(iend - ioff, nao * nao, nao))  # (ni, nbatch, nao)
+            kmats.append(kblk.transpose(0, 1))
+    jres = jmat.reshape(*batch_shape, nao, nao) if jmat is not None else None
+    kres = torch.cat(kmats, dim=-2).reshape(*batch_shape, nao, nao) if with_k else None
+    return jres, kres
+
+def _get_jk_s8(dm: torch.Tensor, el_mat: torch.Tensor, with_j: bool, with_k: bool) \
+        -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]:
+    # calculate the coulomb and exchange matrices from the packed electron
+    # repulsion integrals in one sweep over the chunks of rows
+    # dm: (*BD, nao, nao)
+    # el_mat: (npair * (npair + 1) // 2)
+    # return: (*BD, nao, nao) for both matrices, or None if not requested
+    nao = dm.shape[-1]
+    ti, tj = torch.tril_indices(nao, nao, device=dm.device)
+    pair_idx = intor.get_pair_index(nao, device=dm.device)
+    # the coulomb matrix is obtained by contracting the pairs (ij|kl) * (D_ij + D_ji)
+    # for i >= j
+    dmpair = dm[..., ti, tj] + dm[..., tj, ti] * (ti != tj).to(dm.dtype)  # (*BD, npair)
+
+    jpairs: List[torch.Tensor] = []
+    kmat: Optional[torch.Tensor] = torch.zeros_like(dm) if with_k else None
+    for rows, ioff, iend in _get_s8_row_chunks(el_mat):
+        if with_j:
+            # the (npair, npair) matrix is symmetric, so the rows can be used as columns
+            jpairs.append(torch.matmul(dmpair, rows.transpose(-2, -1)))  # (*BD, nrows)
+        if kmat is not None:
+            # the rows correspond to the pairs (a, b) with a >= b
+            a = ti[ioff:iend]
+            b = tj[ioff:iend]
+            eri = rows[..., pair_idx]  # (nrows, nao, nao) = (ab|kl)
+            # (ij|kl) with (i, j) = (a, b)
+            kmat = kmat.index_add(-2, a, torch.einsum("...pk,pkl->...pl", dm[..., b, :], eri))
+            # (ij|kl) with (i, j) = (b, a) for a != b
+            offdiag = (a != b).to(dm.dtype)  # (nrows,)
+            kmat = kmat.index_add(-2, b, torch.einsum("...pk,pkl,p->...pl", dm[..., a, :], eri, offdiag))
+    jmat = torch.cat(jpairs, dim=-1)[..., pair_idx] if with_j else None
+    return jmat, kmat
@@ -83,6 +83,11 @@ class HamiltonCGTO_PBC(HamiltonCGTO):
     def kpts(self) -> torch.Tensor:
         return self._kpts
 
+    @property
+    def wkpts(self) -> torch.Tensor:
+        # the weights of the k-points with shape (nkpts,)
+        return self._wkpts
+
     @property
     def df(self) -> Optional[BaseDF]:
         return self._df
@@ -216,6 +221,17 @@ class HamiltonCGTO_PBC(HamiltonCGTO):
         res = torch.einsum("kao,o,kbo->kab", orb, orb_weight.to(dtype), orb.conj())
         return res
 
+    def raw_orb2ao_orb(self, orb: torch.Tensor) -> torch.Tensor:
+        # the basis is not transformed, so the Bloch sums of the orbitals have
+        # the same coefficients in all k-points
+        # orb: (nao, norb)
+        # return: (nkpts, nao, norb)
+        nkpts = self._kpts.shape[0]
+        return orb.to(self.cdtype).unsqueeze(0).expand(nkpts, *orb.shape)
+
+    def ao_orb2raw_orb(self, orb: torch.Tensor) -> torch.Tensor:
+        raise NotImplementedError("Converting the Bloch orbitals into the raw basis is not implemented")
+
     def aodm2dens(self, dm: torch.Tensor, xyz: torch.Tensor) -> torch.Tensor:
         # xyz: (*BR, ndim)
         # dm: (*BD, nkpts, nao, nao)
@@ -274,8 +290,12 @@ class HamiltonCGTO_PBC(HamiltonCGTO):
         elif methodname == "get_elrep":
             assert self._df is not None
             return self._df.getparamnames("get_elrep", prefix=prefix + "_df.")
+        elif methodname == "get_jk":
+            return self.getparamnames("get_elrep", prefix=prefix)
         elif methodname == "ao_orb2dm":
             return []
+        elif methodname in ["raw_orb2ao_orb", "ao_orb2raw_orb"]:
+            return []
         elif methodname == "get_vext":
             return [prefix + "basis_dvolume_conj", prefix + "basis"]
         elif methodname == "get_grad_vext":
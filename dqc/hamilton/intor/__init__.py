@@ -4,3 +4,5 @@ from dqc.hamilton.intor.pbcintor import *
 from dqc.hamilton.intor.pbcftintor import *
 from dqc.hamilton.intor.gtoeval import *
 from dqc.hamilton.intor.gtoft import *
+from dqc.hamilton.intor.packed import *
+from dqc.hamilton.intor.directjk import *
@@ -0,0 +1,204 @@
+from typing import Tuple, Dict, List
+import ctypes
+import numpy as np
+import torch
+from dqc.hamilton.intor.lcintwrap import LibcintWrapper
+from dqc.hamilton.intor.molintor import _get_intgl_optimizer, _get_atom_blocks, _get_block_max
+from dqc.hamilton.intor.namemgr import IntorNameManager
+from dqc.hamilton.intor.utils import np2ctypes, int2ctypes, CINT, CGTO
+from dqc.utils.config import config
+
+__all__ = ["DirectJK", "direct_jk"]
+
+class DirectJK(object):
+    """
+    Builder of the Coulomb and exchange matrices directly from the 4-centre
+    electron repulsion integrals of the significant shell quartets without
+    storing the integrals.
+    The Coulomb matrix is ``J_kl = sum_ij D_ij (ij|kl)`` and the exchange
+    matrix is ``K_il = sum_jk D_jk (ij|kl)``.
+    The shell quartets are screened by the Schwarz bounds multiplied by the
+    maximum density matrix elements of the blocks, with the threshold
+    ``config.ERI_SCREEN_THRESHOLD``.
+
+    Arguments
+    ---------
+    wrapper: LibcintWrapper
+        The wrapper of the basis.
+    nrebuild: int
+        The number of incremental builds before the matrices are fully rebuilt
+        to remove the accumulated screening error.
+    """
+    def __init__(self, wrapper: LibcintWrapper, nrebuild: int = 10):
+        self.wrapper = wrapper
+        self.nrebuild = nrebuild
+        self.atm, self.bas, self.env = wrapper.atm_bas_env
+
+        # get the operator
+        opname = IntorNameManager("int2e", "ar12b").get_intgl_name(wrapper.spherical)
+        self.op = getattr(CINT(), opname)
+        self.optimizer = _get_intgl_optimizer(opname, self.atm, self.bas, self.env)
+
+        # get the atom blocks and their maximum Schwarz bounds
+        self.shell_blocks = _get_atom_blocks(wrapper)
+        sl = slice(*wrapper.shell_idxs)
+        bounds = wrapper.full_schwarz_bounds()[sl, sl]
+        self.qblock = _get_block_max(bounds, self.shell_blocks, self.shell_blocks)  # (nblocks, nblocks)
+
+        shell_to_aoloc = wrapper.full_shell_to_aoloc
+        ao0 = shell_to_aoloc[wrapper.shell_idxs[0]]
+        self.ao_slices = [slice(shell_to_aoloc[sh0] - ao0, shell_to_aoloc[sh1] - ao0)
+                          for (sh0, sh1) in self.shell_blocks]
+
+        # the previous results for incremental builds, the key is (shape, with_j, with_k)
+        # and the value is (dm, j, k, number of incremental builds)
+        self._prev: Dict[Tuple, Tuple[np.ndarray, np.ndarray, np.ndarray, int]] = {}
+
+    def build(self, dm: np.ndarray, with_j: bool = True, with_k: bool = True,
+              incremental: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Build the Coulomb and exchange matrices from the density matrix with
+        shape ``(nbatch, nao, nao)``.
+        If ``incremental``, the matrices are built from the difference to the
+        density matrix of the previous incremental build with the same shape,
+        so more shell quartets can be screened as the SCF converges.
+        The matrices which are not requested are returned as zeros.
+        """
+        key = (dm.shape, with_j, with_k)
+        if incremental and key in self._prev:
+            dm_prev, j_prev, k_prev, nsteps = self._prev[key]
+            if nsteps < self.nrebuild:
+                dj, dk = self._build(dm - dm_prev, with_j, with_k)
+                j = j_prev + dj
+                k = k_prev + dk
+                self._prev[key] = (dm.copy(), j, k, nsteps + 1)
+                return j, k
+
+        j, k = self._build(dm, with_j, with_k)
+        if incremental:
+            self._prev[key] = (dm.copy(), j, k, 0)
+        return j, k
+
+    def _build(self, dm: np.ndarray, with_j: bool, with_k: bool) -> Tuple[np.ndarray, np.ndarray]:
+        # dm: (nbatch, nao, nao)
+        thresh = config.ERI_SCREEN_THRESHOLD
+        nblocks = len(self.shell_blocks)
+        jmat = np.zeros_like(dm)
+        kmat = np.zeros_like(dm)
+
+        # maximum absolute density matrix elements in every pair of blocks
+        idx = [s.start for s in self.ao_slices]
+        dabs = np.max(np.abs(dm), axis=0)
+        dmax = np.maximum.reduceat(np.maximum.reduceat(dabs, idx, axis=0), idx, axis=1)
+        dmax = np.maximum(dmax, dmax.T)  # (nblocks, nblocks)
+
+        # only calculate the blocks with iblock0 >= iblock1 and iblock2 >= iblock3
+        tril = np.tri(nblocks, dtype=bool)
+        q = self.qblock
+        bra_mask = tril & (q * np.max(q) * np.max(dmax) >= thresh)
+        for ib0, ib1 in zip(*np.nonzero(bra_mask)):
+            # get the density factor for every ket blocks pair
+            dfac = np.zeros((nblocks, nblocks))
+            if with_j:
+                dfac = np.maximum(dfac, dmax[ib0, ib1])
+            if with_k:
+                dk = np.maximum(dmax[ib0], dmax[ib1])
+                dfac = np.maximum(dfac, np.maximum(dk[:, None], dk[None, :]))
+            mask = tril & (q[ib0, ib1] * q * dfac >= thresh)  # (nblocks, nblocks)
+
+            for ib2 in np.nonzero(np.any(mask, axis=-1))[0]:
+                ib3s = np.nonzero(mask[ib2])[0]
+                eri = self._calc_block(ib0, ib1, ib2, ib3s[0], ib3s[-1] + 1)
+                self._add_block_contrib(dm, jmat, kmat, eri, ib0, ib1, ib2, ib3s[0], ib3s[-1] + 1,
+                                        with_j, with_k)
+        return jmat, kmat
+
+    def _calc_block(self, ib0: int, ib1: int, ib2: int, ib3s: int, ib3e: int) -> np.ndarray:
+        # calculate the integrals of the blocks with the last block given as a range
+        # returns: (nao_b0, nao_b1, nao_b2, nao_b3s:b3e)
+        blocks = self.shell_blocks
+        shells = [blocks[ib0], blocks[ib1], blocks[ib2], (blocks[ib3s][0], blocks[ib3e - 1][1])]
+        shls_slice = sum(shells, ())
+        shell_to_aoloc = self.wrapper.full_shell_to_aoloc
+        blockshape = tuple(shell_to_aoloc[sh1] - shell_to_aoloc[sh0] for (sh0, sh1) in shells)
+
+        out = np.empty(blockshape, dtype=np.float64)
+        drv = CGTO().GTOnr2e_fill_drv
+        fill = CGTO().GTOnr2e_fill_s1
+        prescreen = ctypes.POINTER(ctypes.c_void_p)()
+        drv(self.op, fill, prescreen,
+            out.ctypes.data_as(ctypes.c_void_p),
+            ctypes.c_int(1),
+            (ctypes.c_int * 8)(*shls_slice),
+            np2ctypes(shell_to_aoloc),
+            self.optimizer,
+            np2ctypes(self.atm), int2ctypes(self.atm.shape[0]),
+            np2ctypes(self.bas), int2ctypes(self.bas.shape[0]),
+            np2ctypes(self.env))
+        return out
+
+    def _add_block_contrib(self, dm: np.ndarray, jmat: np.ndarray, kmat: np.ndarray,
+                           eri: np.ndarray, ib0: int, ib1: int, ib2: int, ib3s: int, ib3e: int,
+                           with_j: bool, with_k: bool) -> None:
+        # add the contributions of the integrals block and its symmetry-equivalent
+        # blocks, (ij|kl) = (ji|kl) = (ij|lk) = (ji|lk), to the J and K matrices
+        ao_slices = self.ao_slices
+        sl0, sl1, sl2 = ao_slices[ib0], ao_slices[ib1], ao_slices[ib2]
+        sl3 = slice(ao_slices[ib3s].start, ao_slices[ib3e - 1].stop)
+
+        # the transposed ket is only for the blocks below the diagonal
+        # (the diagonal block already contains both (kl| and (lk|)
+        ncol_low = min(sl2.start, sl3.stop) - sl3.start
+        kets: List[Tuple[slice, slice, np.ndarray]] = [(sl2, sl3, eri)]
+        if ncol_low > 0:
+            sl3_low = slice(sl3.start, sl3.start + ncol_low)
+            kets.append((sl3_low, sl2, eri[..., :ncol_low].transpose(0, 1, 3, 2)))
+
+        for (slk, sll, eri_k) in kets:
+            bras: List[Tuple[slice, slice, np.ndarray]] = [(sl0, sl1, eri_k)]
+            if ib0 != ib1:
+                bras.append((sl1, sl0, eri_k.transpose(1, 0, 2, 3)))
+            for (sli, slj, eri_ijkl) in bras:
+                if with_j:
+                    # J_kl += sum_ij D_ij (ij|kl)
+                    jmat[:, slk, sll] += np.tensordot(dm[:, sli, slj], eri_ijkl, axes=([1, 2], [0, 1]))
+                if with_k:
+                    # K_il += sum_jk D_jk (ij|kl)
+                    kmat[:, sli, sll] += np.tensordot(dm[:, slj, slk], eri_ijkl, axes=([1, 2], [1, 2]))
+
+def direct_jk(builder: DirectJK, dm: torch.Tensor, with_j: bool = True, with_k: bool = True,
+              incremental: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Calculate the Coulomb and exchange matrices from the density matrix with
+    shape ``(..., nao, nao)`` using the direct builder.
+    The results are differentiable with respect to the density matrix, but not
+    with respect to the basis parameters.
+    """
+    return _DirectJKFunction.apply(dm, builder, with_j, with_k, incremental)
+
+class _DirectJKFunction(torch.autograd.Function):
+    # wrapper class to provide the gradient of the J and K matrices w.r.t. the
+    # density matrix
+    @staticmethod
+    def forward(ctx,  # type: ignore
+                dm: torch.Tensor, builder: DirectJK, with_j: bool, with_k: bool,
+                incremental: bool) -> Tuple[torch.Tensor, torch.Tensor]:
+        # dm: (..., nao, nao)
+        dm_np = dm.detach().reshape(-1, *dm.shape[-2:]).numpy()
+        jmat, kmat = builder.build(dm_np, with_j=with_j, with_k=with_k, incremental=incremental)
+        ctx.other_info = (builder, with_j, with_k)
+        jres = torch.as_tensor(jmat, dtype=dm.dtype, device=dm.device).reshape(dm.shape)
+        kres = torch.as_tensor(kmat, dtype=dm.dtype, device=dm.device).reshape(dm.shape)
+        return jres, kres
+
+    @staticmethod
+    def backward(ctx, grad_j: torch.Tensor, grad_k: torch.Tensor):  # type: ignore
+        # the J and K operations are self-adjoint because of the symmetry of
+        # the integrals, so the backward uses the same builder
+        builder, with_j, with_k = ctx.other_info
+        grad_dm = torch.zeros_like(grad_j)
+        if with_j:
+            grad_dm = grad_dm + _DirectJKFunction.apply(grad_j, builder, True, False, False)[0]
+        if with_k:
+            grad_dm = grad_dm + _DirectJKFunction.apply(grad_k, builder, False, True, False)[1]
+        return grad_dm, None, None, None, None
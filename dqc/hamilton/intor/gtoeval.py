@@ -7,16 +7,21 @@ from dqc.hamilton.intor.lcintwrap import LibcintWrapper
 from dqc.hamilton.intor.utils import np2ctypes, int2ctypes, NDIM, CGTO
 from dqc.hamilton.intor.pbcintor import _get_default_kpts, _get_default_options, PBCIntOption
 from dqc.utils.pbc import estimate_ovlp_rcut
+from dqc.grid.spatial_order import get_grid_blocks
 from dqc.hamilton.intor.molintor import _gather_at_dims
+from dqc.utils.config import config
 
 __all__ = ["evl", "eval_gto", "eval_gradgto", "eval_laplgto",
-           "pbc_evl", "pbc_eval_gto", "pbc_eval_gradgto", "pbc_eval_laplgto"]
+           "pbc_evl", "pbc_eval_gto", "pbc_eval_gradgto", "pbc_eval_laplgto",
+           "get_gto_non0tab"]
 
 BLKSIZE = 128  # same as lib/gto/grid_ao_drv.c
 
 # evaluation of the gaussian basis
 def evl(shortname: str, wrapper: LibcintWrapper, rgrid: torch.Tensor,
-        *, to_transpose: bool = False) -> torch.Tensor:
+        *, to_transpose: bool = False, non0tab: Optional[np.ndarray] = None) -> torch.Tensor:
+    # non0tab: the significance mask of the shells in every grid block with
+    # shape (nblocks, nshells_tot), calculated from the basis if not given
     # expand ao_to_atom to have shape of (nao, ndim)
     ao_to_atom = wrapper.ao_to_atom().unsqueeze(-1).expand(-1, NDIM)
 
@@ -26,7 +31,7 @@ def evl(shortname: str, wrapper: LibcintWrapper, rgrid: torch.Tensor,
         *wrapper.params, rgrid,
 
         # nontensors or int tensors
-        ao_to_atom, wrapper, shortname, to_transpose)
+        ao_to_atom, wrapper, shortname, to_transpose, non0tab)
 
 def pbc_evl(shortname: str, wrapper: LibcintWrapper, rgrid: torch.Tensor,
             kpts: Optional[torch.Tensor] = None,
@@ -57,20 +62,23 @@ def pbc_evl(shortname: str, wrapper: LibcintWrapper, rgrid: torch.Tensor,
     return out
 
 # shortcuts
-def eval_gto(wrapper: LibcintWrapper, rgrid: torch.Tensor, *, to_transpose: bool = False) -> torch.Tensor:
+def eval_gto(wrapper: LibcintWrapper, rgrid: torch.Tensor, *, to_transpose: bool = False,
+             non0tab: Optional[np.ndarray] = None) -> torch.Tensor:
     # rgrid: (ngrid, ndim)
     # return: (nao, ngrid)
-    return evl("", wrapper, rgrid, to_transpose=to_transpose)
+    return evl("", wrapper, rgrid, to_transpose=to_transpose, non0tab=non0tab)
 
-def eval_gradgto(wrapper: LibcintWrapper, rgrid: torch.Tensor, *, to_transpose: bool = False) -> torch.Tensor:
+def eval_gradgto(wrapper: LibcintWrapper, rgrid: torch.Tensor, *, to_transpose: bool = False,
+                 non0tab: Optional[np.ndarray] = None) -> torch.Tensor:
     # rgrid: (ngrid, ndim)
     # return: (ndim, nao, ngrid)
-    return evl("ip", wrapper, rgrid, to_transpose=to_transpose)
+    return evl("ip", wrapper, rgrid, to_transpose=to_transpose, non0tab=non0tab)
 
-def eval_laplgto(wrapper: LibcintWrapper, rgrid: torch.Tensor, *, to_transpose: bool = False) -> torch.Tensor:
+def eval_laplgto(wrapper: LibcintWrapper, rgrid: torch.Tensor, *, to_transpose: bool = False,
+                 non0tab: Optional[np.ndarray] = None) -> torch.Tensor:
     # rgrid: (ngrid, ndim)
     # return: (nao, ngrid)
-    return evl("lapl", wrapper, rgrid, to_transpose=to_transpose)
+    return evl("lapl", wrapper, rgrid, to_transpose=to_transpose, non0tab=non0tab)
 
 def pbc_eval_gto(wrapper: LibcintWrapper, rgrid: torch.Tensor,
                  kpts: Optional[torch.Tensor] = None,
@@ -114,9 +122,10 @@ class _EvalGTO(torch.autograd.Function):
                 ao_to_atom: torch.Tensor,  # int tensor (nao, ndim)
                 wrapper: LibcintWrapper,
                 shortname: str,
-                to_transpose: bool) -> torch.Tensor:
+                to_transpose: bool,
+                non0tab: Optional[np.ndarray]) -> torch.Tensor:
 
-        res = gto_evaluator(wrapper, shortname, rgrid, to_transpose)  # (*, nao, ngrid)
+        res = gto_evaluator(wrapper, shortname, rgrid, to_transpose, non0tab)  # (*, nao, ngrid)
         ctx.save_for_backward(coeffs, alphas, pos, rgrid)
         ctx.other_info = (ao_to_atom, wrapper, shortname, to_transpose)
         return res
@@ -148,7 +157,7 @@ class _EvalGTO(torch.autograd.Function):
                 # get the uncontracted version of the integral
                 # (..., nu_ao, ngrid)
                 dout_dcoeff = _EvalGTO.apply(*u_wrapper.params,
-                                             rgrid, ao_to_atom, u_wrapper, shortname, False)
+                                             rgrid, ao_to_atom, u_wrapper, shortname, False, None)
 
                 # get the coefficients and spread it on the u_ao-length tensor
                 coeffs_ao = torch.gather(coeffs, dim=-1, index=ao2shl)  # (nu_ao)
@@ -163,7 +172,7 @@ class _EvalGTO(torch.autograd.Function):
                 new_sname = _get_evalgto_derivname(shortname, "a")
                 # (..., nu_ao, ngrid)
                 dout_dalpha = _EvalGTO.apply(*u_wrapper.params, rgrid,
-                                             ao_to_atom, u_wrapper, new_sname, False)
+                                             ao_to_atom, u_wrapper, new_sname, False, None)
 
                 alphas_ao = torch.gather(alphas, dim=-1, index=ao2shl)  # (nu_ao)
                 grad_dalpha = -torch.einsum("...ur,...ur->u", u_grad_res, dout_dalpha)
@@ -176,7 +185,7 @@ class _EvalGTO(torch.autograd.Function):
         if rgrid.requires_grad or pos.requires_grad:
             opsname = _get_evalgto_derivname(shortname, "r")
             dresdr = _EvalGTO.apply(*ctx.saved_tensors,
-                                    ao_to_atom, wrapper, opsname, False)  # (ndim, *, nao, ngrid)
+                                    ao_to_atom, wrapper, opsname, False, None)  # (ndim, *, nao, ngrid)
             grad_r = dresdr * grad_res  # (ndim, *, nao, ngrid)
 
             if rgrid.requires_grad:
@@ -190,11 +199,11 @@ class _EvalGTO(torch.autograd.Function):
                 grad_pos.scatter_add_(dim=0, index=ao_to_atom, src=grad_rao)
 
         return grad_coeffs, grad_alphas, grad_pos, grad_rgrid, \
-            None, None, None, None, None, None
+            None, None, None, None, None
 
 ################### evaluator (direct interfact to libcgto) ###################
 def gto_evaluator(wrapper: LibcintWrapper, shortname: str, rgrid: torch.Tensor,
-                  to_transpose: bool):
+                  to_transpose: bool, non0tab: Optional[np.ndarray] = None):
     # NOTE: this function do not propagate gradient and should only be used
     # in this file only
 
@@ -202,14 +211,14 @@ def gto_evaluator(wrapper: LibcintWrapper, shortname: str, rgrid: torch.Tensor,
     # returns: (*, nao, ngrid) if not to_transpose else (*, ngrid, nao)
 
     ngrid = rgrid.shape[0]
-    nshells = len(wrapper)
     nao = wrapper.nao()
     opname = _get_evalgto_opname(shortname, wrapper.spherical)
     outshape = _get_evalgto_compshape(shortname) + (nao, ngrid)
 
     out = np.empty(outshape, dtype=np.float64)
-    non0tab = np.ones(((ngrid + BLKSIZE - 1) // BLKSIZE, nshells),
-                      dtype=np.int8)
+    if non0tab is None:
+        non0tab = get_gto_non0tab(wrapper, rgrid, shortname)
+    non0tab = np.ascontiguousarray(non0tab, dtype=np.int8)
 
     # TODO: check if we need to transpose it first?
     rgrid = rgrid.contiguous()
@@ -238,6 +247,65 @@ def gto_evaluator(wrapper: LibcintWrapper, shortname: str, rgrid: torch.Tensor,
     out_tensor = torch.as_tensor(out, dtype=wrapper.dtype, device=wrapper.device)
     return out_tensor
 
+def get_gto_non0tab(wrapper: LibcintWrapper, rgrid: torch.Tensor, shortname: str = "",
+                    bounds: Optional[torch.Tensor] = None) -> np.ndarray:
+    # get the significance mask of the shells in every block of BLKSIZE grid
+    # points, i.e. the shell is significant in the block if its radial part,
+    # max_g |c_g| * r^l * exp(-a_g * r^2), is above config.AO_SCREEN_THRESHOLD
+    # at the closest point of the block's bounding box to the shell centre.
+    # The column index is the absolute shell index as required by libcgto.
+    # rgrid: (ngrid, ndim)
+    # bounds: (nblocks, 2, ndim) the bounding boxes of the blocks from
+    #     BaseGrid.get_blocks(BLKSIZE), computed from rgrid if not given
+    # returns: int8 (nblocks, nshells_tot)
+    ngrid = rgrid.shape[0]
+    nblocks = (ngrid + BLKSIZE - 1) // BLKSIZE
+    atm, bas, env = wrapper.atm_bas_env
+    non0tab = np.zeros((nblocks, bas.shape[0]), dtype=np.int8)
+    sh0, sh1 = wrapper.shell_idxs
+    thresh = config.AO_SCREEN_THRESHOLD
+    if thresh <= 0 or ngrid == 0:
+        non0tab[:, sh0:sh1] = 1
+        return non0tab
+
+    # the derivatives bring additional factors of (2 * a * r)
+    nderiv = shortname.count("ip") + 2 * shortname.count("rr") + 2 * shortname.count("lapl")
+    rcut2 = np.array([_get_shell_rcut2(bas[sh], env, thresh, nderiv) for sh in range(sh0, sh1)])
+
+    # the bounding boxes of the grid blocks
+    if bounds is None:
+        bounds, _ = get_grid_blocks(rgrid, BLKSIZE)
+    assert bounds.shape[0] == nblocks
+    bounds_np = np.asarray(bounds.detach().cpu(), dtype=np.float64)
+    bmin = bounds_np[:, 0]  # (nblocks, ndim)
+    bmax = bounds_np[:, 1]
+
+    # squared distance from the atoms to the bounding boxes
+    atm_coords = env[atm[:, 1][:, None] + np.arange(NDIM)]  # (natoms, ndim)
+    dist = np.maximum(bmin[:, None, :] - atm_coords, 0) + \
+        np.maximum(atm_coords - bmax[:, None, :], 0)  # (nblocks, natoms, ndim)
+    dist2 = np.sum(dist * dist, axis=-1)  # (nblocks, natoms)
+
+    non0tab[:, sh0:sh1] = dist2[:, bas[sh0:sh1, 0]] <= rcut2
+    return non0tab
+
+def _get_shell_rcut2(bas_row: np.ndarray, env: np.ndarray, thresh: float, nderiv: int) -> float:
+    # estimate the squared radius where the radial part of the shell falls
+    # below the threshold, the radius is taken as the maximum over all
+    # primitives and contractions in the shell
+    angmom, nprim, nctr, ptr_exp, ptr_coeff = bas_row[1:6]
+    alphas = env[ptr_exp:ptr_exp + nprim]
+    coeffs = np.max(np.abs(env[ptr_coeff:ptr_coeff + nprim * nctr].reshape(nctr, nprim)), axis=0)
+    coeffs = coeffs * np.maximum(2 * alphas, 1.0) ** nderiv
+    lpow = angmom + nderiv
+
+    # solve |c| * r^l * exp(-a * r^2) = thresh with a few fixed point iterations
+    logc = np.log(np.maximum(coeffs, 1e-300)) - np.log(thresh)
+    r2 = np.maximum(logc, 0) / alphas
+    for _ in range(3):
+        r2 = np.maximum(logc + 0.5 * lpow * np.log(np.maximum(r2, 1.0)), 0) / alphas
+    return float(np.max(r2))
+
 def _get_evalgto_opname(shortname: str, spherical: bool) -> str:
     # returns the complete name of the evalgto operation
     sname = ("_" + shortname) if (shortname != "") else ""
@@ -2,6 +2,7 @@ from __future__ import annotations
 from contextlib import contextmanager
 from typing import List, Tuple, Iterator, Optional, Dict
 import copy
+import ctypes
 import torch
 import numpy as np
 from dqc.utils.datastruct import AtomCGTOBasis, CGTOBasis
@@ -17,6 +18,11 @@ __all__ = ["LibcintWrapper", "SubsetLibcintWrapper"]
 #          counted as different shells)
 # * ao: shell that has been splitted into its components,
 #       e.g. p-shell is splitted into 3 components for cartesian (x, y, z)
+# * ctr: one contracted function in a shell. Consecutive CGTOBasis of an atom
+#        with the same angmom and the same alphas tensor are put into one shell
+#        with multiple contractions (general contraction), so libcint only
+#        calculates the shared primitive integrals once.
+#        The aos of a shell are ordered contraction-by-contraction.
 
 PTR_RINV_ORIG = 4  # from libcint/src/cint_const.h
 
@@ -44,11 +50,14 @@ class LibcintWrapper(object):
         allangmoms: List[int] = []
         shell_to_atom: List[int] = []
         ngauss_at_shell: List[int] = []
+        nctr_at_shell: List[int] = []
         gauss_to_shell: List[int] = []
+        gauss_to_ctr: List[int] = []
 
         # constructing the triplet lists and also collecting the parameters
         nshells = 0
         ishell = 0
+        ictr = 0
         for iatom, atombasis in enumerate(atombases):
             # construct the atom environment
             assert atombasis.pos.numel() == NDIM, "Please report this bug in Github"
@@ -68,29 +77,39 @@ class LibcintWrapper(object):
             # TODO: consider moving allpos into shell
             allpos.append(atombasis.pos.unsqueeze(0))
 
-            nshells += len(atombasis.bases)
-            shell_to_atom.extend([iatom] * len(atombasis.bases))
-
-            # then construct the basis
-            for shell in atombasis.bases:
-                assert shell.alphas.shape == shell.coeffs.shape and shell.alphas.ndim == 1,\
-                    "Please report this bug in Github"
-                shell.wfnormalize_()
-                ngauss = len(shell.alphas)
-                #                iatom, angmom,       ngauss, ncontr, kappa, ptr_exp
-                bas_list.append([iatom, shell.angmom, ngauss, 1, 0, ptr_env,
+            # then construct the basis, where the bases sharing the gaussian
+            # exponents are grouped into one shell
+            for shells in _group_general_contraction(atombasis.bases):
+                angmom = shells[0].angmom
+                ngauss = len(shells[0].alphas)
+                nctr = len(shells)
+                #                iatom, angmom, ngauss, ncontr, kappa, ptr_exp
+                bas_list.append([iatom, angmom, ngauss, nctr, 0, ptr_env,
                                  # ptr_coeffs,           unused
                                  ptr_env + ngauss, 0])
-                env_list.extend(shell.alphas.detach())
-                env_list.extend(shell.coeffs.detach())
-                ptr_env += 2 * ngauss
-
-                # add the alphas and coeffs to the parameters list
-                allalphas.append(shell.alphas)
-                allcoeffs.append(shell.coeffs)
-                allangmoms.extend([shell.angmom] * ngauss)
-                ngauss_at_shell.append(ngauss)
-                gauss_to_shell.extend([ishell] * ngauss)
+                env_list.extend(shells[0].alphas.detach())
+                ptr_env += ngauss
+                for shell in shells:
+                    assert shell.alphas.shape == shell.coeffs.shape and shell.alphas.ndim == 1,\
+                        "Please report this bug in Github"
+                    shell.wfnormalize_()
+                    env_list.extend(shell.coeffs.detach())
+                    ptr_env += ngauss
+
+                    # add the alphas and coeffs to the parameters list
+                    # (the shared alphas are repeated for every contraction so
+                    # the parameters are still indexed per gaussian of each
+                    # contraction)
+                    allalphas.append(shell.alphas)
+                    allcoeffs.append(shell.coeffs)
+                    allangmoms.extend([angmom] * ngauss)
+                    gauss_to_shell.extend([ishell] * ngauss)
+                    gauss_to_ctr.extend([ictr] * ngauss)
+                    ictr += 1
+                ngauss_at_shell.append(ngauss * nctr)
+                nctr_at_shell.append(nctr)
+                shell_to_atom.append(iatom)
+                nshells += 1
                 ishell += 1
 
         # compile the parameters of this object
@@ -99,6 +118,7 @@ class LibcintWrapper(object):
         self._allcoeffs_params = torch.cat(allcoeffs, dim=0)  # (ntot_gauss)
         self._allangmoms = torch.tensor(allangmoms, dtype=torch.int32, device=self.device)  # (ntot_gauss)
         self._gauss_to_shell = torch.tensor(gauss_to_shell, dtype=torch.int32, device=self.device)
+        self._gauss_to_ctr = torch.tensor(gauss_to_ctr, dtype=torch.int32, device=self.device)
 
         # convert the lists to numpy to make it contiguous (Python lists are not contiguous)
         self._atm = np.array(atm_list, dtype=np.int32, order="C")
@@ -109,18 +129,26 @@ class LibcintWrapper(object):
         shell_to_aoloc = [0]
         ao_to_shell: List[int] = []
         ao_to_atom: List[int] = []
+        ao_to_ctr: List[int] = []
+        ictr = 0
         for i in range(nshells):
             nao_at_shell_i = self._nao_at_shell(i)
             shell_to_aoloc_i = shell_to_aoloc[-1] + nao_at_shell_i
             shell_to_aoloc.append(shell_to_aoloc_i)
             ao_to_shell.extend([i] * nao_at_shell_i)
             ao_to_atom.extend([shell_to_atom[i]] * nao_at_shell_i)
+            nao_at_ctr = nao_at_shell_i // nctr_at_shell[i]
+            for _ in range(nctr_at_shell[i]):
+                ao_to_ctr.extend([ictr] * nao_at_ctr)
+                ictr += 1
 
         self._ngauss_at_shell_list = ngauss_at_shell
+        self._nctr_at_shell_list = nctr_at_shell
         self._shell_to_aoloc = np.array(shell_to_aoloc, dtype=np.int32)
         self._shell_idxs = (0, nshells)
         self._ao_to_shell = torch.tensor(ao_to_shell, dtype=torch.long, device=self.device)
         self._ao_to_atom = torch.tensor(ao_to_atom, dtype=torch.long, device=self.device)
+        self._ao_to_ctr = torch.tensor(ao_to_ctr, dtype=torch.long, device=self.device)
 
     @property
     def parent(self) -> LibcintWrapper:
@@ -188,6 +216,18 @@ class LibcintWrapper(object):
         # if this object is a subset, then returns the complete mapping
         return self._gauss_to_shell
 
+    @property
+    def full_gauss_to_ctr(self) -> torch.Tensor:
+        # returns the full index mapping from gaussian to contraction tensor
+        # if this object is a subset, then returns the complete mapping
+        return self._gauss_to_ctr
+
+    @property
+    def full_ao_to_ctr(self) -> torch.Tensor:
+        # returns the full array mapping from atomic orbital index to the
+        # contraction index
+        return self._ao_to_ctr
+
     @property
     def full_ao_to_atom(self) -> torch.Tensor:
         # returns the full array mapping from atomic orbital index to the
@@ -202,9 +242,15 @@ class LibcintWrapper(object):
 
     @property
     def ngauss_at_shell(self) -> List[int]:
-        # returns the number of gaussian basis at the given shell
+        # returns the number of gaussian basis at the given shell (counted for
+        # every contraction in the shell)
         return self._ngauss_at_shell_list
 
+    @property
+    def nctr_at_shell(self) -> List[int]:
+        # returns the number of contractions at the given shell
+        return self._nctr_at_shell_list
+
     @memoize_method
     def __len__(self) -> int:
         # total shells
@@ -285,15 +331,112 @@ class LibcintWrapper(object):
             new_atombases, spherical=self.spherical)
 
         # get the mapping uncontracted ao to the contracted ao
+        uao2ao_res = self._get_uao2ao()
+        return uncontr_wrapper, uao2ao_res
+
+    def _get_uao2ao(self) -> torch.Tensor:
+        # get the mapping from the uncontracted atomic orbital (relative index)
+        # to the relative index of the atomic orbital of this object
+        # the uncontracted shells are ordered by the contraction, then by the gaussian
         uao2ao: List[int] = []
         idx_ao = 0
         # iterate over shells
-        for i in range(len(self)):
-            nao = self._nao_at_shell(i)
-            uao2ao += list(range(idx_ao, idx_ao + nao)) * self.ngauss_at_shell[i]
-            idx_ao += nao
-        uao2ao_res = torch.tensor(uao2ao, dtype=torch.long, device=self.device)
-        return uncontr_wrapper, uao2ao_res
+        for i in range(*self.shell_idxs):
+            nctr = self.nctr_at_shell[i]
+            nao = self._nao_at_shell(i) // nctr
+            ngauss = self.ngauss_at_shell[i] // nctr
+            for _ in range(nctr):
+                uao2ao += list(range(idx_ao, idx_ao + nao)) * ngauss
+                idx_ao += nao
+        return torch.tensor(uao2ao, dtype=torch.long, device=self.device)
+
+    @memoize_method
+    def full_schwarz_bounds(self) -> np.ndarray:
+        # returns the Schwarz bounds of all shell pairs in the environment,
+        # i.e. Q[i, j] = sqrt(max |(ij|ij)|) where the max is taken over the
+        # atomic orbitals in the shells i and j, so |(ij|kl)| <= Q[i, j] * Q[k, l]
+        # the bounds are computed once for the parent and shared with the subsets
+        # returns: (nshells_tot, nshells_tot)
+        parent = self.parent
+        if parent is not self:
+            return parent.full_schwarz_bounds()
+
+        opname = "int2e_sph" if self.spherical else "int2e_cart"
+        op = getattr(CINT(), opname)
+        atm, bas, env = self.atm_bas_env
+        shell_to_aoloc = self.full_shell_to_aoloc
+        nshells = len(shell_to_aoloc) - 1
+        nao_max = int(np.max(np.diff(shell_to_aoloc)))
+        buf = np.empty(nao_max ** 4, dtype=np.float64)
+        shls = np.zeros(4, dtype=np.int32)
+        null = ctypes.POINTER(ctypes.c_void_p)()
+
+        bounds = np.zeros((nshells, nshells), dtype=np.float64)
+        for i in range(nshells):
+            di = shell_to_aoloc[i + 1] - shell_to_aoloc[i]
+            for j in range(i + 1):
+                dj = shell_to_aoloc[j + 1] - shell_to_aoloc[j]
+                shls[:] = (i, j, i, j)
+                op(np2ctypes(buf), null, np2ctypes(shls),
+                   np2ctypes(atm), int2ctypes(atm.shape[0]),
+                   np2ctypes(bas), int2ctypes(bas.shape[0]),
+                   np2ctypes(env), null, null)
+                # libcint stores the output in fortran order, but we only
+                # need the diagonal (ij|ij) elements
+                nij = di * dj
+                diag = buf[:nij * nij].reshape(nij, nij).diagonal()
+                bounds[i, j] = np.sqrt(np.max(np.abs(diag)))
+                bounds[j, i] = bounds[i, j]
+        return bounds
+
+    @memoize_method
+    def full_schwarz_deriv_bounds(self) -> np.ndarray:
+        # returns the Schwarz bounds of all shell pairs in the environment with
+        # the nabla on the first shell, i.e. Qd[i, j] = sqrt(max |(d_x i j|d_x i j)|)
+        # where the max is taken over the atomic orbitals in the shells i and j
+        # and the directions x, so |(d_x i j|kl)| <= Qd[i, j] * Q[k, l]
+        # the bounds are computed once for the parent and shared with the subsets
+        # returns: (nshells_tot, nshells_tot), not symmetric
+        parent = self.parent
+        if parent is not self:
+            return parent.full_schwarz_deriv_bounds()
+
+        # the (d_x i j|d_y k l) integrals
+        cartsph = "sph" if self.spherical else "cart"
+        op = getattr(CINT(), "int2e_ipar12ipb_%s" % cartsph)
+        atm, bas, env = self.atm_bas_env
+        shell_to_aoloc = self.full_shell_to_aoloc
+        nshells = len(shell_to_aoloc) - 1
+        nao_max = int(np.max(np.diff(shell_to_aoloc)))
+        ncomp = NDIM * NDIM
+        buf = np.empty(ncomp * nao_max ** 4, dtype=np.float64)
+        shls = np.zeros(4, dtype=np.int32)
+        null = ctypes.POINTER(ctypes.c_void_p)()
+
+        bounds = np.zeros((nshells, nshells), dtype=np.float64)
+        for i in range(nshells):
+            di = shell_to_aoloc[i + 1] - shell_to_aoloc[i]
+            for j in range(nshells):
+                dj = shell_to_aoloc[j + 1] - shell_to_aoloc[j]
+                shls[:] = (i, j, i, j)
+                op(np2ctypes(buf), null, np2ctypes(shls),
+                   np2ctypes(atm), int2ctypes(atm.shape[0]),
+                   np2ctypes(bas), int2ctypes(bas.shape[0]),
+                   np2ctypes(env), null, null)
+                # only the diagonal (ij|ij) elements of the xx, yy, and zz
+                # components are needed
+                nij = di * dj
+                diag = buf[:ncomp * nij * nij].reshape(ncomp, nij, nij)[::NDIM + 1]
+                diag = np.diagonal(diag, axis1=-2, axis2=-1)
+                bounds[i, j] = np.sqrt(np.max(np.abs(diag)))
+        return bounds
+
+    @memoize_method
+    def shell_to_atom(self) -> np.ndarray:
+        # get the relative mapping from the shells of this object to the
+        # absolute atom index
+        bas = self.atm_bas_env[1]
+        return bas[slice(*self.shell_idxs), 0]
 
     @staticmethod
     def concatenate(*wrappers: LibcintWrapper) \
@@ -417,13 +560,7 @@ class SubsetLibcintWrapper(LibcintWrapper):
 
         # construct the uao (relative index) mapping to the absolute index
         # of the atomic orbital in the contracted basis
-        uao2ao = []
-        idx_ao = 0
-        for i in range(shell_idxs[0], shell_idxs[1]):
-            nao = self._parent._nao_at_shell(i)
-            uao2ao += list(range(idx_ao, idx_ao + nao)) * self._parent.ngauss_at_shell[i]
-            idx_ao += nao
-        uao2ao_res = torch.tensor(uao2ao, dtype=torch.long, device=self.device)
+        uao2ao_res = self._get_uao2ao()
         return u_wrapper, uao2ao_res
 
     def __getitem__(self, inp):
@@ -431,3 +568,16 @@ class SubsetLibcintWrapper(LibcintWrapper):
 
     def __getattr__(self, name):
         return getattr(self._parent, name)
+
+def _group_general_contraction(bases: List[CGTOBasis]) -> List[List[CGTOBasis]]:
+    # group the consecutive bases with the same angular momentum and the same
+    # alphas tensor (e.g. the general contractions from ``loadbasis``) to be
+    # put in one shell
+    res: List[List[CGTOBasis]] = []
+    for basis in bases:
+        if len(res) > 0 and res[-1][0].angmom == basis.angmom and \
+                res[-1][0].alphas is basis.alphas:
+            res[-1].append(basis)
+        else:
+            res.append([basis])
+    return res
@@ -8,10 +8,18 @@ import torch
 from dqc.hamilton.intor.lcintwrap import LibcintWrapper
 from dqc.hamilton.intor.utils import np2ctypes, int2ctypes, NDIM, CINT, CGTO
 from dqc.hamilton.intor.namemgr import IntorNameManager
+from dqc.hamilton.intor.symmetry import BaseSymmetry, S4Symmetry, S8Symmetry
+from dqc.hamilton.intor.packed import get_pair_index, get_nao_from_s8, unpack_s8
+from dqc.utils.config import config
 
 __all__ = ["int1e", "int3c2e", "int2e",
            "overlap", "kinetic", "nuclattr", "elrep", "coul2c", "coul3c"]
 
+# the basis permutations of the 8-fold symmetry of the electron repulsion
+# integrals, (ij|kl) = (ji|kl) = (ij|lk) = (kl|ij) = ...
+_ERI_PERMS = [(0, 1, 2, 3), (1, 0, 2, 3), (0, 1, 3, 2), (1, 0, 3, 2),
+              (2, 3, 0, 1), (3, 2, 0, 1), (2, 3, 1, 0), (3, 2, 1, 0)]
+
 # integrals
 def int1e(shortname: str, wrapper: LibcintWrapper, other: Optional[LibcintWrapper] = None, *,
           # additional options for some specific integrals
@@ -74,12 +82,16 @@ def int3c2e(shortname: str, wrapper: LibcintWrapper,
 def int2e(shortname: str, wrapper: LibcintWrapper,
           other1: Optional[LibcintWrapper] = None,
           other2: Optional[LibcintWrapper] = None,
-          other3: Optional[LibcintWrapper] = None) -> torch.Tensor:
+          other3: Optional[LibcintWrapper] = None, *,
+          packed: bool = False) -> torch.Tensor:
     """
     4-centre 2-electron integrals where the `wrapper` and `other1` correspond
     to the first electron, and `other2` and `other3` correspond to another
     electron.
     The returned indices are sorted based on `wrapper`, `other1`, `other2`, and `other3`.
+    If `packed` is True, the integral must have 8-fold symmetry and it returns
+    the packed elements with shape (npair * (npair + 1) // 2,) where
+    npair = nao * (nao + 1) // 2 (see `dqc.hamilton.intor.packed`).
     The available shortname: "ar12b"
     """
 
@@ -90,7 +102,8 @@ def int2e(shortname: str, wrapper: LibcintWrapper,
     return _Int4cFunction.apply(
         *wrapper.params,
         [wrapper, other1w, other2w, other3w],
-        IntorNameManager("int2e", shortname))
+        IntorNameManager("int2e", shortname),
+        packed)
 
 # shortcuts
 def overlap(wrapper: LibcintWrapper, other: Optional[LibcintWrapper] = None) -> torch.Tensor:
@@ -114,9 +127,9 @@ def nuclattr(wrapper: LibcintWrapper, other: Optional[LibcintWrapper] = None) ->
 def elrep(wrapper: LibcintWrapper,
           other1: Optional[LibcintWrapper] = None,
           other2: Optional[LibcintWrapper] = None,
-          other3: Optional[LibcintWrapper] = None,
-          ) -> torch.Tensor:
-    return int2e("ar12b", wrapper, other1, other2, other3)
+          other3: Optional[LibcintWrapper] = None, *,
+          packed: bool = False) -> torch.Tensor:
+    return int2e("ar12b", wrapper, other1, other2, other3, packed=packed)
 
 def coul2c(wrapper: LibcintWrapper,
            other: Optional[LibcintWrapper] = None,
@@ -252,72 +265,12 @@ class _Int2cFunction(torch.autograd.Function):
             grad_datpos = grad_out * (dout_datposs[0] + dout_datposs[1])
             grad_rinv_pos = grad_datpos.reshape(grad_datpos.shape[0], -1).sum(dim=-1)
 
-        # gradient for the basis coefficients
-        grad_allcoeffs: Optional[torch.Tensor] = None
-        grad_allalphas: Optional[torch.Tensor] = None
-        if allcoeffs.requires_grad or allalphas.requires_grad:
-            # obtain the uncontracted wrapper and mapping
-            # uao2aos: list of (nu_ao0,), (nu_ao1,)
-            u_wrappers_tup, uao2aos_tup = zip(*[w.get_uncontracted_wrapper() for w in wrappers])
-            u_wrappers = list(u_wrappers_tup)
-            uao2aos = list(uao2aos_tup)
-            u_params = u_wrappers[0].params
-
-            # get the uncontracted (gathered) grad_out
-            u_grad_out = _gather_at_dims(grad_out, mapidxs=uao2aos, dims=[-2, -1])
-
-            # get the scatter indices
-            ao2shl0 = u_wrappers[0].ao_to_shell()
-            ao2shl1 = u_wrappers[1].ao_to_shell()
-
-            # calculate the gradient w.r.t. coeffs
-            if allcoeffs.requires_grad:
-                grad_allcoeffs = torch.zeros_like(allcoeffs)  # (ngauss)
-
-                # get the uncontracted version of the integral
-                dout_dcoeff = _Int2cFunction.apply(
-                    *u_params, rinv_pos, u_wrappers, int_nmgr)  # (..., nu_ao0, nu_ao1)
-
-                # get the coefficients and spread it on the u_ao-length tensor
-                coeffs_ao0 = torch.gather(allcoeffs, dim=-1, index=ao2shl0)  # (nu_ao0)
-                coeffs_ao1 = torch.gather(allcoeffs, dim=-1, index=ao2shl1)  # (nu_ao1)
-                # divide done here instead of after scatter to make the 2nd gradient
-                # calculation correct.
-                # division can also be done after scatter for more efficient 1st grad
-                # calculation, but it gives the wrong result for 2nd grad
-                dout_dcoeff_i = dout_dcoeff / coeffs_ao0[:, None]
-                dout_dcoeff_j = dout_dcoeff / coeffs_ao1
-
-                # (nu_ao)
-                grad_dcoeff_i = torch.einsum("...ij,...ij->i", u_grad_out, dout_dcoeff_i)
-                grad_dcoeff_j = torch.einsum("...ij,...ij->j", u_grad_out, dout_dcoeff_j)
-                # grad_dcoeff = grad_dcoeff_i + grad_dcoeff_j
-
-                # scatter the grad
-                grad_allcoeffs.scatter_add_(dim=-1, index=ao2shl0, src=grad_dcoeff_i)
-                grad_allcoeffs.scatter_add_(dim=-1, index=ao2shl1, src=grad_dcoeff_j)
-
-            # calculate the gradient w.r.t. alphas
-            if allalphas.requires_grad:
-                grad_allalphas = torch.zeros_like(allalphas)  # (ngauss)
-
-                u_int_fcn = lambda u_wrappers, int_nmgr: _Int2cFunction.apply(
-                    *u_params, rinv_pos, u_wrappers, int_nmgr)
-
-                # get the uncontracted integrals
-                sname_derivs = [int_nmgr.get_intgl_deriv_namemgr("rr", ib) for ib in (0, 1)]
-                new_axes_pos = [int_nmgr.get_intgl_deriv_newaxispos("rr", ib) for ib in (0, 1)]
-                dout_dalphas = _get_integrals(sname_derivs, u_wrappers, u_int_fcn, new_axes_pos)
-
-                # (nu_ao)
-                # negative because the exponent is negative alpha * (r-ra)^2
-                grad_dalpha_i = -torch.einsum("...ij,...ij->i", u_grad_out, dout_dalphas[0])
-                grad_dalpha_j = -torch.einsum("...ij,...ij->j", u_grad_out, dout_dalphas[1])
-                # grad_dalpha = (grad_dalpha_i + grad_dalpha_j)  # (nu_ao)
-
-                # scatter the grad
-                grad_allalphas.scatter_add_(dim=-1, index=ao2shl0, src=grad_dalpha_i)
-                grad_allalphas.scatter_add_(dim=-1, index=ao2shl1, src=grad_dalpha_j)
+        # gradient for the basis coefficients and exponents
+        u_int_fcn = lambda u_params, u_wrappers, int_nmgr: _Int2cFunction.apply(
+            *u_params, rinv_pos, u_wrappers, int_nmgr)
+        grad_allcoeffs, grad_allalphas = _get_basis_params_grad(
+            _fold_grad_out(grad_out, wrappers, int_nmgr), allcoeffs, allalphas, wrappers,
+            int_nmgr, u_int_fcn)
 
         return grad_allcoeffs, grad_allalphas, grad_allposs, \
             grad_rinv_pos, \
@@ -373,74 +326,12 @@ class _Int3cFunction(torch.autograd.Function):
             grad_allpossT.scatter_add_(dim=-1, index=ao_to_atom1, src=grad_pos_a2)
             grad_allpossT.scatter_add_(dim=-1, index=ao_to_atom2, src=grad_pos_b1)
 
-        # gradients for the basis coefficients
-        grad_allcoeffs: Optional[torch.Tensor] = None
-        grad_allalphas: Optional[torch.Tensor] = None
-        if allcoeffs.requires_grad or allalphas.requires_grad:
-            # obtain the uncontracted wrapper, and expanded grad_out
-            # uao2ao: (nu_ao)
-            u_wrappers_tup, uao2aos_tup = zip(*[w.get_uncontracted_wrapper() for w in wrappers])
-            u_wrappers = list(u_wrappers_tup)
-            uao2aos = list(uao2aos_tup)
-            u_params = u_wrappers[0].params
-
-            # u_grad_out: (..., nu_ao0, nu_ao1, nu_ao2)
-            u_grad_out = _gather_at_dims(grad_out, mapidxs=uao2aos, dims=[-3, -2, -1])
-
-            # get the scatter indices
-            ao2shl0 = u_wrappers[0].ao_to_shell()  # (nu_ao0,)
-            ao2shl1 = u_wrappers[1].ao_to_shell()
-            ao2shl2 = u_wrappers[2].ao_to_shell()
-
-            # calculate the grad w.r.t. coeffs
-            if allcoeffs.requires_grad:
-                grad_allcoeffs = torch.zeros_like(allcoeffs)
-
-                # (..., nu_ao0, nu_ao1, nu_ao2)
-                dout_dcoeff = _Int3cFunction.apply(*u_params, u_wrappers, int_nmgr)
-
-                # get the coefficients and spread it on the u_ao-length tensor
-                coeffs_ao0 = torch.gather(allcoeffs, dim=-1, index=ao2shl0)  # (nu_ao0)
-                coeffs_ao1 = torch.gather(allcoeffs, dim=-1, index=ao2shl1)  # (nu_ao1)
-                coeffs_ao2 = torch.gather(allcoeffs, dim=-1, index=ao2shl2)  # (nu_ao2)
-                # dout_dcoeff_*: (..., nu_ao0, nu_ao1, nu_ao2, nu_ao3)
-                dout_dcoeff_a1 = dout_dcoeff / coeffs_ao0[:, None, None]
-                dout_dcoeff_a2 = dout_dcoeff / coeffs_ao1[:, None]
-                dout_dcoeff_b1 = dout_dcoeff / coeffs_ao2
-
-                # reduce the uncontracted integrations
-                # grad_coeff_*: (nu_ao*)
-                grad_coeff_a1 = torch.einsum("...ijk,...ijk->i", dout_dcoeff_a1, u_grad_out)
-                grad_coeff_a2 = torch.einsum("...ijk,...ijk->j", dout_dcoeff_a2, u_grad_out)
-                grad_coeff_b1 = torch.einsum("...ijk,...ijk->k", dout_dcoeff_b1, u_grad_out)
-                # grad_coeff_all = grad_coeff_a1 + grad_coeff_a2 + grad_coeff_b1 + grad_coeff_b2
-
-                # scatter to the coefficients
-                grad_allcoeffs.scatter_add_(dim=-1, index=ao2shl0, src=grad_coeff_a1)
-                grad_allcoeffs.scatter_add_(dim=-1, index=ao2shl1, src=grad_coeff_a2)
-                grad_allcoeffs.scatter_add_(dim=-1, index=ao2shl2, src=grad_coeff_b1)
-
-            if allalphas.requires_grad:
-                grad_allalphas = torch.zeros_like(allalphas)  # (ngauss)
-
-                # get the uncontracted integrals
-                sname_derivs = [int_nmgr.get_intgl_deriv_namemgr("rr", ib) for ib in (0, 1, 2)]
-                new_axes_pos = [int_nmgr.get_intgl_deriv_newaxispos("rr", ib) for ib in (0, 1, 2)]
-                u_int_fcn = lambda u_wrappers, int_nmgr: _Int3cFunction.apply(
-                    *u_params, u_wrappers, int_nmgr)
-                dout_dalphas = _get_integrals(sname_derivs, u_wrappers, u_int_fcn, new_axes_pos)
-
-                # (nu_ao)
-                # negative because the exponent is negative alpha * (r-ra)^2
-                grad_alpha_a1 = -torch.einsum("...ijk,...ijk->i", dout_dalphas[0], u_grad_out)
-                grad_alpha_a2 = -torch.einsum("...ijk,...ijk->j", dout_dalphas[1], u_grad_out)
-                grad_alpha_b1 = -torch.einsum("...ijk,...ijk->k", dout_dalphas[2], u_grad_out)
-                # grad_alpha_all = (grad_alpha_a1 + grad_alpha_a2 + grad_alpha_b1 + grad_alpha_b2)
-
-                # scatter the grad
-                grad_allalphas.scatter_add_(dim=-1, index=ao2shl0, src=grad_alpha_a1)
-                grad_allalphas.scatter_add_(dim=-1, index=ao2shl1, src=grad_alpha_a2)
-                grad_allalphas.scatter_add_(dim=-1, index=ao2shl2, src=grad_alpha_b1)
+        # gradients for the basis coefficients and exponents
+        u_int_fcn = lambda u_params, u_wrappers, int_nmgr: _Int3cFunction.apply(
+            *u_params, u_wrappers, int_nmgr)
+        grad_allcoeffs, grad_allalphas = _get_basis_params_grad(
+            _fold_grad_out(grad_out, wrappers, int_nmgr), allcoeffs, allalphas, wrappers,
+            int_nmgr, u_int_fcn)
 
         return grad_allcoeffs, grad_allalphas, grad_allposs, \
             None, None, None
@@ -451,21 +342,35 @@ class _Int4cFunction(torch.autograd.Function):
     def forward(ctx,  # type: ignore
                 allcoeffs: torch.Tensor, allalphas: torch.Tensor, allposs: torch.Tensor,
                 wrappers: List[LibcintWrapper],
-                int_nmgr: IntorNameManager) -> torch.Tensor:
+                int_nmgr: IntorNameManager,
+                packed: bool = False) -> torch.Tensor:
 
         assert len(wrappers) == 4
 
-        out_tensor = Intor(int_nmgr, wrappers).calc()
+        out_tensor = Intor(int_nmgr, wrappers, packed=packed).calc()
         ctx.save_for_backward(allcoeffs, allalphas, allposs)
-        ctx.other_info = (wrappers, int_nmgr)
-        return out_tensor  # (..., nao0, nao1, nao2, nao3)
+        ctx.other_info = (wrappers, int_nmgr, packed)
+        return out_tensor  # (..., nao0, nao1, nao2, nao3) or (npacked,) if packed
 
     @staticmethod
     def backward(ctx, grad_out) -> Tuple[Optional[torch.Tensor], ...]:  # type: ignore
-        # grad_out: (..., nao0, nao1, nao2, nao3)
+        # grad_out: (..., nao0, nao1, nao2, nao3) or (npacked,) if packed
         allcoeffs, allalphas, allposs = ctx.saved_tensors
-        wrappers, int_nmgr = ctx.other_info
-        naos = grad_out.shape[-4:]
+        wrappers, int_nmgr, packed = ctx.other_info
+
+        # the derivatives w.r.t. the centres related by the permutation
+        # symmetry of the integrals are obtained from the same derivative
+        # integrals with the permuted grad_out, e.g. only the derivative
+        # w.r.t. the first centre is calculated for the 8-fold symmetric
+        # electron repulsion integrals
+        if packed:
+            # the unpacked gradient is already invariant under the 8-fold
+            # symmetry, so the folding is only multiplying it by 4
+            grad_outs = {0: _unpack_s8_grad(grad_out, scale=4.0)}
+        else:
+            grad_outs = _fold_grad_out(grad_out, wrappers, int_nmgr)
+        grad_out0 = grad_outs[0]
+        naos = grad_out0.shape[-4:]
 
         # calculate the gradient w.r.t. positions
         grad_allposs: Optional[torch.Tensor] = None
@@ -473,109 +378,206 @@ class _Int4cFunction(torch.autograd.Function):
             grad_allposs = torch.zeros_like(allposs)  # (natom, ndim)
             grad_allpossT = grad_allposs.transpose(-2, -1)  # (ndim, natom)
 
-            sname_derivs = [int_nmgr.get_intgl_deriv_namemgr("ip", ib) for ib in range(4)]
-            new_axes_pos = [int_nmgr.get_intgl_deriv_newaxispos("ip", ib) for ib in range(4)]
+            ibs = sorted(grad_outs.keys())
+            # without the symmetry, the integrals are translationally invariant,
+            # so the derivative w.r.t. the last centre is minus the sum of the
+            # derivatives w.r.t. the other three centres, and it is not calculated
+            use_tinv = len(ibs) == 4
+            if use_tinv:
+                ibs = ibs[:3]
+            sname_derivs = [int_nmgr.get_intgl_deriv_namemgr("ip", ib) for ib in ibs]
+            new_axes_pos = [int_nmgr.get_intgl_deriv_newaxispos("ip", ib) for ib in ibs]
             int_fcn = lambda wrappers, int_nmgr: _Int4cFunction.apply(
                 *ctx.saved_tensors, wrappers, int_nmgr)
-            dout_dposs = _get_integrals(sname_derivs, wrappers, int_fcn, new_axes_pos)
 
-            # negative because the integral calculates the nabla w.r.t. the
-            # spatial coordinate, not the basis central position
-            ndim = dout_dposs[0].shape[0]
-            shape = (ndim, -1, *naos)
-            grad_out2 = grad_out.reshape(*shape[1:])
-            grad_pos_a1 = -torch.einsum("dzijkl,zijkl->di", dout_dposs[0].reshape(*shape), grad_out2)
-            grad_pos_a2 = -torch.einsum("dzijkl,zijkl->dj", dout_dposs[1].reshape(*shape), grad_out2)
-            grad_pos_b1 = -torch.einsum("dzijkl,zijkl->dk", dout_dposs[2].reshape(*shape), grad_out2)
-            grad_pos_b2 = -torch.einsum("dzijkl,zijkl->dl", dout_dposs[3].reshape(*shape), grad_out2)
+            # the derivative integrals are calculated in blocks of the first
+            # basis and contracted immediately with grad_out to limit the memory
+            ndim = NDIM
+            ncomp = grad_out0.numel() // reduce(operator.mul, naos, 1)
+            numel_per_ao = len(sname_derivs) * ndim * ncomp * naos[1] * naos[2] * naos[3]
+            maxnao = max(1, config.CHUNK_MEMORY // (grad_out0.element_size() * numel_per_ao))
+            grad_pos_blks: Dict[int, List[torch.Tensor]] = {ib: [] for ib in grad_outs}
+            ioff = 0
+            for wrapper0 in _split_wrapper(wrappers[0], maxnao):
+                iend = ioff + wrapper0.nao()
+                dout_dposs = _get_integrals(sname_derivs, [wrapper0, *wrappers[1:]], int_fcn,
+                                            new_axes_pos)
+
+                # negative because the integral calculates the nabla w.r.t. the
+                # spatial coordinate, not the basis central position
+                shape = (ndim, -1, iend - ioff, *naos[1:])
+                dout_dposs = [dout_dpos.reshape(*shape) for dout_dpos in dout_dposs]
+                for ib, dout_dpos in zip(ibs, dout_dposs):
+                    grad_out2 = grad_outs[ib][..., ioff:iend, :, :, :].reshape(*shape[1:])
+                    grad_pos_blks[ib].append(
+                        -torch.einsum("dzijkl,zijkl->d%s" % "ijkl"[ib], dout_dpos, grad_out2))
+                if use_tinv:
+                    grad_out2 = grad_outs[3][..., ioff:iend, :, :, :].reshape(*shape[1:])
+                    dout_dpos_sum = dout_dposs[0] + dout_dposs[1] + dout_dposs[2]
+                    grad_pos_blks[3].append(torch.einsum("dzijkl,zijkl->dl", dout_dpos_sum, grad_out2))
+                ioff = iend
+
+            for ib, grad_pos_blk in grad_pos_blks.items():
+                # the blocks are split along the first basis and summed for the others
+                grad_pos = torch.cat(grad_pos_blk, dim=-1) if ib == 0 else \
+                    reduce(operator.add, grad_pos_blk)
+                ao_to_atom = wrappers[ib].ao_to_atom().expand(ndim, -1)
+                grad_allpossT.scatter_add_(dim=-1, index=ao_to_atom, src=grad_pos)
+
+        # gradients for the basis coefficients and exponents
+        u_int_fcn = lambda u_params, u_wrappers, int_nmgr: _Int4cFunction.apply(
+            *u_params, u_wrappers, int_nmgr)
+        grad_allcoeffs, grad_allalphas = _get_basis_params_grad(
+            grad_outs, allcoeffs, allalphas, wrappers, int_nmgr, u_int_fcn)
 
-            ao_to_atom0 = wrappers[0].ao_to_atom().expand(ndim, -1)
-            ao_to_atom1 = wrappers[1].ao_to_atom().expand(ndim, -1)
-            ao_to_atom2 = wrappers[2].ao_to_atom().expand(ndim, -1)
-            ao_to_atom3 = wrappers[3].ao_to_atom().expand(ndim, -1)
-            grad_allpossT.scatter_add_(dim=-1, index=ao_to_atom0, src=grad_pos_a1)
-            grad_allpossT.scatter_add_(dim=-1, index=ao_to_atom1, src=grad_pos_a2)
-            grad_allpossT.scatter_add_(dim=-1, index=ao_to_atom2, src=grad_pos_b1)
-            grad_allpossT.scatter_add_(dim=-1, index=ao_to_atom3, src=grad_pos_b2)
-
-        # gradients for the basis coefficients
-        grad_allcoeffs: Optional[torch.Tensor] = None
-        grad_allalphas: Optional[torch.Tensor] = None
-        if allcoeffs.requires_grad or allalphas.requires_grad:
-            # obtain the uncontracted wrapper, and expanded grad_out
-            # uao2ao: (nu_ao)
-            u_wrappers_tup, uao2aos_tup = zip(*[w.get_uncontracted_wrapper() for w in wrappers])
-            u_wrappers = list(u_wrappers_tup)
-            uao2aos = list(uao2aos_tup)
-            u_params = u_wrappers[0].params
-
-            # u_grad_out: (..., nu_ao0, nu_ao1, nu_ao2, nu_ao3)
-            u_grad_out = _gather_at_dims(grad_out, mapidxs=uao2aos, dims=[-4, -3, -2, -1])
-
-            # get the scatter indices
-            ao2shl0 = u_wrappers[0].ao_to_shell()  # (nu_ao0,)
-            ao2shl1 = u_wrappers[1].ao_to_shell()
-            ao2shl2 = u_wrappers[2].ao_to_shell()
-            ao2shl3 = u_wrappers[3].ao_to_shell()
-
-            # calculate the grad w.r.t. coeffs
-            if allcoeffs.requires_grad:
-                grad_allcoeffs = torch.zeros_like(allcoeffs)
-
-                # (..., nu_ao0, nu_ao1, nu_ao2, nu_ao3)
-                dout_dcoeff = _Int4cFunction.apply(*u_params, u_wrappers, int_nmgr)
+        return grad_allcoeffs, grad_allalphas, grad_allposs, \
+            None, None, None
 
+def _unpack_s8_grad(grad_out: torch.Tensor, scale: float = 1.0) -> torch.Tensor:
+    # convert the gradient of the packed 8-fold symmetry integrals into the
+    # gradient of the full integrals, spread equally on the symmetry-equivalent
+    # elements and multiplied by scale
+    # the packed gradient is divided by the degeneracy of its elements (1, 2,
+    # 4, or 8 from i == j, k == l, and ij == kl) in chunks of rows before it
+    # is unpacked once, so no other full-size tensors are constructed
+    # grad_out: (npacked,)
+    # returns: (nao, nao, nao, nao)
+    nao = get_nao_from_s8(grad_out.shape[-1])
+    npair = nao * (nao + 1) // 2
+    i, j = torch.tril_indices(nao, nao, device=grad_out.device)
+    pair_deg = 2 - (i == j).to(grad_out.dtype)  # (npair,)
+
+    # the rows of the packed array contain (ij|kl) with kl <= ij, the number
+    # of rows is limited by the index arrays of the chunk
+    nrows = max(1, config.CHUNK_MEMORY // (4 * 8 * npair))
+    grads: List[torch.Tensor] = []
+    for row0 in range(0, npair, nrows):
+        row1 = min(row0 + nrows, npair)
+        rows = torch.arange(row0, row1, device=grad_out.device)
+        ij = torch.repeat_interleave(rows, rows + 1)
+        kl = torch.arange(row0 * (row0 + 1) // 2, row1 * (row1 + 1) // 2,
+                          device=grad_out.device) - ij * (ij + 1) // 2
+        mult = pair_deg[ij] * pair_deg[kl] * (2 - (ij == kl).to(grad_out.dtype)) / scale
+        grads.append(grad_out[..., row0 * (row0 + 1) // 2:row1 * (row1 + 1) // 2] / mult)
+    return unpack_s8(torch.cat(grads, dim=-1))
+
+def _get_basis_params_grad(grad_outs: Dict[int, torch.Tensor], allcoeffs: torch.Tensor,
+                           allalphas: torch.Tensor, wrappers: List[LibcintWrapper],
+                           int_nmgr: IntorNameManager,
+                           u_int_fcn: Callable[[Tuple[torch.Tensor, ...], List[LibcintWrapper],
+                                                IntorNameManager], torch.Tensor]) \
+        -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]:
+    # calculate the gradients w.r.t. the basis coefficients and exponents from
+    # the integrals of the uncontracted bases
+    # the uncontracted integrals are calculated in blocks of shells of the first
+    # basis, contracted with the gathered block of grad_out, and discarded
+    # immediately, so the full uncontracted tensors are never constructed
+    # the derivatives related by the permutation symmetry of the integrals are
+    # only calculated for one of the bases, with the combined grad_out
+    # grad_outs: dictionary of the calculated basis index to its grad_out
+    #     (..., nao0, nao1, ...) from _fold_grad_out on the contracted
+    #     wrappers, as the uncontracted wrappers are always different objects
+    # u_int_fcn: function receiving the uncontracted parameters, wrappers, and
+    #     the integral name manager, returning the integral tensor
+    # returns the gradients w.r.t. allcoeffs and allalphas: (ngauss_tot,) or None
+    with_coeffs = allcoeffs.requires_grad
+    with_alphas = allalphas.requires_grad
+    if not (with_coeffs or with_alphas):
+        return None, None
+
+    nbasis = len(wrappers)
+    dims = list(range(-nbasis, 0))
+    subs = "ijkl"[:nbasis]
+
+    # obtain the uncontracted wrapper and mapping
+    # uao2aos: list of (nu_ao*,)
+    u_wrappers_tup, uao2aos_tup = zip(*[w.get_uncontracted_wrapper() for w in wrappers])
+    u_wrappers = list(u_wrappers_tup)
+    uao2aos = list(uao2aos_tup)
+    u_params = u_wrappers[0].params
+    int_fcn = lambda u_wrappers, int_nmgr: u_int_fcn(u_params, u_wrappers, int_nmgr)
+
+    # get the scatter indices
+    ao2shls = [w.ao_to_shell() for w in u_wrappers]  # list of (nu_ao*,)
+
+    ibs = sorted(grad_outs.keys())
+    grad_out0 = grad_outs[ibs[0]]
+
+    # get the derivative integral names for the exponents
+    sname_derivs = [int_nmgr.get_intgl_deriv_namemgr("rr", ib) for ib in ibs]
+    new_axes_pos = [int_nmgr.get_intgl_deriv_newaxispos("rr", ib) for ib in ibs]
+
+    # determine the block size from the number of integral elements per
+    # uncontracted atomic orbital of the first basis
+    nu_aos = [len(uao2ao) for uao2ao in uao2aos]
+    ncomp = grad_out0.numel() // reduce(operator.mul, grad_out0.shape[-nbasis:], 1)
+    # the integrals and the gathered grad_out for every calculated basis
+    nints = (1 if with_coeffs else 0) + (len(ibs) if with_alphas else 0) + len(ibs)
+    numel_per_ao = nints * ncomp * reduce(operator.mul, nu_aos[1:], 1)
+    maxnao = max(1, config.CHUNK_MEMORY // (grad_out0.element_size() * numel_per_ao))
+
+    grad_allcoeffs = torch.zeros_like(allcoeffs) if with_coeffs else None  # (ngauss)
+    grad_allalphas = torch.zeros_like(allalphas) if with_alphas else None  # (ngauss)
+    ioff = 0
+    for u_wrapper0 in _split_wrapper(u_wrappers[0], maxnao):
+        iend = ioff + u_wrapper0.nao()
+        blk_wrappers = [u_wrapper0, *u_wrappers[1:]]
+        blk_ao2shls = [ao2shls[0][ioff:iend], *ao2shls[1:]]
+
+        # get the uncontracted (gathered) grad_out only for the block
+        # u_grad_outs: list of (..., nu_blk, nu_ao1, ...)
+        u_grad_outs = [_gather_at_dims(grad_outs[ib], mapidxs=[uao2aos[0][ioff:iend], *uao2aos[1:]],
+                                       dims=dims) for ib in ibs]
+
+        # calculate the gradient w.r.t. coeffs
+        if grad_allcoeffs is not None:
+            # (..., nu_blk, nu_ao1, ...)
+            dout_dcoeff = int_fcn(blk_wrappers, int_nmgr)
+            for ib, u_grad_out in zip(ibs, u_grad_outs):
                 # get the coefficients and spread it on the u_ao-length tensor
-                coeffs_ao0 = torch.gather(allcoeffs, dim=-1, index=ao2shl0)  # (nu_ao0)
-                coeffs_ao1 = torch.gather(allcoeffs, dim=-1, index=ao2shl1)  # (nu_ao1)
-                coeffs_ao2 = torch.gather(allcoeffs, dim=-1, index=ao2shl2)  # (nu_ao2)
-                coeffs_ao3 = torch.gather(allcoeffs, dim=-1, index=ao2shl3)  # (nu_ao3)
-                # dout_dcoeff_*: (..., nu_ao0, nu_ao1, nu_ao2, nu_ao3)
-                dout_dcoeff_a1 = dout_dcoeff / coeffs_ao0[:, None, None, None]
-                dout_dcoeff_a2 = dout_dcoeff / coeffs_ao1[:, None, None]
-                dout_dcoeff_b1 = dout_dcoeff / coeffs_ao2[:, None]
-                dout_dcoeff_b2 = dout_dcoeff / coeffs_ao3
-
-                # reduce the uncontracted integrations
-                # grad_coeff_*: (nu_ao*)
-                grad_coeff_a1 = torch.einsum("...ijkl,...ijkl->i", dout_dcoeff_a1, u_grad_out)
-                grad_coeff_a2 = torch.einsum("...ijkl,...ijkl->j", dout_dcoeff_a2, u_grad_out)
-                grad_coeff_b1 = torch.einsum("...ijkl,...ijkl->k", dout_dcoeff_b1, u_grad_out)
-                grad_coeff_b2 = torch.einsum("...ijkl,...ijkl->l", dout_dcoeff_b2, u_grad_out)
-                # grad_coeff_all = grad_coeff_a1 + grad_coeff_a2 + grad_coeff_b1 + grad_coeff_b2
-
-                # scatter to the coefficients
-                grad_allcoeffs.scatter_add_(dim=-1, index=ao2shl0, src=grad_coeff_a1)
-                grad_allcoeffs.scatter_add_(dim=-1, index=ao2shl1, src=grad_coeff_a2)
-                grad_allcoeffs.scatter_add_(dim=-1, index=ao2shl2, src=grad_coeff_b1)
-                grad_allcoeffs.scatter_add_(dim=-1, index=ao2shl3, src=grad_coeff_b2)
-
-            if allalphas.requires_grad:
-                grad_allalphas = torch.zeros_like(allalphas)  # (ngauss)
-
-                # get the uncontracted integrals
-                sname_derivs = [int_nmgr.get_intgl_deriv_namemgr("rr", ib) for ib in range(4)]
-                new_axes_pos = [int_nmgr.get_intgl_deriv_newaxispos("rr", ib) for ib in range(4)]
-                u_int_fcn = lambda u_wrappers, int_nmgr: _Int4cFunction.apply(
-                    *u_params, u_wrappers, int_nmgr)
-                dout_dalphas = _get_integrals(sname_derivs, u_wrappers, u_int_fcn, new_axes_pos)
-
-                # (nu_ao)
+                coeffs_ao = torch.gather(allcoeffs, dim=-1, index=blk_ao2shls[ib])
+                # divide done here instead of after scatter to make the 2nd gradient
+                # calculation correct
+                dout_dcoeff_i = dout_dcoeff / coeffs_ao[(...,) + (None,) * (nbasis - 1 - ib)]
+                grad_coeff_i = torch.einsum("...%s,...%s->%s" % (subs, subs, subs[ib]),
+                                            dout_dcoeff_i, u_grad_out)
+                grad_allcoeffs.scatter_add_(dim=-1, index=blk_ao2shls[ib], src=grad_coeff_i)
+
+        # calculate the gradient w.r.t. alphas
+        if grad_allalphas is not None:
+            dout_dalphas = _get_integrals(sname_derivs, blk_wrappers, int_fcn, new_axes_pos)
+            for ib, dout_dalpha, u_grad_out in zip(ibs, dout_dalphas, u_grad_outs):
                 # negative because the exponent is negative alpha * (r-ra)^2
-                grad_alpha_a1 = -torch.einsum("...ijkl,...ijkl->i", dout_dalphas[0], u_grad_out)
-                grad_alpha_a2 = -torch.einsum("...ijkl,...ijkl->j", dout_dalphas[1], u_grad_out)
-                grad_alpha_b1 = -torch.einsum("...ijkl,...ijkl->k", dout_dalphas[2], u_grad_out)
-                grad_alpha_b2 = -torch.einsum("...ijkl,...ijkl->l", dout_dalphas[3], u_grad_out)
-                # grad_alpha_all = (grad_alpha_a1 + grad_alpha_a2 + grad_alpha_b1 + grad_alpha_b2)
-
-                # scatter the grad
-                grad_allalphas.scatter_add_(dim=-1, index=ao2shl0, src=grad_alpha_a1)
-                grad_allalphas.scatter_add_(dim=-1, index=ao2shl1, src=grad_alpha_a2)
-                grad_allalphas.scatter_add_(dim=-1, index=ao2shl2, src=grad_alpha_b1)
-                grad_allalphas.scatter_add_(dim=-1, index=ao2shl3, src=grad_alpha_b2)
-
-        return grad_allcoeffs, grad_allalphas, grad_allposs, \
-            None, None, None
+                grad_alpha_i = -torch.einsum("...%s,...%s->%s" % (subs, subs, subs[ib]),
+                                             dout_dalpha, u_grad_out)
+                grad_allalphas.scatter_add_(dim=-1, index=blk_ao2shls[ib], src=grad_alpha_i)
+
+        ioff = iend
+
+    return grad_allcoeffs, grad_allalphas
+
+def _fold_grad_out(grad_out: torch.Tensor, wrappers: List[LibcintWrapper],
+                   int_nmgr: IntorNameManager) -> Dict[int, torch.Tensor]:
+    # get the grad_out to be contracted with the derivatives w.r.t. every basis
+    # where the derivatives related by a permutation symmetry P of the integrals
+    # are combined into the one of the lowest basis index, i.e.
+    #     sum_x g[x] d_a I[x] = sum_x g.permute(P^-1)[x] d_P[a] I[x]
+    # grad_out: (..., nao0, nao1, ...)
+    # returns the dictionary of the calculated basis index to its grad_out
+    nbasis = len(wrappers)
+    perms = [tuple(range(nbasis))]
+    if int_nmgr.int_type == "int2e" and int_nmgr.shortname == "ar12b":
+        perms = [perm for perm in _ERI_PERMS
+                 if all(wrappers[perm[i]] is wrappers[i] for i in range(nbasis))]
+
+    nbatch = grad_out.ndim - nbasis
+    res: Dict[int, torch.Tensor] = {}
+    for ib in range(nbasis):
+        perm = min(perms, key=operator.itemgetter(ib))
+        inv_perm = [nbatch + int(i) for i in np.argsort(perm)]
+        grad = grad_out.permute(*range(nbatch), *inv_perm)
+        res[perm[ib]] = res[perm[ib]] + grad if perm[ib] in res else grad
+    return res
 
 ################### integrator (direct interface to libcint) ###################
 
@@ -588,12 +590,15 @@ class _cintoptHandler(ctypes.c_void_p):
             pass
 
 class Intor(object):
-    def __init__(self, int_nmgr: IntorNameManager, wrappers: List[LibcintWrapper]):
+    def __init__(self, int_nmgr: IntorNameManager, wrappers: List[LibcintWrapper],
+                 packed: bool = False):
         assert len(wrappers) > 0
         wrapper0 = wrappers[0]
         self.int_type = int_nmgr.int_type
         self.atm, self.bas, self.env = wrapper0.atm_bas_env
         self.wrapper0 = wrapper0
+        self.wrappers = wrappers
+        self.packed = packed
         self.int_nmgr = int_nmgr
         self.wrapper_uniqueness = _get_uniqueness([id(w) for w in wrappers])
 
@@ -667,8 +672,31 @@ class Intor(object):
     def _int4c(self) -> torch.Tensor:
         # performing 4-centre integrals with libcint
         symm = self.int_nmgr.get_intgl_symmetry(self.wrapper_uniqueness)
-        outshape = symm.get_reduced_shape(self.outshape)
 
+        if self.packed:
+            assert isinstance(symm, S4Symmetry), \
+                "Packed integral is only available for integrals with 8-fold symmetry"
+
+        # use the screened calculation only if there are negligible blocks
+        screened = None
+        bound_tables = self._get_schwarz_tables()
+        if config.ERI_SCREEN_THRESHOLD > 0 and bound_tables is not None:
+            screened = self._get_screened_blocks(config.ERI_SCREEN_THRESHOLD,
+                                                 symm.code == "s4", *bound_tables)
+        if screened is None:
+            out = self._int4c_packed() if self.packed else self._int4c_full(symm)
+        else:
+            shell_blocks, block_quartets = screened
+            out = self._int4c_screened(shell_blocks, block_quartets, symm)
+
+        if not self.packed:
+            out = symm.reconstruct_array(out, self.outshape)
+        return self._to_tensor(out)
+
+    def _int4c_full(self, symm: BaseSymmetry) -> np.ndarray:
+        # calculate all the elements of the 4-centre integrals
+        # returns the array in the reduced shape of the symmetry
+        outshape = symm.get_reduced_shape(self.outshape)
         out = np.empty(outshape, dtype=np.float64)
 
         drv = CGTO().GTOnr2e_fill_drv
@@ -683,9 +711,228 @@ class Intor(object):
             np2ctypes(self.atm), int2ctypes(self.atm.shape[0]),
             np2ctypes(self.bas), int2ctypes(self.bas.shape[0]),
             np2ctypes(self.env))
-
-        out = symm.reconstruct_array(out, self.outshape)
-        return self._to_tensor(out)
+        return out
+
+    def _int4c_packed(self) -> np.ndarray:
+        # calculate the 8-fold symmetric integrals directly in the packed
+        # array, as there is no s8 fill function in libcgto
+        # the rows ij are calculated in blocks of i-shells with the s4 (j in
+        # the block) and s2kl (j before the block) fills, with kl limited to
+        # the pairs before the end of the block, and only the kl <= ij
+        # elements of every row are copied to the packed array
+        # the size of every block is limited by config.CHUNK_MEMORY
+        # returns: (nao * (nao + 1) // 2 * (nao * (nao + 1) // 2 + 1) // 2,)
+        assert self.ncomp == 1
+        drv = CGTO().GTOnr2e_fill_drv
+        prescreen = ctypes.POINTER(ctypes.c_void_p)()
+        shell_to_aoloc = self.wrapper0.full_shell_to_aoloc
+        sh0, sh1 = self.wrapper0.shell_idxs
+        ao0 = shell_to_aoloc[sh0]
+        nao = self.outshape[-1]
+        pair_idx = get_pair_index(nao).numpy()
+
+        # split the i-shells into blocks where the rows ij with i in the block
+        # and kl before the end of the block fit in the memory limit
+        blocks: List[Tuple[int, int]] = []
+        bsh0 = sh0
+        for bsh1 in range(sh0 + 2, sh1 + 1):
+            a0 = shell_to_aoloc[bsh0] - ao0
+            a1 = shell_to_aoloc[bsh1] - ao0
+            if 8 * (a1 - a0) * a1 * a1 * (a1 + 1) // 2 > config.CHUNK_MEMORY:
+                blocks.append((bsh0, bsh1 - 1))
+                bsh0 = bsh1 - 1
+        blocks.append((bsh0, sh1))
+
+        # every element of the packed array is written exactly once
+        out = np.empty(S8Symmetry().get_reduced_shape(self.outshape), dtype=np.float64)
+        for (bsh0, bsh1) in blocks:
+            a0 = shell_to_aoloc[bsh0] - ao0
+            a1 = shell_to_aoloc[bsh1] - ao0
+            nkl = a1 * (a1 + 1) // 2
+            for fill_code in ("s4", "s2kl"):
+                if fill_code == "s4":
+                    jshells = (bsh0, bsh1)
+                    ij = pair_idx[a0:a1, a0:a1][np.tril_indices(a1 - a0)]
+                elif bsh0 > sh0:
+                    jshells = (sh0, bsh0)
+                    ij = pair_idx[a0:a1, :a0].ravel()
+                else:
+                    continue
+                shls_slice = (bsh0, bsh1, *jshells, sh0, bsh1, sh0, bsh1)
+                block = np.empty((len(ij), nkl), dtype=np.float64)
+
+                fill = getattr(CGTO(), "GTOnr2e_fill_%s" % fill_code)
+                drv(self.op, fill, prescreen,
+                    block.ctypes.data_as(ctypes.c_void_p),
+                    ctypes.c_int(self.ncomp),
+                    (ctypes.c_int * 8)(*shls_slice),
+                    np2ctypes(shell_to_aoloc),
+                    self.optimizer,
+                    np2ctypes(self.atm), int2ctypes(self.atm.shape[0]),
+                    np2ctypes(self.bas), int2ctypes(self.bas.shape[0]),
+                    np2ctypes(self.env))
+
+                # the packed row ij is contiguous with kl = 0, ..., ij
+                for (irow, ijrow) in enumerate(ij):
+                    offset = ijrow * (ijrow + 1) // 2
+                    out[offset:offset + ijrow + 1] = block[irow, :ijrow + 1]
+        return out
+
+    def _get_schwarz_tables(self) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        # get the Schwarz bounds of the bra and ket shell pairs of the integral,
+        # indexed by the absolute shell indices of (0, 1) and (2, 3) bases
+        # returns None if the bounds are not available for the operator
+        if self.int_nmgr.int_type != "int2e":
+            return None
+        sname = self.int_nmgr.shortname
+        if sname == "ar12b":
+            bounds = self.wrapper0.full_schwarz_bounds()
+            return bounds, bounds
+
+        # the first derivatives w.r.t. one of the centres, i.e.
+        # |(d_x i j|kl)| <= sqrt((d_x i j|d_x i j)) * sqrt((kl|kl))
+        int_nmgr = IntorNameManager("int2e", "ar12b")
+        for ib in range(4):
+            if sname == int_nmgr.get_intgl_deriv_namemgr("ip", ib).shortname:
+                bounds = self.wrapper0.full_schwarz_bounds()
+                dbounds = self.wrapper0.full_schwarz_deriv_bounds()
+                # the derivative bounds are indexed by (nabla shell, other shell)
+                if ib % 2 == 1:
+                    dbounds = dbounds.T
+                return (dbounds, bounds) if ib < 2 else (bounds, dbounds)
+        return None
+
+    def _get_screened_blocks(self, thresh: float, symm_s4: bool,
+                             bra_bounds: np.ndarray, ket_bounds: np.ndarray) \
+            -> Optional[Tuple[List[List[Tuple[int, int]]], List[Tuple[int, int, int, int, int]]]]:
+        # get the list of significant atom-block quartets based on the Schwarz
+        # inequality, |(ij|kl)| <= Q[i, j] * Q[k, l], where Q for the bra and
+        # the ket pairs are given in bra_bounds and ket_bounds.
+        # Returns the shell ranges of the atom blocks for every wrapper and
+        # the list of block quartets, where every element is (iblock0,
+        # iblock1, iblock2, iblock3_start, iblock3_end), i.e. the last block
+        # dimension is given as a contiguous range covering the significant
+        # blocks (to reduce the number of calls).
+        # If symm_s4, only the blocks with iblock0 >= iblock1 and
+        # iblock2 >= iblock3 are listed and the diagonal block iblock3 ==
+        # iblock2 is always listed separately.
+        # Returns None if no blocks can be skipped.
+        wrappers = self.wrappers
+        shell_blocks = [_get_atom_blocks(w) for w in wrappers]
+
+        # get the maximum bounds for every pair of atom blocks
+        # qbra: (nblock0, nblock1), qket: (nblock2, nblock3)
+        sl = [slice(*w.shell_idxs) for w in wrappers]
+        qbra = _get_block_max(bra_bounds[sl[0], sl[1]], shell_blocks[0], shell_blocks[1])
+        qket = _get_block_max(ket_bounds[sl[2], sl[3]], shell_blocks[2], shell_blocks[3])
+        if symm_s4:
+            qbra = np.tril(qbra)
+            qket = np.tril(qket)
+            qbra_min = np.min(qbra[np.tril_indices_from(qbra)])
+            qket_min = np.min(qket[np.tril_indices_from(qket)])
+        else:
+            qbra_min = np.min(qbra)
+            qket_min = np.min(qket)
+
+        # all blocks are significant
+        if qbra_min * qket_min >= thresh:
+            return None
+
+        res: List[Tuple[int, int, int, int, int]] = []
+        qket_max = np.max(qket)
+        for ib0, ib1 in zip(*np.nonzero(qbra * qket_max >= thresh)):
+            mask = qbra[ib0, ib1] * qket >= thresh  # (nblock2, nblock3)
+            for ib2 in np.nonzero(np.any(mask, axis=-1))[0]:
+                ib3s = np.nonzero(mask[ib2])[0]
+                ib3e = ib3s[-1] + 1
+                if symm_s4 and ib3e == ib2 + 1 and ib3s[0] < ib2:
+                    # split the diagonal block to be calculated with the
+                    # symmetric fill function
+                    res.append((ib0, ib1, ib2, ib3s[0], ib2))
+                    res.append((ib0, ib1, ib2, ib2, ib3e))
+                else:
+                    res.append((ib0, ib1, ib2, ib3s[0], ib3e))
+        return shell_blocks, res
+
+    def _int4c_screened(self, shell_blocks: List[List[Tuple[int, int]]],
+                        block_quartets: List[Tuple[int, int, int, int, int]],
+                        symm: BaseSymmetry) -> np.ndarray:
+        # performing 4-centre integrals only on the significant block quartets
+        # while leaving the other elements as zeros
+        # returns the array in the reduced shape of the symmetry, or the
+        # packed array if self.packed
+        drv = CGTO().GTOnr2e_fill_drv
+        prescreen = ctypes.POINTER(ctypes.c_void_p)()
+        comp_shape = self.outshape[:-4]
+        shell_to_aoloc = self.wrapper0.full_shell_to_aoloc
+        ao_offsets = [shell_to_aoloc[w.shell_idxs[0]] for w in self.wrappers]
+
+        symm_s4 = symm.code == "s4"
+        if self.packed:
+            # out: (npair * (npair + 1) // 2,) with npair = nao * (nao + 1) // 2
+            out = np.zeros(S8Symmetry().get_reduced_shape(self.outshape), dtype=np.float64)
+            pair_idx = get_pair_index(self.outshape[-1]).numpy()
+        elif symm_s4:
+            # out: (..., nao0 * (nao0 + 1) // 2, nao2 * (nao2 + 1) // 2)
+            out = np.zeros(symm.get_reduced_shape(self.outshape), dtype=np.float64)
+            pair_idx = get_pair_index(self.outshape[-1]).numpy()
+        else:
+            # out: (ncomp, nao0, nao1, nao2, nao3)
+            out = np.zeros((self.ncomp, *self.outshape[-4:]), dtype=np.float64)
+        for (ib0, ib1, ib2, ib3s, ib3e) in block_quartets:
+            # kl > ij for all the elements with k in a later block than i,
+            # so they are already in the packed array from the swapped quartet
+            if self.packed and ib2 > ib0:
+                continue
+            shells = [shell_blocks[0][ib0], shell_blocks[1][ib1],
+                      shell_blocks[2][ib2],
+                      (shell_blocks[3][ib3s][0], shell_blocks[3][ib3e - 1][1])]
+            shls_slice = sum(shells, ())
+            aoslices = [slice(shell_to_aoloc[sh0] - offset, shell_to_aoloc[sh1] - offset)
+                        for ((sh0, sh1), offset) in zip(shells, ao_offsets)]
+            a0, a1, a2, a3 = aoslices
+
+            if symm_s4:
+                # only the lower triangular part of the diagonal blocks is
+                # calculated, packed in the same order as the pair index
+                bra_s2 = ib0 == ib1
+                ket_s2 = ib3s == ib2 and ib3e == ib2 + 1
+                fill_code = {(True, True): "s4", (True, False): "s2ij",
+                             (False, True): "s2kl", (False, False): "s1"}[(bra_s2, ket_s2)]
+                ij = pair_idx[a0, a1]
+                ij = ij[np.tril_indices_from(ij)] if bra_s2 else ij.ravel()
+                kl = pair_idx[a2, a3]
+                kl = kl[np.tril_indices_from(kl)] if ket_s2 else kl.ravel()
+                block = np.empty((self.ncomp, len(ij), len(kl)), dtype=np.float64)
+            else:
+                fill_code = "s1"
+                block = np.empty((self.ncomp, *(a.stop - a.start for a in aoslices)),
+                                 dtype=np.float64)
+
+            fill = getattr(CGTO(), "GTOnr2e_fill_%s" % fill_code)
+            drv(self.op, fill, prescreen,
+                block.ctypes.data_as(ctypes.c_void_p),
+                ctypes.c_int(self.ncomp),
+                (ctypes.c_int * 8)(*shls_slice),
+                np2ctypes(shell_to_aoloc),
+                self.optimizer,
+                np2ctypes(self.atm), int2ctypes(self.atm.shape[0]),
+                np2ctypes(self.bas), int2ctypes(self.bas.shape[0]),
+                np2ctypes(self.env))
+
+            if self.packed:
+                # the elements with kl > ij are written by the swapped quartet
+                irow, icol = np.nonzero(kl[None, :] <= ij[:, None])
+                ijsel = ij[irow]
+                out[ijsel * (ijsel + 1) // 2 + kl[icol]] = block[0, irow, icol]
+            elif symm_s4:
+                out[..., ij[:, None], kl[None, :]] = block.reshape(*comp_shape, len(ij), len(kl))
+            else:
+                out[:, a0, a1, a2, a3] = block
+
+        if not symm_s4:
+            out = out.reshape(self.outshape)
+        return out
 
     def _to_tensor(self, out: np.ndarray) -> torch.Tensor:
         # convert the numpy array to the appropriate tensor
@@ -707,6 +954,45 @@ def _get_intgl_optimizer(opname: str,
     opt = ctypes.cast(cintopt, _cintoptHandler)
     return opt
 
+def _split_wrapper(wrapper: LibcintWrapper, maxnao: int) -> List[LibcintWrapper]:
+    # split the wrapper into subsets of contiguous shells where each subset
+    # has at most maxnao atomic orbitals (unless it only has 1 shell)
+    if wrapper.nao() <= maxnao:
+        return [wrapper]
+    parent = wrapper.parent
+    shell_to_aoloc = wrapper.full_shell_to_aoloc
+    sh0, sh1 = wrapper.shell_idxs
+    res: List[LibcintWrapper] = []
+    start = sh0
+    for sh in range(sh0 + 1, sh1 + 1):
+        # close the block before the last shell if the block [start, sh) is too big
+        if shell_to_aoloc[sh] - shell_to_aoloc[start] > maxnao and sh - 1 > start:
+            res.append(parent[start:sh - 1])
+            start = sh - 1
+    res.append(parent[start:sh1])
+    return res
+
+def _get_atom_blocks(wrapper: LibcintWrapper) -> List[Tuple[int, int]]:
+    # split the shells of the wrapper into blocks of shells belonging to the
+    # same atom (the shells of an atom are contiguous)
+    # returns the list of absolute shell index ranges (upper is exclusive)
+    shell_to_atom = wrapper.shell_to_atom()
+    sh0 = wrapper.shell_idxs[0]
+    splits = np.nonzero(np.diff(shell_to_atom))[0] + 1
+    bounds = [0, *splits.tolist(), len(shell_to_atom)]
+    return [(sh0 + bounds[i], sh0 + bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+def _get_block_max(a: np.ndarray, blocks0: List[Tuple[int, int]],
+                   blocks1: List[Tuple[int, int]]) -> np.ndarray:
+    # get the maximum values of the 2D array for every pair of the blocks
+    # a: (nshells0, nshells1)
+    # returns: (nblocks0, nblocks1)
+    idx0 = np.array([b[0] for b in blocks0]) - blocks0[0][0]
+    idx1 = np.array([b[0] for b in blocks1]) - blocks1[0][0]
+    res = np.maximum.reduceat(a, idx0, axis=0)
+    res = np.maximum.reduceat(res, idx1, axis=1)
+    return res
+
 ############### name derivation manager functions ###############
 def _get_integrals(int_nmgrs: List[IntorNameManager],
                    wrappers: List[LibcintWrapper],
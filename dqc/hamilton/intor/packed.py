@@ -0,0 +1,71 @@
+from typing import Optional
+import math
+import torch
+from dqc.utils.config import config
+
+# functions to work with the 8-fold symmetry packed 4-centre integrals
+# The packed array stores the elements (ij|kl) with i >= j, k >= l, and
+# ij >= kl, where ij = i * (i + 1) // 2 + j is the pair index in the
+# lower-triangular order.
+# All the functions here are written with differentiable torch operations.
+
+__all__ = ["get_pair_index", "get_nao_from_s8", "get_s8_rows", "pack_s8", "unpack_s8"]
+
+def get_pair_index(nao: int, device: Optional[torch.device] = None) -> torch.Tensor:
+    # returns the pair index of (i, j) in the lower-triangular order
+    # returns: (nao, nao) with dtype torch.long
+    i = torch.arange(nao, dtype=torch.long, device=device)
+    imax = torch.maximum(i[:, None], i[None, :])
+    imin = torch.minimum(i[:, None], i[None, :])
+    return imax * (imax + 1) // 2 + imin
+
+def get_nao_from_s8(npacked: int) -> int:
+    # get the number of atomic orbitals from the size of the packed array
+    npair = (math.isqrt(8 * npacked + 1) - 1) // 2
+    nao = (math.isqrt(8 * npair + 1) - 1) // 2
+    assert npair * (npair + 1) // 2 == npacked and nao * (nao + 1) // 2 == npair, \
+        "The size of the packed array does not correspond to any number of orbitals"
+    return nao
+
+def get_s8_rows(packed: torch.Tensor, row0: int, row1: int) -> torch.Tensor:
+    # get the rows of the 4-fold symmetry matrix (ij|kl) with shape (npair, npair)
+    # from the 8-fold symmetry packed array
+    # packed: (..., npair * (npair + 1) // 2)
+    # returns: (..., row1 - row0, npair)
+    nao = get_nao_from_s8(packed.shape[-1])
+    npair = nao * (nao + 1) // 2
+    r = torch.arange(row0, row1, dtype=torch.long, device=packed.device)[:, None]
+    c = torch.arange(npair, dtype=torch.long, device=packed.device)[None, :]
+    rmax = torch.maximum(r, c)
+    rmin = torch.minimum(r, c)
+    return packed[..., rmax * (rmax + 1) // 2 + rmin]
+
+def pack_s8(mat: torch.Tensor) -> torch.Tensor:
+    # pack the full 4-centre integrals with 8-fold symmetry
+    # mat: (..., nao, nao, nao, nao)
+    # returns: (..., npair * (npair + 1) // 2)
+    nao = mat.shape[-1]
+    npair = nao * (nao + 1) // 2
+    ti, tj = torch.tril_indices(nao, nao, device=mat.device)
+    iu, ju = torch.tril_indices(npair, npair, device=mat.device)
+    return mat[..., ti[iu], tj[iu], ti[ju], tj[ju]]
+
+def unpack_s8(packed: torch.Tensor) -> torch.Tensor:
+    # unpack the 8-fold symmetry packed array to the full 4-centre integrals
+    # the elements are gathered in chunks of the first index, limited by
+    # config.CHUNK_MEMORY, so the indices are never constructed in full size
+    # packed: (..., npair * (npair + 1) // 2)
+    # returns: (..., nao, nao, nao, nao)
+    nao = get_nao_from_s8(packed.shape[-1])
+    pidx = get_pair_index(nao, device=packed.device)
+    out = torch.empty((*packed.shape[:-1], nao, nao, nao, nao), dtype=packed.dtype,
+                      device=packed.device)
+    bs = max(1, config.CHUNK_MEMORY // (3 * 8 * nao ** 3))
+    for i0 in range(0, nao, bs):
+        i1 = min(i0 + bs, nao)
+        ij = pidx[i0:i1, :, None, None]
+        kl = pidx[None, None, :, :]
+        imax = torch.maximum(ij, kl)
+        imin = torch.minimum(ij, kl)
+        out[..., i0:i1, :, :, :] = packed[..., imax * (imax + 1) // 2 + imin]
+    return out
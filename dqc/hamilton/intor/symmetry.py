@@ -67,3 +67,36 @@ class S4Symmetry(BaseSymmetry):
         assert len(orig_shape) >= 4
         assert orig_shape[-4] == orig_shape[-3]
         assert orig_shape[-2] == orig_shape[-1]
+
+class S8Symmetry(BaseSymmetry):
+    # (...ijkl) == (...jikl) == (...ijlk) == (...jilk) ==
+    # (...klij) == (...lkij) == (...klji) == (...lkji)
+    # there is no s8 fill function in libcgto, so the packed array is filled
+    # in blocks from the s4 and s2kl fills (see ``Intor._int4c_packed``)
+    def get_reduced_shape(self, orig_shape: Tuple[int, ...]) -> Tuple[int, ...]:
+        # the returned shape would be (..., ij(ij+1)/2) with ij = i(i+1)/2
+        self.__check_orig_shape(orig_shape)
+
+        batchshape = orig_shape[:-4]
+        ijshape = orig_shape[-4] * (orig_shape[-3] + 1) // 2
+        return (*batchshape, ijshape * (ijshape + 1) // 2)
+
+    @property
+    def code(self) -> str:
+        return "s8"
+
+    def reconstruct_array(self, arr: np.ndarray, orig_shape: Tuple[int, ...]) -> np.ndarray:
+        # reconstruct the full array
+        # arr: (..., ij(ij+1)/2)
+        self.__check_orig_shape(orig_shape)
+
+        s4symm = S4Symmetry()
+        arr4 = np.zeros(s4symm.get_reduced_shape(orig_shape), dtype=arr.dtype)
+        idx0, idx1 = np.tril_indices(arr4.shape[-1])
+        arr4[..., idx0, idx1] = arr
+        arr4[..., idx1, idx0] = arr
+        return s4symm.reconstruct_array(arr4, orig_shape)
+
+    def __check_orig_shape(self, orig_shape: Tuple[int, ...]):
+        assert len(orig_shape) >= 4
+        assert orig_shape[-4] == orig_shape[-3] == orig_shape[-2] == orig_shape[-1]
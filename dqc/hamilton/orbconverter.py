@@ -1,8 +1,11 @@
 from abc import abstractmethod
-from typing import List
+from typing import List, Tuple
 import torch
 import xitorch as xt
 import xitorch.linalg
+from dqc.hamilton.intor.packed import get_pair_index, get_s8_rows
+from dqc.utils.config import config
+from dqc.utils.misc import logger
 
 class BaseOrbConverter(xt.EditableModule):
     """
@@ -35,6 +38,24 @@ class BaseOrbConverter(xt.EditableModule):
         """
         pass
 
+    @abstractmethod
+    def convert_orb(self, orb: torch.Tensor) -> torch.Tensor:
+        """
+        Convert the orbital coefficients in the original orbital basis with
+        shape (..., nao, norb) into the coefficients in the new orbital basis
+        sets with shape (..., nao2, norb).
+        """
+        pass
+
+    @abstractmethod
+    def unconvert_orb(self, orb: torch.Tensor) -> torch.Tensor:
+        """
+        Convert back the orbital coefficients in the new orbital basis sets
+        with shape (..., nao2, norb) into the coefficients in the original
+        orbital basis with shape (..., nao, norb).
+        """
+        pass
+
     @abstractmethod
     def convert2(self, mat: torch.Tensor) -> torch.Tensor:
         """
@@ -44,10 +65,12 @@ class BaseOrbConverter(xt.EditableModule):
         pass
 
     @abstractmethod
-    def convert4(self, mat: torch.Tensor) -> torch.Tensor:
+    def convert4(self, mat: torch.Tensor, packed: bool = False) -> torch.Tensor:
         """
         Convert the last 4 dimensions of the matrix with shape (..., nao, nao, nao, nao)
         into the new orbital basis sets with shape (..., nao2, nao2, nao2, nao2).
+        If ``packed``, the matrix is given and returned in the 8-fold symmetry
+        packed form (see ``dqc.hamilton.intor.packed``).
         """
         pass
 
@@ -88,6 +111,26 @@ class OrbitalOrthogonalizer(BaseOrbConverter):
     def unconvert_to_ortho_dm(self, dm: torch.Tensor) -> torch.Tensor:
         return dm
 
+    def convert_orb(self, orb: torch.Tensor) -> torch.Tensor:
+        """
+        Convert the orbital coefficients in the original orbital basis with
+        shape (..., nao, norb) into the coefficients in the new orbital basis
+        sets with shape (..., nao2, norb).
+        """
+        # the columns of the orthogonalizer are orthogonal, so its
+        # pseudo-inverse is its scaled conjugate transpose
+        orthozer_h = self._orthozer.transpose(-2, -1).conj()  # (nao2, nao)
+        norm = torch.sum(orthozer_h * self._orthozer.transpose(-2, -1), dim=-1, keepdim=True)
+        return (orthozer_h / norm) @ orb
+
+    def unconvert_orb(self, orb: torch.Tensor) -> torch.Tensor:
+        """
+        Convert back the orbital coefficients in the new orbital basis sets
+        with shape (..., nao2, norb) into the coefficients in the original
+        orbital basis with shape (..., nao, norb).
+        """
+        return self._orthozer @ orb
+
     def convert2(self, mat: torch.Tensor) -> torch.Tensor:
         """
         Convert the last 2 dimensions of the matrix with shape (..., nao, nao)
@@ -96,14 +139,20 @@ class OrbitalOrthogonalizer(BaseOrbConverter):
         res = self._orthozer.transpose(-2, -1).conj() @ mat @ self._orthozer
         return res
 
-    def convert4(self, mat: torch.Tensor) -> torch.Tensor:
+    def convert4(self, mat: torch.Tensor, packed: bool = False) -> torch.Tensor:
         """
         Convert the last 4 dimensions of the matrix with shape (..., nao, nao, nao, nao)
         into the new orbital basis sets with shape (..., nao2, nao2, nao2, nao2).
+        If ``packed``, the matrix is given and returned in the 8-fold symmetry
+        packed form (see ``dqc.hamilton.intor.packed``).
         """
-        orthozer = self._orthozer
-        res = torch.einsum("...ijkl,...im,...jn,...kp,...lq->...mnpq",
-                           mat, orthozer, orthozer, orthozer, orthozer)
+        # the conversion is done as sequential quarter-transformations in blocks
+        if packed:
+            res, peak_mem = _quarter_transform_s8(mat, self._orthozer)
+        else:
+            res, peak_mem = _quarter_transform(mat, self._orthozer)
+        logger.log("Peak memory of the 4-index conversion intermediates: %.1f MB" %
+                   (peak_mem / 1024 ** 2), vlevel=1)
         return res
 
     def unconvert_dm(self, dm: torch.Tensor) -> torch.Tensor:
@@ -116,7 +165,7 @@ class OrbitalOrthogonalizer(BaseOrbConverter):
         return dm
 
     def getparamnames(self, methodname: str, prefix: str = "") -> List[str]:
-        if methodname in ["convert2", "convert4", "unconvert_dm"]:
+        if methodname in ["convert_orb", "unconvert_orb", "convert2", "convert4", "unconvert_dm"]:
             return [prefix + "_orthozer"]
         elif methodname in ["convert_ortho_orb", "unconvert_to_ortho_dm"]:
             return []
@@ -143,17 +192,23 @@ class IdentityOrbConverter(BaseOrbConverter):
     def unconvert_to_ortho_dm(self, dm: torch.Tensor) -> torch.Tensor:
         return self._sqrt_ovlp @ dm @ self._sqrt_ovlp
 
+    def convert_orb(self, orb: torch.Tensor) -> torch.Tensor:
+        return orb
+
+    def unconvert_orb(self, orb: torch.Tensor) -> torch.Tensor:
+        return orb
+
     def convert2(self, mat: torch.Tensor) -> torch.Tensor:
         return mat
 
-    def convert4(self, mat: torch.Tensor) -> torch.Tensor:
+    def convert4(self, mat: torch.Tensor, packed: bool = False) -> torch.Tensor:
         return mat
 
     def unconvert_dm(self, dm: torch.Tensor) -> torch.Tensor:
         return dm
 
     def getparamnames(self, methodname: str, prefix: str = "") -> List[str]:
-        if methodname in ["convert2", "convert4", "unconvert_dm"]:
+        if methodname in ["convert_orb", "unconvert_orb", "convert2", "convert4", "unconvert_dm"]:
             return []
         elif methodname == "convert_ortho_orb":
             return [prefix + "_inv_sqrt_ovlp"]
@@ -161,3 +216,92 @@ class IdentityOrbConverter(BaseOrbConverter):
             return [prefix + "_sqrt_ovlp"]
         else:
             raise KeyError(f"Unknown method {methodname}")
+
+def _quarter_transform(mat: torch.Tensor, coeff: torch.Tensor) -> Tuple[torch.Tensor, int]:
+    # transform the 4-index matrix with sequential quarter-transformations,
+    # i.e. res_mnpq = sum_ijkl mat_ijkl c_im c_jn c_kp c_lq, as batched GEMMs
+    # the first two transformations (for the last two indices) are done in
+    # blocks of i and the last two in blocks of p, so the intermediates of the
+    # matrix multiplications are limited by config.CHUNK_MEMORY
+    # mat: (..., nao, nao, nao, nao)
+    # coeff: (nao, nao2)
+    # returns the transformed matrix (..., nao2, nao2, nao2, nao2) and the
+    # peak memory of the arrays in bytes
+    nao, nao2 = coeff.shape
+    batch_shape = mat.shape[:-4]
+    nbatch = mat.numel() // nao ** 4
+    elsize = mat.element_size()
+    coeffT = coeff.transpose(-2, -1)
+
+    # transform the last two indices: (..., nao, nao, nao2, nao2)
+    half = torch.empty((*batch_shape, nao, nao, nao2, nao2), dtype=mat.dtype, device=mat.device)
+    blk_numel = nbatch * nao * nao * max(nao, nao2)
+    bs = max(1, config.CHUNK_MEMORY // (elsize * blk_numel))
+    for i0 in range(0, nao, bs):
+        i1 = min(i0 + bs, nao)
+        half[..., i0:i1, :, :, :] = coeffT @ mat[..., i0:i1, :, :, :] @ coeff
+    peak_numel = mat.numel() + half.numel() + 2 * min(bs, nao) * blk_numel
+
+    # transform the first two indices: (..., nao2, nao2, nao2, nao2)
+    res = torch.empty((*batch_shape, nao2, nao2, nao2, nao2), dtype=mat.dtype, device=mat.device)
+    blk_numel = nbatch * nao2 * nao * max(nao, nao2)
+    bs = max(1, config.CHUNK_MEMORY // (elsize * blk_numel))
+    for p0 in range(0, nao2, bs):
+        p1 = min(p0 + bs, nao2)
+        # move the untransformed indices to the last to make them as matrices
+        blk = torch.movedim(half[..., p0:p1, :], (-4, -3), (-2, -1))  # (..., np, nao2, nao, nao)
+        blk = coeffT @ blk @ coeff  # (..., np, nao2, nao2, nao2)
+        res[..., p0:p1, :] = torch.movedim(blk, (-2, -1), (-4, -3))
+    peak_numel = max(peak_numel, mat.numel() + half.numel() + res.numel() +
+                     3 * min(bs, nao2) * blk_numel)
+    return res, peak_numel * elsize
+
+def _quarter_transform_s8(packed: torch.Tensor, coeff: torch.Tensor) -> Tuple[torch.Tensor, int]:
+    # the same as _quarter_transform, but for the 8-fold symmetry packed matrix
+    # (see dqc.hamilton.intor.packed) which returns the packed matrix
+    # the symmetry is used by transforming only the pairs with i >= j in the first
+    # half-transformation and only the pairs with p >= q in the second
+    # half-transformation, and the full matrix is never constructed
+    # packed: (..., npair * (npair + 1) // 2)
+    # coeff: (nao, nao2)
+    # returns the transformed packed matrix (..., npair2 * (npair2 + 1) // 2) and
+    # the peak memory of the arrays in bytes
+    nao, nao2 = coeff.shape
+    npair = nao * (nao + 1) // 2
+    npair2 = nao2 * (nao2 + 1) // 2
+    batch_shape = packed.shape[:-1]
+    nbatch = packed.numel() // (npair * (npair + 1) // 2)
+    elsize = packed.element_size()
+    coeffT = coeff.transpose(-2, -1)
+    pidx = get_pair_index(nao, device=packed.device)  # (nao, nao)
+    tril2 = torch.tril_indices(nao2, nao2, device=packed.device)  # (2, npair2)
+
+    # transform the ket pair for every bra pair ij: (..., npair, npair2)
+    half = torch.empty((*batch_shape, npair, npair2), dtype=packed.dtype, device=packed.device)
+    blk_numel = nbatch * nao * max(nao, nao2)
+    bs = max(1, config.CHUNK_MEMORY // (elsize * blk_numel))
+    for r0 in range(0, npair, bs):
+        r1 = min(r0 + bs, npair)
+        blk = get_s8_rows(packed, r0, r1)[..., pidx]  # (..., nr, nao, nao)
+        blk = coeffT @ blk @ coeff  # (..., nr, nao2, nao2)
+        half[..., r0:r1, :] = blk[..., tril2[0], tril2[1]]
+    peak_numel = packed.numel() + half.numel() + 3 * min(bs, npair) * blk_numel
+
+    # transform the bra pair for every transformed ket pair pq, and only
+    # store the elements with mn <= pq: (..., npair2 * (npair2 + 1) // 2)
+    res = torch.empty((*batch_shape, npair2 * (npair2 + 1) // 2), dtype=packed.dtype,
+                      device=packed.device)
+    blk_numel = nbatch * nao * max(nao, nao2)
+    bs = max(1, config.CHUNK_MEMORY // (elsize * blk_numel))
+    cols = torch.arange(npair2, dtype=torch.long, device=packed.device)
+    for c0 in range(0, npair2, bs):
+        c1 = min(c0 + bs, npair2)
+        blk = torch.movedim(half[..., c0:c1][..., pidx, :], -1, -3)  # (..., nc, nao, nao)
+        blk = coeffT @ blk @ coeff  # (..., nc, nao2, nao2)
+        blk = blk[..., tril2[0], tril2[1]]  # (..., nc, npair2)
+        # the rows c0:c1 of the lower triangle are contiguous in the packed array
+        mask = cols[None, :] <= cols[c0:c1, None]  # (nc, npair2)
+        res[..., c0 * (c0 + 1) // 2:c1 * (c1 + 1) // 2] = blk[..., mask]
+    peak_numel = max(peak_numel, packed.numel() + half.numel() + res.numel() +
+                     3 * min(bs, npair2) * blk_numel)
+    return res, peak_numel * elsize
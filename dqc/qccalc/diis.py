@@ -0,0 +1,226 @@
+from __future__ import annotations
+from typing import Callable, List, Optional, Tuple, Union
+import numpy as np
+import torch
+from dqc.utils.datastruct import SpinParam
+from dqc.utils.misc import logger
+
+# Pulay's DIIS (direct inversion in the iterative subspace) accelerator of the
+# self-consistent iterations on the Fock matrices (the self-consistent params)
+# with the commutator error FDS - SDF, hybridised with EDIIS (Kudin, Scuseria,
+# and Cances, J. Chem. Phys. 116, 8255 (2002)) or ADIIS (Hu and Yang,
+# J. Chem. Phys. 132, 054109 (2010)) far from convergence following Garza and
+# Scuseria, J. Chem. Phys. 137, 054110 (2012)
+# The matrices can be complex (e.g. the Fock matrices of the k-points of
+# periodic systems), where the traces are Re tr(A^H B) weighted by the k-points
+
+__all__ = ["diis_equilibrium"]
+
+# the commutator error above which only EDIIS/ADIIS is used, below
+# DIIS_ERR_LOW only DIIS is used, and the coefficients are interpolated in
+# between
+DIIS_ERR_HIGH = 1e-1
+DIIS_ERR_LOW = 1e-4
+
+def diis_equilibrium(scp0: torch.Tensor,
+                     scp2dm: Callable[[torch.Tensor], Union[torch.Tensor, SpinParam[torch.Tensor]]],
+                     dm2scp: Callable[[Union[torch.Tensor, SpinParam[torch.Tensor]]], torch.Tensor],
+                     ovlp: torch.Tensor,
+                     dm2energy: Optional[Callable[[Union[torch.Tensor, SpinParam[torch.Tensor]]],
+                                                  torch.Tensor]] = None,
+                     wkpts: Optional[torch.Tensor] = None,
+                     maxiter: int = 50,
+                     f_tol: float = 1e-8,
+                     diis_space: int = 8,
+                     hybrid: Optional[str] = "adiis") -> Tuple[torch.Tensor, int, float]:
+    """
+    Perform the self-consistent iterations with the DIIS accelerator and
+    returns the self-consistent parameter (i.e. the Fock matrix), the number
+    of iterations, and the final maximum absolute commutator error.
+    The iterations are stopped when the maximum absolute commutator error is
+    below ``f_tol``.
+    The commutator errors are printed in every iteration if ``config.VERBOSE``
+    is larger than 1.
+    The gradients are not propagated through the iterations, so the results
+    must be passed to ``xitorch.optimize.equilibrium`` to get the gradients.
+
+    Arguments
+    ---------
+    scp0: torch.Tensor
+        The initial self-consistent parameter with shape ``(nao, nao)`` or
+        ``(2, nao, nao)`` for the polarized case.
+    scp2dm: callable
+        Function to calculate the density matrix from the self-consistent
+        parameter.
+    dm2scp: callable
+        Function to calculate the self-consistent parameter from the density
+        matrix.
+    ovlp: torch.Tensor
+        The overlap matrix with shape ``(nao, nao)``, or ``(nkpts, nao, nao)``
+        for periodic systems.
+    dm2energy: callable or None
+        Function to calculate the energy from the density matrix.
+        Only required for ``hybrid="ediis"``.
+    wkpts: torch.Tensor or None
+        The weights of the k-points with shape ``(nkpts,)`` for periodic
+        systems, or None for isolated systems.
+    maxiter: int
+        The maximum number of iterations.
+    f_tol: float
+        The tolerance of the maximum absolute commutator error.
+    diis_space: int
+        The maximum number of the Fock matrices kept in the history.
+    hybrid: str or None
+        The method used far from convergence, ``"ediis"``, ``"adiis"``,
+        or None to use only DIIS.
+    """
+    assert diis_space >= 1
+    if hybrid not in ("ediis", "adiis", None):
+        raise ValueError("Unknown DIIS hybrid: %s. Options are: 'ediis', 'adiis', None" % hybrid)
+    if hybrid == "ediis" and dm2energy is None:
+        raise ValueError("dm2energy must be given for the EDIIS hybrid")
+
+    focks: List[torch.Tensor] = []
+    dms: List[torch.Tensor] = []
+    errs: List[torch.Tensor] = []
+    enes: List[float] = []
+
+    def trace_prod(a: List[torch.Tensor], b: List[torch.Tensor]) -> np.ndarray:
+        return _trace_prod(a, b, wkpts)
+
+    scp = scp0.detach()
+    errmax = float("inf")
+    with torch.no_grad():
+        for i in range(maxiter):
+            dm = scp2dm(scp)
+            fock = dm2scp(dm)
+            dmt = _dm2tensor(dm)  # same shape as the scp
+
+            # commutator error FDS - SDF, where SDF = (FDS)^H
+            fds = torch.matmul(fock, torch.matmul(dmt, ovlp))
+            err = fds - fds.transpose(-2, -1).conj()
+            errmax = float(err.abs().max())
+            logger.log("DIIS iter %3d: commutator error %.3e" % (i + 1, errmax), vlevel=1)
+            if errmax < f_tol:
+                return fock, i + 1, errmax
+
+            focks.append(fock)
+            dms.append(dmt)
+            errs.append(err)
+            if hybrid == "ediis":
+                assert dm2energy is not None
+                enes.append(float(dm2energy(dm)))
+            if len(focks) > diis_space:
+                focks.pop(0)
+                dms.pop(0)
+                errs.pop(0)
+                if hybrid == "ediis":
+                    enes.pop(0)
+
+            # get the extrapolation coefficients
+            if hybrid is None or errmax < DIIS_ERR_LOW:
+                coeffs = _get_diis_coeffs(errs, trace_prod)
+            else:
+                if hybrid == "ediis":
+                    coeffs_hyb = _get_ediis_coeffs(focks, dms, enes, trace_prod)
+                else:
+                    coeffs_hyb = _get_adiis_coeffs(focks, dms, trace_prod)
+                if errmax > DIIS_ERR_HIGH:
+                    coeffs = coeffs_hyb
+                else:
+                    w = errmax / DIIS_ERR_HIGH
+                    coeffs = w * coeffs_hyb + (1 - w) * _get_diis_coeffs(errs, trace_prod)
+
+            scp = sum([float(c) * f for (c, f) in zip(coeffs, focks)])
+
+    logger.log("DIIS does not converge after %d iterations" % maxiter)
+    return scp, maxiter, errmax
+
+def _dm2tensor(dm: Union[torch.Tensor, SpinParam[torch.Tensor]]) -> torch.Tensor:
+    # convert the density matrix into a tensor with the same shape as the scp
+    if isinstance(dm, SpinParam):
+        return torch.stack((dm.u, dm.d), dim=0)
+    return dm
+
+TraceProdType = Callable[[List[torch.Tensor], List[torch.Tensor]], np.ndarray]
+
+def _trace_prod(a: List[torch.Tensor], b: List[torch.Tensor],
+                wkpts: Optional[torch.Tensor] = None) -> np.ndarray:
+    # returns the matrix of Re tr(a_i^H b_j) summed over the spins and
+    # over the k-points weighted by wkpts (if given), which is tr(a_i b_j) for
+    # the Hermitian matrices
+    # a, b: list of (*, nkpts, nao, nao) or (*, nao, nao) matrices
+    # wkpts: (nkpts,)
+    if wkpts is not None:
+        a = [ai * wkpts.unsqueeze(-1).unsqueeze(-1) for ai in a]
+    amat = torch.stack([ai.reshape(-1) for ai in a], dim=0)
+    bmat = torch.stack([bi.reshape(-1) for bi in b], dim=0)
+    res = torch.matmul(amat.conj(), bmat.transpose(-2, -1)).real
+    return np.asarray(res.cpu(), dtype=np.float64)
+
+def _get_diis_coeffs(errs: List[torch.Tensor], trace_prod: TraceProdType) -> np.ndarray:
+    # minimize the norm of the extrapolated error with the coefficients that
+    # sum up to 1 by solving the Lagrangian equations
+    n = len(errs)
+    if n == 1:
+        return np.ones(1)
+    bmat = trace_prod(errs, errs)
+    # normalize to improve the conditioning of the equations
+    bmat = bmat / np.max(np.abs(np.diag(bmat)))
+    amat = np.zeros((n + 1, n + 1))
+    amat[:n, :n] = bmat
+    amat[:n, n] = -1
+    amat[n, :n] = -1
+    rhs = np.zeros(n + 1)
+    rhs[n] = -1
+    coeffs = np.linalg.lstsq(amat, rhs, rcond=None)[0][:n]
+    return coeffs
+
+def _get_ediis_coeffs(focks: List[torch.Tensor], dms: List[torch.Tensor],
+                      enes: List[float], trace_prod: TraceProdType) -> np.ndarray:
+    # minimize the interpolated energy of the density matrix
+    # E(c) = sum_i c_i E_i - 1/4 sum_ij c_i c_j tr((F_i - F_j)(D_i - D_j))
+    # within the simplex, where D is the total (or the spin) density matrix
+    fd = trace_prod(focks, dms)  # tr(F_i D_j)
+    diag = np.diag(fd)
+    amat = diag[:, None] + diag[None, :] - fd - fd.T
+    return _minimize_simplex(np.asarray(enes), -0.5 * amat)
+
+def _get_adiis_coeffs(focks: List[torch.Tensor], dms: List[torch.Tensor],
+                      trace_prod: TraceProdType) -> np.ndarray:
+    # minimize the second order expansion of the energy around the latest
+    # density matrix, D_n,
+    # E(c) = E_n + sum_i c_i tr(dD_i F_n) + 1/2 sum_ij c_i c_j tr(dD_i dF_j)
+    # within the simplex, where dD_i = D_i - D_n and dF_i = F_i - F_n
+    ddms = [dm - dms[-1] for dm in dms]
+    dfocks = [fock - focks[-1] for fock in focks]
+    grad = trace_prod(ddms, [focks[-1]])[:, 0]
+    hess = trace_prod(ddms, dfocks)
+    return _minimize_simplex(grad, 0.5 * (hess + hess.T))
+
+def _minimize_simplex(grad: np.ndarray, hess: np.ndarray, maxiter: int = 200) -> np.ndarray:
+    # minimize grad.c + 1/2 c.hess.c within the simplex (c_i >= 0, sum_i c_i = 1)
+    # with the projected gradient descent starting from the latest entry
+    n = grad.shape[0]
+    c = np.zeros(n)
+    c[-1] = 1.0
+    if n == 1:
+        return c
+    lipschitz = np.linalg.norm(hess, 2)
+    step = 1.0 / lipschitz if lipschitz > 0 else 1.0
+    for i in range(maxiter):
+        cnew = _project_simplex(c - step * (grad + np.dot(hess, c)))
+        if np.max(np.abs(cnew - c)) < 1e-10:
+            c = cnew
+            break
+        c = cnew
+    return c
+
+def _project_simplex(v: np.ndarray) -> np.ndarray:
+    # euclidean projection onto the simplex (Duchi et al., ICML (2008))
+    u = np.sort(v)[::-1]
+    css = np.cumsum(u) - 1
+    idx = np.arange(1, v.shape[0] + 1)
+    rho = np.nonzero(u - css / idx > 0)[0][-1]
+    theta = css[rho] / (rho + 1)
+    return np.maximum(v - theta, 0)
@@ -0,0 +1,281 @@
+from __future__ import annotations
+from typing import Dict, List, Sequence, Tuple, Union
+import warnings
+import torch
+import xitorch as xt
+from dqc.hamilton import intor
+from dqc.hamilton.hcgto import HamiltonCGTO
+from dqc.hamilton.hcgto_pbc import HamiltonCGTO_PBC
+from dqc.system.base_system import BaseSystem
+from dqc.qccalc.base_qccalc import BaseQCCalc
+from dqc.utils.datastruct import CGTOBasis, AtomCGTOBasis, SpinParam
+
+# initial guesses of the density matrix for the self-consistent iterations
+# built from the occupied orbitals of the free atoms with spherically averaged
+# occupations, which are calculated with restricted Hartree-Fock once for every
+# element and basis:
+# * "sad": superposition of the atomic density matrices
+# * "huckel": extended Huckel (generalized Wolfsberg-Helmholz) Hamiltonian in
+#   the minimal basis of the atomic orbitals with the atomic orbital energies
+#   (S. Lehtola, J. Chem. Theory Comput. 15, 1593 (2019))
+# and the warm-start guesses from the previous calculations, where the
+# occupied natural orbitals are projected onto the basis of the new system and
+# orthonormalized in the new metric
+# * a previous calculation: the projected density matrix
+# * a list of the previous calculations: the extrapolation of the projected
+#   density matrices with the coefficients that best reproduce the new
+#   atomic positions from the previous ones
+
+__all__ = ["get_sad_dm", "get_huckel_dm", "get_projected_dm", "get_extrapolated_dm"]
+
+# threshold of the eigenvalues of the overlap matrices and the occupation
+# numbers to be considered as non-zero
+PROJ_EIG_THRESHOLD = 1e-6
+PROJ_OCC_THRESHOLD = 1e-10
+
+# Wolfsberg-Helmholz constant
+HUCKEL_K = 1.75
+
+# the order of the atomic shells, (n, l), in the aufbau principle
+AUFBAU_SHELLS = [(1, 0), (2, 0), (2, 1), (3, 0), (3, 1), (4, 0), (3, 2), (4, 1),
+                 (5, 0), (4, 2), (5, 1), (6, 0), (4, 3), (5, 2), (6, 1), (7, 0),
+                 (5, 3), (6, 2), (7, 1)]
+
+# cache of the atomic orbitals, occupations, and orbital energies
+_ATOM_GUESS: Dict[Tuple, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]] = {}
+
+def get_sad_dm(system: BaseSystem, polarized: bool) -> Union[torch.Tensor, SpinParam[torch.Tensor]]:
+    """
+    Returns the superposition of the atomic density matrices of the system
+    in the basis used by the system's Hamiltonian, normalized to the number of
+    electrons of the system.
+    """
+    with torch.no_grad():
+        orbs, weights, _ = _get_atom_orbs(system)
+        weights = weights * (float(system.numel) / float(weights.sum()))
+        ao_orbs = system.get_hamiltonian().raw_orb2ao_orb(orbs)
+        dm = system.get_hamiltonian().ao_orb2dm(ao_orbs, weights)
+    if polarized:
+        return SpinParam(u=dm * 0.5, d=dm * 0.5)
+    return dm
+
+def get_huckel_dm(system: BaseSystem, polarized: bool) -> Union[torch.Tensor, SpinParam[torch.Tensor]]:
+    """
+    Returns the density matrix of the system's occupied orbitals of the
+    extended Huckel Hamiltonian in the minimal basis of the atomic orbitals
+    in the basis used by the system's Hamiltonian.
+    """
+    with torch.no_grad():
+        orbs, _, eorbs = _get_atom_orbs(system)
+        hamilton = system.get_hamiltonian()
+        ao_orbs = hamilton.raw_orb2ao_orb(orbs)  # (*BH, nao, nmin)
+        ovlp = hamilton.get_overlap().fullmatrix()  # (*BH, nao, nao)
+
+        # the Huckel Hamiltonian in the minimal basis
+        ao_orbs_h = ao_orbs.transpose(-2, -1).conj()
+        ovlp_min = torch.matmul(ao_orbs_h, torch.matmul(ovlp, ao_orbs))  # (*BH, nmin, nmin)
+        eavg = (eorbs.unsqueeze(-1) + eorbs.unsqueeze(-2)) * 0.5  # (nmin, nmin)
+        fac = torch.full_like(eavg, HUCKEL_K)
+        fac.diagonal().fill_(1.0)
+        hmin = ovlp_min * (fac * eavg).to(ovlp_min.dtype)
+
+        # solve the generalized eigenvalue problem by the canonical
+        # orthogonalization of the minimal basis
+        ovlp_eival, ovlp_eivec = torch.linalg.eigh(ovlp_min)
+        xmin = ovlp_eivec * ovlp_eival.unsqueeze(-2) ** (-0.5)  # (*BH, nmin, nmin)
+        hmin2 = torch.matmul(xmin.transpose(-2, -1).conj(), torch.matmul(hmin, xmin))
+        _, eivecs = torch.linalg.eigh(hmin2)
+        mo_orbs = torch.matmul(ao_orbs, torch.matmul(xmin, eivecs))  # (*BH, nao, nmin)
+
+        orb_weights = system.get_orbweight(polarized=polarized)
+        nmin = mo_orbs.shape[-1]
+
+        def get_dm(orb_weight: torch.Tensor) -> torch.Tensor:
+            norb = orb_weight.shape[-1]
+            if norb > nmin:
+                raise RuntimeError("The Huckel guess requires %d orbitals, but there are only %d "
+                                   "atomic orbitals in the minimal basis. Please use the 'sad' "
+                                   "guess instead." % (norb, nmin))
+            return hamilton.ao_orb2dm(mo_orbs[..., :norb], orb_weight)
+
+        dm = SpinParam.apply_fcn(get_dm, orb_weights)
+    return dm
+
+def get_projected_dm(qc: BaseQCCalc, system: BaseSystem,
+                     polarized: bool) -> Union[torch.Tensor, SpinParam[torch.Tensor]]:
+    """
+    Returns the density matrix of the previous calculation projected onto the
+    basis used by the system's Hamiltonian.
+    The system can have different atomic positions, basis, or orthogonalizer
+    than the system of the previous calculation.
+    Only available for the isolated molecules.
+    """
+    with torch.no_grad():
+        dm = _project_dm(qc, system)
+    return _set_polarization(dm, polarized)
+
+def get_extrapolated_dm(qcs: Sequence[BaseQCCalc], system: BaseSystem,
+                        polarized: bool) -> Union[torch.Tensor, SpinParam[torch.Tensor]]:
+    """
+    Returns the density matrix extrapolated from the previous calculations
+    (ordered from the oldest to the latest) with different atomic positions.
+    The density matrices are projected onto the basis used by the system's
+    Hamiltonian and combined with the coefficients, ``c``, that sum up to 1
+    and minimize ``|R - sum_i c_i R_i|``, where ``R`` are the atomic positions.
+    If the previous systems have different number of atoms, only the latest
+    calculation is used.
+    """
+    assert len(qcs) > 0
+    atompos = system.atompos.detach().reshape(-1)
+    prev_atompos = [qc.get_system().atompos.detach().reshape(-1) for qc in qcs]
+    if len(qcs) == 1 or any([pos.shape != atompos.shape for pos in prev_atompos]):
+        return get_projected_dm(qcs[-1], system, polarized)
+
+    # get the coefficients relative to the latest calculation
+    amat = torch.stack([pos - prev_atompos[-1] for pos in prev_atompos[:-1]], dim=-1)  # (natoms * ndim, nqcs - 1)
+    bvec = atompos - prev_atompos[-1]  # (natoms * ndim,)
+    coeffs = torch.matmul(torch.linalg.pinv(amat), bvec)  # (nqcs - 1,)
+    coeffs = torch.cat((coeffs, 1 - coeffs.sum(dim=0, keepdim=True)), dim=0)  # (nqcs,)
+
+    dms = [get_projected_dm(qc, system, polarized) for qc in qcs]
+    dm = SpinParam.apply_fcn(lambda dm: dm * coeffs[0], dms[0])
+    for (c, dmi) in zip(coeffs[1:], dms[1:]):
+        dm = SpinParam.apply_fcn(lambda dm, dmi: dm + dmi * c, dm, dmi)
+    return dm
+
+def _project_dm(qc: BaseQCCalc, system: BaseSystem) -> Union[torch.Tensor, SpinParam[torch.Tensor]]:
+    # project the density matrix of the previous calculation by projecting its
+    # occupied natural orbitals onto the new basis
+    h_old = qc.get_system().get_hamiltonian()
+    h_new = system.get_hamiltonian()
+    # HamiltonCGTO_PBC is a subclass of HamiltonCGTO, so it is checked first
+    if isinstance(h_old, HamiltonCGTO_PBC) or isinstance(h_new, HamiltonCGTO_PBC):
+        raise NotImplementedError("Projecting the density matrix is not implemented for periodic systems")
+    if not isinstance(h_old, HamiltonCGTO) or not isinstance(h_new, HamiltonCGTO):
+        raise NotImplementedError("Projecting the density matrix is only implemented for molecules")
+
+    # projection from the old raw basis to the new raw basis, pinv(S_new) @ S_cross
+    wrap_new, wrap_old = intor.LibcintWrapper.concatenate(h_new.libcint_wrapper, h_old.libcint_wrapper)
+    ovlp_cross = intor.overlap(wrap_new, wrap_old)  # (nao_raw_new, nao_raw_old)
+    ovlp_new_raw = intor.overlap(wrap_new)  # (nao_raw_new, nao_raw_new)
+    eival, eivec = torch.linalg.eigh(ovlp_new_raw)
+    idx = eival > PROJ_EIG_THRESHOLD
+    proj = torch.matmul(eivec[:, idx] / eival[idx], torch.matmul(eivec[:, idx].T, ovlp_cross))
+
+    ovlp_old = h_old.get_overlap().fullmatrix()
+    ovlp_new = h_new.get_overlap().fullmatrix()
+
+    def project(dm: torch.Tensor) -> torch.Tensor:
+        orbs, occ = _get_natural_orbs(dm.detach(), ovlp_old)
+        orbs_new = h_new.raw_orb2ao_orb(torch.matmul(proj, h_old.ao_orb2raw_orb(orbs)))
+        orbs_new = _orthonormalize(orbs_new, ovlp_new)
+        return h_new.ao_orb2dm(orbs_new, occ)
+
+    return SpinParam.apply_fcn(project, qc.aodm())
+
+def _get_natural_orbs(dm: torch.Tensor, ovlp: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    # returns the natural orbitals (nao, nocc) with non-zero occupations and
+    # the occupation numbers (nocc,) of the density matrix in the metric ovlp
+    eival, eivec = torch.linalg.eigh(ovlp)
+    ovlp_sqrt = torch.matmul(eivec * eival.sqrt(), eivec.T)
+    ovlp_isqrt = torch.matmul(eivec / eival.sqrt(), eivec.T)
+    occ, orbs = torch.linalg.eigh(torch.matmul(ovlp_sqrt, torch.matmul(dm, ovlp_sqrt)))
+    idx = occ > PROJ_OCC_THRESHOLD
+    return torch.matmul(ovlp_isqrt, orbs[:, idx]), occ[idx]
+
+def _orthonormalize(orbs: torch.Tensor, ovlp: torch.Tensor) -> torch.Tensor:
+    # symmetric (Lowdin) orthonormalization of the orbitals (nao, norb) in the
+    # metric ovlp, the orbitals that are lost in the projection are zeroed
+    orbs_ovlp = torch.matmul(orbs.T, torch.matmul(ovlp, orbs))  # (norb, norb)
+    eival, eivec = torch.linalg.eigh(orbs_ovlp)
+    idx = eival > PROJ_EIG_THRESHOLD
+    isqrt = torch.matmul(eivec[:, idx] / eival[idx].sqrt(), eivec[:, idx].T)
+    return torch.matmul(orbs, isqrt)
+
+def _set_polarization(dm: Union[torch.Tensor, SpinParam[torch.Tensor]],
+                      polarized: bool) -> Union[torch.Tensor, SpinParam[torch.Tensor]]:
+    # convert the density matrix into a SpinParam if polarized or a tensor if not
+    if isinstance(dm, torch.Tensor) and polarized:
+        return SpinParam(u=dm * 0.5, d=dm * 0.5)
+    elif isinstance(dm, SpinParam) and not polarized:
+        return dm.u + dm.d
+    return dm
+
+def _get_atom_orbs(system: BaseSystem) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # returns the occupied orbitals of the free atoms as the block-diagonal
+    # coefficients in the raw basis of the system (nao_raw, nmin), their
+    # occupations (nmin,), and their energies (nmin,)
+    orbs_list: List[torch.Tensor] = []
+    weights_list: List[torch.Tensor] = []
+    eorbs_list: List[torch.Tensor] = []
+    for atb in system.atombases:
+        orbs, weights, eorbs = _get_atom_guess(atb)
+        orbs_list.append(orbs)
+        weights_list.append(weights)
+        eorbs_list.append(eorbs)
+    orbs = torch.block_diag(*orbs_list)
+    return orbs, torch.cat(weights_list), torch.cat(eorbs_list)
+
+def _get_atom_guess(atb: AtomCGTOBasis) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # returns the occupied orbitals (nao_atom, nmin_atom), the occupations
+    # (nmin_atom,), and the orbital energies (nmin_atom,) of the free atom,
+    # cached for every element, basis, dtype, and device
+    atomz = int(round(float(atb.atomz)))
+    dtype = atb.pos.dtype
+    device = atb.pos.device
+    key = (atomz, tuple((bas.angmom, tuple(bas.alphas.tolist()), tuple(bas.coeffs.tolist()),
+                         bas.normalized) for bas in atb.bases), dtype, device)
+    if key not in _ATOM_GUESS:
+        _ATOM_GUESS[key] = _calc_atom_guess(atomz, atb.bases, dtype, device)
+    return _ATOM_GUESS[key]
+
+def _calc_atom_guess(atomz: int, bases: List[CGTOBasis], dtype: torch.dtype,
+                     device: torch.device) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # restricted Hartree-Fock calculation of the free atom with the spherically
+    # averaged occupations of the atomic shells
+    # NOTE: the imports are here to avoid the circular imports
+    from dqc.system.mol import Mol
+    from dqc.qccalc.hf import _HFEngine
+    from dqc.qccalc.diis import diis_equilibrium
+
+    bases = [CGTOBasis(angmom=bas.angmom, alphas=bas.alphas.detach(),
+                       coeffs=bas.coeffs.detach(), normalized=bas.normalized)
+             for bas in bases]
+    nao = sum([2 * bas.angmom + 1 for bas in bases])
+    weights = _get_shell_occupations(atomz, dtype, device)[:nao]
+    if atomz <= 0 or weights.shape[0] == 0:
+        empty = torch.zeros((0,), dtype=dtype, device=device)
+        return torch.zeros((nao, 0), dtype=dtype, device=device), empty, empty
+
+    atompos = torch.zeros((1, 3), dtype=dtype, device=device)
+    mol = Mol(([atomz], atompos), basis=[bases], orthogonalize_basis=False,
+              orb_weights=SpinParam(u=weights * 0.5, d=weights * 0.5),
+              dtype=dtype, device=device)
+    engine = _HFEngine(mol, restricted=True)
+    engine.set_eigen_options({"method": "exacteig"})
+    norb = weights.shape[0]
+    with torch.no_grad(), warnings.catch_warnings():
+        # the atomic density does not need to be fully converged
+        warnings.simplefilter("ignore")
+        scp0 = engine.dm2scp(torch.zeros(engine.shape, dtype=dtype, device=device))
+        ovlp = mol.get_hamiltonian().get_overlap().fullmatrix()
+        fock, _, _ = diis_equilibrium(scp0, engine.scp2dm, engine.dm2scp, ovlp,
+                                      maxiter=100, f_tol=1e-6)
+        fock = (fock + fock.transpose(-2, -1)) * 0.5
+        eorbs, orbs = engine.diagonalize(xt.LinearOperator.m(fock, is_hermitian=True), norb)
+    return orbs, weights, eorbs
+
+def _get_shell_occupations(atomz: int, dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+    # returns the spherically averaged occupations of the orbitals of the
+    # neutral atom following the aufbau principle, where the electrons of a
+    # partially filled shell are distributed equally among its orbitals
+    nelec = atomz
+    weights: List[float] = []
+    for (_, l) in AUFBAU_SHELLS:
+        if nelec <= 0:
+            break
+        ndeg = 2 * l + 1
+        nocc = min(nelec, 2 * ndeg)
+        weights.extend([nocc / ndeg] * ndeg)
+        nelec -= nocc
+    return torch.tensor(weights, dtype=dtype, device=device)
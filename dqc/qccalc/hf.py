@@ -6,6 +6,7 @@ import xitorch.optimize
 from dqc.system.base_system import BaseSystem
 from dqc.qccalc.scf_qccalc import SCF_QCCalc, BaseSCFEngine
 from dqc.utils.datastruct import SpinParam
+from dqc.utils.davidson import davidson
 
 __all__ = ["HF"]
 
@@ -68,6 +69,10 @@ class _HFEngine(BaseSCFEngine):
         # set up the 1-electron linear operator
         self._core1e_linop = self._hamilton.get_kinnucl()  # kinetic and nuclear
 
+        # eigenvectors from the previous diagonalization to warm-start the
+        # iterative eigensolver
+        self._prev_eivecs: Dict[str, torch.Tensor] = {}
+
     def get_system(self) -> BaseSystem:
         return self._system
 
@@ -195,10 +200,23 @@ class _HFEngine(BaseSCFEngine):
     def __dm2vhf(self, dm):
         # from density matrix, returns the linear operator on electron-electron
         # coulomb and exchange
-        elrep = self._hamilton.get_elrep(SpinParam.sum(dm))
-        exch = self._hamilton.get_exchange(dm)
-        vhf = SpinParam.apply_fcn(lambda exch: elrep + exch, exch)
-        return vhf
+        # the coulomb and exchange operators are obtained together in one pass
+        if isinstance(dm, torch.Tensor):
+            elrep, exch = self._hamilton.get_jk(dm)
+            assert elrep is not None and exch is not None
+            return elrep + exch
+        else:
+            # the density matrices of both spins are built in one batch, where the
+            # coulomb operator is linear in dm and the exchange operator uses its
+            # spin-scaling property, i.e. exch(2 * dm_s) = 2 * exch(dm_s)
+            elrep, exch = self._hamilton.get_jk(torch.stack((dm.u, dm.d), dim=0))
+            assert elrep is not None and exch is not None
+            elrep_mat = elrep.fullmatrix()
+            exch_mat = exch.fullmatrix()
+            elrep_tot = elrep_mat[0] + elrep_mat[1]
+            return SpinParam(
+                u=xt.LinearOperator.m(elrep_tot + 2 * exch_mat[0], is_hermitian=True),
+                d=xt.LinearOperator.m(elrep_tot + 2 * exch_mat[1], is_hermitian=True))
 
     @overload
     def __fock2dm(self, fock: xt.LinearOperator) -> torch.Tensor:
@@ -228,23 +246,33 @@ class _HFEngine(BaseSCFEngine):
         ovlp = self._hamilton.get_overlap()
         if isinstance(fock, SpinParam):
             assert isinstance(self._norb, SpinParam)
-            eivals_u, eivecs_u = xitorch.linalg.lsymeig(
-                A=fock.u,
-                neig=norb.u,
-                M=ovlp,
-                **self.eigen_options)
-            eivals_d, eivecs_d = xitorch.linalg.lsymeig(
-                A=fock.d,
-                neig=norb.d,
-                M=ovlp,
-                **self.eigen_options)
+            eivals_u, eivecs_u = self.__lsymeig(fock.u, norb.u, ovlp, "u")
+            eivals_d, eivecs_d = self.__lsymeig(fock.d, norb.d, ovlp, "d")
             return SpinParam(u=eivals_u, d=eivals_d), SpinParam(u=eivecs_u, d=eivecs_d)
         else:
-            return xitorch.linalg.lsymeig(
-                A=fock,
-                neig=norb,
-                M=ovlp,
-                **self.eigen_options)
+            return self.__lsymeig(fock, norb, ovlp, "")
+
+    def __lsymeig(self, fock: xt.LinearOperator, norb: int, ovlp: xt.LinearOperator,
+                  key: str) -> Tuple[torch.Tensor, torch.Tensor]:
+        # "davidson" uses dqc's Davidson eigensolver starting from the
+        # eigenvectors of the previous diagonalization, it is passed as the
+        # method of lsymeig to keep the implicit gradients
+        eigen_options = self.eigen_options
+        use_davidson = eigen_options.get("method", None) == "davidson"
+        if use_davidson:
+            eigen_options = {**eigen_options, "method": davidson}
+            prev_eivecs = self._prev_eivecs.get(key, None)
+            if prev_eivecs is not None and prev_eivecs.shape[-2] == fock.shape[-1] and \
+                    "v_init" not in self.eigen_options:
+                eigen_options["v_init"] = prev_eivecs
+        eivals, eivecs = xitorch.linalg.lsymeig(
+            A=fock,
+            neig=norb,
+            M=ovlp,
+            **eigen_options)
+        if use_davidson:
+            self._prev_eivecs[key] = eivecs.detach()
+        return eivals, eivecs
 
     def getparamnames(self, methodname: str, prefix: str = "") -> List[str]:
         if methodname == "scp2scp":
@@ -288,8 +316,7 @@ class _HFEngine(BaseSCFEngine):
                 self.getparamnames("__dm2vhf", prefix=prefix)
         elif methodname == "__dm2vhf":
             hprefix = prefix + "_hamilton."
-            return self._hamilton.getparamnames("get_elrep", prefix=hprefix) + \
-                self._hamilton.getparamnames("get_exchange", prefix=hprefix)
+            return self._hamilton.getparamnames("get_jk", prefix=hprefix)
         elif methodname == "diagonalize":
             return self._hamilton.getparamnames("get_overlap", prefix=prefix + "_hamilton.")
         else:
@@ -7,6 +7,7 @@ from dqc.system.base_system import BaseSystem
 from dqc.qccalc.scf_qccalc import SCF_QCCalc, BaseSCFEngine
 from dqc.qccalc.hf import _HFEngine
 from dqc.xc.base_xc import BaseXC
+from dqc.grid.base_grid import BaseGrid
 from dqc.api.getxc import get_xc
 from dqc.utils.datastruct import SpinParam
 
@@ -32,14 +33,25 @@ class KS(SCF_QCCalc):
         If True, then solve the Kohn-Sham equation variationally (i.e. using
         optimization) instead of using self-consistent iteration.
         Otherwise, solve it using self-consistent iteration.
+    coarse_grid: int, str, or None
+        If given, the early self-consistent iterations are run on this
+        (cheaper) grid, e.g. ``"sg2"`` or ``1``, before switching to the
+        system's grid. The final energy and gradients are from the system's
+        grid. It is not used if the system requires the grid (e.g. with an
+        external potential) or there is no xc.
+    coarse_grid_tol: float
+        The maximum absolute residual of the self-consistent iterations on the
+        coarse grid before switching to the system's grid.
     """
 
     def __init__(self, system: BaseSystem, xc: Union[str, BaseXC, None],
                  restricted: Optional[bool] = None,
-                 variational: bool = False):
+                 variational: bool = False,
+                 coarse_grid: Optional[Union[int, str]] = None,
+                 coarse_grid_tol: float = 1e-3):
 
-        engine = _KSEngine(system, xc)
-        super().__init__(engine, variational)
+        engine = _KSEngine(system, xc, coarse_grid=coarse_grid)
+        super().__init__(engine, variational, coarse_grid_tol=coarse_grid_tol)
 
 class _KSEngine(BaseSCFEngine):
     """
@@ -53,7 +65,8 @@ class _KSEngine(BaseSCFEngine):
     self-consistent iteration is performed.
     """
     def __init__(self, system: BaseSystem, xc: Union[str, BaseXC, None],
-                 restricted: Optional[bool] = None):
+                 restricted: Optional[bool] = None,
+                 coarse_grid: Optional[Union[int, str]] = None):
 
         # get the xc object
         if isinstance(xc, str):
@@ -67,10 +80,19 @@ class _KSEngine(BaseSCFEngine):
         self._system = system
 
         # build and setup basis and grid
+        # if the coarse grid is used, the system's grid is only constructed
+        # when the engine switches to it
         self.hamilton = system.get_hamiltonian()
-        if self.xc is not None or system.requires_grid():
+        self._coarse_grid: Optional[BaseGrid] = None
+        self._use_coarse_grid = False
+        if self.xc is not None and coarse_grid is not None and not system.requires_grid():
+            self._coarse_grid = system.build_grid(coarse_grid)
+            self._use_coarse_grid = True
+            self.hamilton.setup_grid(self._coarse_grid, self.xc)
+        elif self.xc is not None or system.requires_grid():
             system.setup_grid()
             self.hamilton.setup_grid(system.get_grid(), self.xc)
+        self._final_grid_setup = not self._use_coarse_grid
 
         # get the HF engine and build the hamiltonian
         # no need to rebuild the grid because it has been constructed
@@ -154,8 +176,27 @@ class _KSEngine(BaseSCFEngine):
         # set the eigendecomposition (diagonalization) option
         self.hf_engine.set_eigen_options(eigen_options)
 
+    def set_coarse_grid(self, coarse: bool) -> bool:
+        # switch the grid of the hamiltonian between the coarse and the final grid
+        if self._coarse_grid is None:
+            return False
+        if coarse != self._use_coarse_grid:
+            if coarse:
+                grid = self._coarse_grid
+            else:
+                if not self._final_grid_setup:
+                    self._system.setup_grid()
+                    self._final_grid_setup = True
+                grid = self._system.get_grid()
+            self.hamilton.setup_grid(grid, self.xc)
+            self._use_coarse_grid = coarse
+        return True
+
     def dm2energy(self, dm: Union[torch.Tensor, SpinParam[torch.Tensor]]) -> torch.Tensor:
         # calculate the energy given the density matrix
+        # the energy is calculated on the current grid, which is the final grid
+        # except during the coarse stage of run() (e.g. for EDIIS), after which
+        # the final grid is always restored
         dmtot = SpinParam.sum(dm)
         e_core = self.hamilton.get_e_hcore(dmtot)
         e_elrep = self.hamilton.get_e_elrep(dmtot)
@@ -0,0 +1,209 @@
+from __future__ import annotations
+from typing import Callable, List, Tuple, Union
+import warnings
+import torch
+from dqc.utils.datastruct import SpinParam
+from dqc.utils.misc import logger
+
+# quasi-Newton (L-BFGS) minimization of the energy over the orbital rotations,
+# C(kappa) = C exp(K(kappa)), where K is the antisymmetric matrix of the
+# non-redundant rotations between the orbitals with different occupations.
+# The rotations are re-anchored at the current orbitals in every iteration,
+# the Hessian is approximated by the orbital energy differences as the
+# initial inverse Hessian of L-BFGS, and the steps are limited by a trust
+# region radius updated from the ratio of the actual energy change and the one
+# predicted by the same L-BFGS quadratic model.
+# With F = dE/dD (i.e. the Fock matrix), the gradient and the approximate
+# diagonal Hessian w.r.t. the rotation between orbitals p and q are
+#   g_pq = 2 (w_p - w_q) F_pq
+#   h_pq = 2 (w_p - w_q) (F_qq - F_pp)
+
+__all__ = ["orbrot_minimize"]
+
+# the minimum value of the approximate diagonal Hessian
+ORBROT_HDIAG_MIN = 1e-2
+
+DMType = Union[torch.Tensor, SpinParam[torch.Tensor]]
+
+def orbrot_minimize(dm0: DMType,
+                    dm2energy: Callable[[DMType], torch.Tensor],
+                    dm2fock: Callable[[DMType], torch.Tensor],
+                    ao_orb2dm: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                    ovlp: torch.Tensor,
+                    orb_weight: Union[torch.Tensor, SpinParam[torch.Tensor]],
+                    maxiter: int = 200,
+                    g_tol: float = 1e-7,
+                    trust_radius: float = 0.5,
+                    max_trust_radius: float = 2.0,
+                    history: int = 10) -> DMType:
+    """
+    Minimize the energy w.r.t. the orbital rotations starting from the
+    canonical orbitals of the density matrix ``dm0`` and returns the density
+    matrix at the minimum.
+    The gradients are not propagated through the iterations.
+    The energy and the gradient are printed in every iteration if
+    ``config.VERBOSE`` is larger than 1.
+
+    Arguments
+    ---------
+    dm0: torch.Tensor or SpinParam[torch.Tensor]
+        The initial density matrix.
+    dm2energy: callable
+        Function to calculate the energy from the density matrix.
+    dm2fock: callable
+        Function to calculate the derivative of the energy w.r.t. the density
+        matrix (i.e. the Fock matrix), concatenated for both spins if polarized.
+    ao_orb2dm: callable
+        Function to calculate the density matrix from the orbitals and their
+        weights.
+    ovlp: torch.Tensor
+        The overlap matrix with shape ``(nao, nao)``.
+    orb_weight: torch.Tensor or SpinParam[torch.Tensor]
+        The occupations of the orbitals, ``(norb,)`` for every spin.
+    maxiter: int
+        The maximum number of iterations.
+    g_tol: float
+        The tolerance of the maximum absolute gradient.
+    trust_radius: float
+        The initial trust radius of the rotation parameters.
+    max_trust_radius: float
+        The maximum trust radius of the rotation parameters.
+    history: int
+        The number of the previous steps kept in L-BFGS.
+    """
+    polarized = isinstance(dm0, SpinParam)
+    weights: List[torch.Tensor] = [orb_weight.u, orb_weight.d] \
+        if isinstance(orb_weight, SpinParam) else [orb_weight]
+    if ovlp.is_complex():
+        raise NotImplementedError("Orbital rotations are only implemented for real orbitals")
+
+    with torch.no_grad():
+        dm0 = SpinParam.apply_fcn(lambda dm: dm.detach(), dm0)
+
+        # the initial orbitals are the canonical orbitals of the initial density
+        ovlp_eival, ovlp_eivec = torch.linalg.eigh(ovlp)
+        ovlp_isqrt = torch.matmul(ovlp_eivec * ovlp_eival.rsqrt(), ovlp_eivec.T)
+        orbs: List[torch.Tensor] = []
+        for fock in _split_fock(dm2fock(dm0), polarized):
+            _, eivec = torch.linalg.eigh(torch.matmul(ovlp_isqrt, torch.matmul(fock, ovlp_isqrt)))
+            orbs.append(torch.matmul(ovlp_isqrt, eivec))  # (nao, nmo)
+
+        # the non-redundant rotations are between orbitals with different weights
+        nmo = orbs[0].shape[-1]
+        wfulls: List[torch.Tensor] = []
+        pairs: List[Tuple[torch.Tensor, torch.Tensor]] = []
+        for w in weights:
+            wfull = torch.zeros((nmo,), dtype=ovlp.dtype, device=ovlp.device)
+            wfull[:w.shape[-1]] = w
+            ip, iq = torch.triu_indices(nmo, nmo, offset=1, device=ovlp.device)
+            nonredundant = (wfull[ip] - wfull[iq]).abs() > 1e-12
+            wfulls.append(wfull)
+            pairs.append((ip[nonredundant], iq[nonredundant]))
+
+        def orbs2dm(orbs: List[torch.Tensor]) -> DMType:
+            dms = [ao_orb2dm(orb[:, :w.shape[-1]], w) for (orb, w) in zip(orbs, weights)]
+            return SpinParam(u=dms[0], d=dms[1]) if polarized else dms[0]
+
+        def get_grad(orbs: List[torch.Tensor], dm: DMType) -> Tuple[torch.Tensor, torch.Tensor]:
+            # returns the gradient and the approximate diagonal Hessian
+            grads = []
+            hdiags = []
+            for (orb, fock, wfull, (ip, iq)) in zip(orbs, _split_fock(dm2fock(dm), polarized),
+                                                    wfulls, pairs):
+                fmo = torch.matmul(orb.T, torch.matmul(fock, orb))
+                dw = wfull[ip] - wfull[iq]
+                grads.append(2 * dw * fmo[ip, iq])
+                hdiags.append(2 * dw * (fmo[iq, iq] - fmo[ip, ip]))
+            return torch.cat(grads), torch.cat(hdiags).clamp(min=ORBROT_HDIAG_MIN)
+
+        def rotate(orbs: List[torch.Tensor], kappa: torch.Tensor) -> List[torch.Tensor]:
+            # rotate the orbitals, C exp(K), where K_qp = kappa_pq = -K_pq
+            res = []
+            i0 = 0
+            for (orb, (ip, iq)) in zip(orbs, pairs):
+                kmat = torch.zeros((nmo, nmo), dtype=orb.dtype, device=orb.device)
+                kmat[iq, ip] = kappa[i0:i0 + ip.shape[0]]
+                kmat = kmat - kmat.T
+                res.append(torch.matmul(orb, torch.matrix_exp(kmat)))
+                i0 += ip.shape[0]
+            return res
+
+        dm = orbs2dm(orbs)
+        ene = float(dm2energy(dm))
+        grad, hdiag = get_grad(orbs, dm)
+        svecs: List[torch.Tensor] = []
+        yvecs: List[torch.Tensor] = []
+        gmax = float("inf")
+        for i in range(maxiter):
+            gmax = float(grad.abs().max()) if grad.numel() > 0 else 0.0
+            logger.log("Orbital rotation iter %3d: energy %.12e, max gradient %.3e, trust radius %.3e" %
+                       (i + 1, ene, gmax, trust_radius), vlevel=1)
+            if gmax < g_tol:
+                return dm
+
+            # quasi-Newton step restricted in the trust region
+            step = -_lbfgs_apply(grad, 1.0 / hdiag, svecs, yvecs)
+            step_norm = float(step.norm())
+            scale = 1.0
+            if step_norm > trust_radius:
+                scale = trust_radius / step_norm
+                step = step * scale
+                step_norm = trust_radius
+            # the energy change predicted by the L-BFGS model, g.s + 1/2 s.B.s,
+            # where B is the inverse of the two-loop operator, so B s = -scale * g
+            bstep = -scale * grad
+            pred = float(torch.dot(grad, step) + 0.5 * torch.dot(step, bstep))
+            if pred >= 0:
+                # not a descent direction, restart from the preconditioned gradient
+                svecs.clear()
+                yvecs.clear()
+                continue
+
+            new_orbs = rotate(orbs, step)
+            new_dm = orbs2dm(new_orbs)
+            new_ene = float(dm2energy(new_dm))
+            ratio = (new_ene - ene) / pred
+
+            # update the trust radius
+            if ratio < 0.25:
+                trust_radius = trust_radius * 0.25
+            elif ratio > 0.75 and step_norm >= trust_radius * (1 - 1e-6):
+                trust_radius = min(trust_radius * 2, max_trust_radius)
+
+            # accept the step only if the energy decreases
+            if new_ene < ene:
+                new_grad, new_hdiag = get_grad(new_orbs, new_dm)
+                yvec = new_grad - grad
+                if float(torch.dot(step, yvec)) > 1e-12:
+                    svecs.append(step)
+                    yvecs.append(yvec)
+                    if len(svecs) > history:
+                        svecs.pop(0)
+                        yvecs.pop(0)
+                orbs, dm, ene, grad, hdiag = new_orbs, new_dm, new_ene, new_grad, new_hdiag
+            elif trust_radius < 1e-10:
+                break
+
+    warnings.warn("The orbital rotation does not converge, max gradient: %.3e" % gmax)
+    return dm
+
+def _split_fock(fock: torch.Tensor, polarized: bool) -> List[torch.Tensor]:
+    # split the fock matrix into the list of the fock matrices of every spin
+    return [fock[0], fock[1]] if polarized else [fock]
+
+def _lbfgs_apply(grad: torch.Tensor, hinv_diag: torch.Tensor,
+                 svecs: List[torch.Tensor], yvecs: List[torch.Tensor]) -> torch.Tensor:
+    # apply the L-BFGS approximation of the inverse Hessian to the gradient
+    # with the two-loop recursion and the diagonal initial inverse Hessian
+    q = grad
+    alphas = []
+    rhos = [1.0 / float(torch.dot(y, s)) for (s, y) in zip(svecs, yvecs)]
+    for (s, y, rho) in zip(reversed(svecs), reversed(yvecs), reversed(rhos)):
+        alpha = rho * float(torch.dot(s, q))
+        q = q - alpha * y
+        alphas.append(alpha)
+    r = hinv_diag * q
+    for (s, y, rho, alpha) in zip(svecs, yvecs, rhos, reversed(alphas)):
+        beta = rho * float(torch.dot(y, r))
+        r = r + (alpha - beta) * s
+    return r
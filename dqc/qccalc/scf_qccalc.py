@@ -1,15 +1,20 @@
 from __future__ import annotations
 from abc import abstractmethod, abstractproperty
 from typing import Optional, Dict, Any, List, Union, Tuple
+import warnings
 import torch
 import xitorch as xt
 import xitorch.linalg
 import xitorch.optimize
 from dqc.system.base_system import BaseSystem
 from dqc.qccalc.base_qccalc import BaseQCCalc
+from dqc.qccalc.diis import diis_equilibrium
+from dqc.qccalc.orbrot import orbrot_minimize
+from dqc.hamilton.hcgto_pbc import HamiltonCGTO_PBC
+from dqc.qccalc.guess import get_sad_dm, get_huckel_dm, get_projected_dm, get_extrapolated_dm
 from dqc.utils.datastruct import SpinParam
 from dqc.utils.config import config
-from dqc.utils.misc import set_default_option
+from dqc.utils.misc import set_default_option, logger
 
 class SCF_QCCalc(BaseQCCalc):
     """
@@ -24,10 +29,16 @@ class SCF_QCCalc(BaseQCCalc):
         If True, then use optimization of the free orbital parameters to find
         the minimum energy.
         Otherwise, use self-consistent iterations.
+    coarse_grid_tol: float
+        If the engine has a coarse integration grid, the self-consistent
+        iterations are run on the coarse grid until the maximum absolute
+        residual is below this tolerance, then continued on the final grid.
     """
 
-    def __init__(self, engine: BaseSCFEngine, variational: bool = False):
+    def __init__(self, engine: BaseSCFEngine, variational: bool = False,
+                 coarse_grid_tol: float = 1e-3):
         self._engine = engine
+        self._coarse_grid_tol = coarse_grid_tol
         self._polarized = engine.polarized
         self._shape = self._engine.shape
         self.dtype = self._engine.dtype
@@ -38,7 +49,8 @@ class SCF_QCCalc(BaseQCCalc):
     def get_system(self) -> BaseSystem:
         return self._engine.get_system()
 
-    def run(self, dm0: Optional[Union[str, torch.Tensor, SpinParam[torch.Tensor]]] = "1e",  # type: ignore
+    def run(self, dm0: Optional[Union[str, torch.Tensor, SpinParam[torch.Tensor], BaseQCCalc,  # type: ignore
+                                      List[BaseQCCalc]]] = "1e",
             eigen_options: Optional[Dict[str, Any]] = None,
             fwd_options: Optional[Dict[str, Any]] = None,
             bck_options: Optional[Dict[str, Any]] = None) -> BaseQCCalc:
@@ -81,30 +93,58 @@ class SCF_QCCalc(BaseQCCalc):
         # save the eigen_options for use in diagonalization
         self._engine.set_eigen_options(eigen_options)
 
-        # set up the initial self-consistent param guess
-        if dm0 is None:
-            dm = self._get_zero_dm()
-        elif isinstance(dm0, str):
-            if dm0 == "1e":  # initial density based on 1-electron Hamiltonian
+        # the early self-consistent iterations are run on the coarse grid (if
+        # the engine has one), starting from the initial guess
+        # the final grid is always restored afterwards, even if the coarse
+        # stage is interrupted, so the energy is never evaluated on the
+        # coarse grid
+        coarse = self._engine.set_coarse_grid(not self._variational)
+        try:
+            # set up the initial self-consistent param guess
+            if dm0 is None:
                 dm = self._get_zero_dm()
-                scp0 = self._engine.dm2scp(dm)
-                dm = self._engine.scp2dm(scp0)
+            elif isinstance(dm0, str):
+                if dm0 == "1e":  # initial density based on 1-electron Hamiltonian
+                    dm = self._get_zero_dm()
+                    scp0 = self._engine.dm2scp(dm)
+                    dm = self._engine.scp2dm(scp0)
+                elif dm0 == "sad":  # superposition of atomic densities
+                    dm = get_sad_dm(self.get_system(), self._polarized)
+                elif dm0 == "huckel":  # extended Huckel in the atomic minimal basis
+                    dm = get_huckel_dm(self.get_system(), self._polarized)
+                else:
+                    raise RuntimeError("Unknown dm0: %s" % dm0)
+            elif isinstance(dm0, BaseQCCalc):
+                # warm start from the previous calculation (e.g. different geometry)
+                dm = get_projected_dm(dm0, self.get_system(), self._polarized)
+            elif isinstance(dm0, (list, tuple)):
+                # extrapolation from the previous calculations with different geometries
+                dm = get_extrapolated_dm(dm0, self.get_system(), self._polarized)
             else:
-                raise RuntimeError("Unknown dm0: %s" % dm0)
-        else:
-            dm = SpinParam.apply_fcn(lambda dm0: dm0.detach(), dm0)
+                dm = SpinParam.apply_fcn(lambda dm0: dm0.detach(), dm0)
+
+            # making it spin param for polarized and tensor for nonpolarized
+            if isinstance(dm, torch.Tensor) and self._polarized:
+                dm_u = dm * 0.5
+                dm_d = dm * 0.5
+                dm = SpinParam(u=dm_u, d=dm_d)
+            elif isinstance(dm, SpinParam) and not self._polarized:
+                dm = dm.u + dm.d
 
-        # making it spin param for polarized and tensor for nonpolarized
-        if isinstance(dm, torch.Tensor) and self._polarized:
-            dm_u = dm * 0.5
-            dm_d = dm * 0.5
-            dm = SpinParam(u=dm_u, d=dm_d)
-        elif isinstance(dm, SpinParam) and not self._polarized:
-            dm = dm.u + dm.d
+            if coarse and not self._variational:
+                dm = self._run_coarse_scf(dm, fwd_options)
+        finally:
+            self._engine.set_coarse_grid(False)
 
         if not self._variational:
             scp0 = self._engine.dm2scp(dm)
 
+            # the DIIS iterations only give the initial guess of the
+            # equilibrium, which then only checks the convergence and provides
+            # the implicit gradients of the self-consistent params
+            if fwd_options["method"] == "diis":
+                scp0, fwd_options, _, _ = self._run_diis(scp0, fwd_options)
+
             # do the self-consistent iteration
             scp = xitorch.optimize.equilibrium(
                 fcn=self._engine.scp2scp,
@@ -141,17 +181,26 @@ class SCF_QCCalc(BaseQCCalc):
                     p, c, orb_weights)
                 return dm
 
-            params0, coeffs0 = dm2params(dm)
-            params0 = params0.detach()
-            coeffs0 = coeffs0.detach()
-            min_params0: torch.Tensor = xitorch.optimize.minimize(
-                fcn=self._engine.aoparams2ene,
-                # random noise to add the chance of it gets to the minimum, not
-                # a saddle point
-                y0=params0 + torch.randn_like(params0) * 0.03 / params0.numel(),
-                params=(coeffs0, None,),  # coeffs & with_penalty
-                bck_options={**bck_options},
-                **fwd_options).detach()
+            if fwd_options["method"] == "trust-region":
+                # quasi-Newton minimization over the orbital rotations, the
+                # parameters are only obtained at the minimum to provide the
+                # implicit gradients below
+                min_dm = self._run_orbrot(dm, fwd_options)
+                min_params0, coeffs0 = dm2params(min_dm)
+                min_params0 = min_params0.detach()
+                coeffs0 = coeffs0.detach()
+            else:
+                params0, coeffs0 = dm2params(dm)
+                params0 = params0.detach()
+                coeffs0 = coeffs0.detach()
+                min_params0 = xitorch.optimize.minimize(
+                    fcn=self._engine.aoparams2ene,
+                    # random noise to add the chance of it gets to the minimum, not
+                    # a saddle point
+                    y0=params0 + torch.randn_like(params0) * 0.03 / params0.numel(),
+                    params=(coeffs0, None,),  # coeffs & with_penalty
+                    bck_options={**bck_options},
+                    **fwd_options).detach()
 
             if torch.is_grad_enabled():
                 # If the gradient is required, then put it through the minimization
@@ -192,6 +241,99 @@ class SCF_QCCalc(BaseQCCalc):
             (isinstance(dm, SpinParam) and self._polarized)
         return self._engine.dm2energy(dm)
 
+    def _run_coarse_scf(self, dm: Union[torch.Tensor, SpinParam[torch.Tensor]],
+                        fwd_options: Dict[str, Any]) -> Union[torch.Tensor, SpinParam[torch.Tensor]]:
+        # run the self-consistent iterations on the coarse grid until the
+        # residual is below the tolerance and returns the density matrix
+        # the gradients are not needed here because they are obtained from the
+        # self-consistent iterations on the final grid
+        niter = 0
+        resid = float("inf")
+
+        def scp2scp(scp: torch.Tensor) -> torch.Tensor:
+            nonlocal niter, resid
+            new_scp = self._engine.scp2scp(scp)
+            niter += 1
+            resid = float((new_scp - scp).abs().max())
+            return new_scp
+
+        with torch.no_grad(), warnings.catch_warnings():
+            # the iterations do not need to converge on the coarse grid
+            warnings.simplefilter("ignore")
+            scp0 = self._engine.dm2scp(dm)
+            if fwd_options["method"] == "diis":
+                scp, _, niter, err = self._run_diis(scp0, {**fwd_options, "f_tol": self._coarse_grid_tol})
+            else:
+                scp = xitorch.optimize.equilibrium(
+                    fcn=scp2scp,
+                    y0=scp0,
+                    **{**fwd_options, "f_tol": self._coarse_grid_tol})
+        if fwd_options["method"] == "diis":
+            logger.log("Switching the SCF to the final grid after %d DIIS iterations on the coarse grid "
+                       "(commutator error: %.3e)" % (niter, err))
+        else:
+            logger.log("Switching the SCF to the final grid after %d iterations on the coarse grid "
+                       "(residual: %.3e)" % (niter, resid))
+        return self._engine.scp2dm(scp)
+
+    def _run_diis(self, scp0: torch.Tensor, fwd_options: Dict[str, Any]) -> \
+            Tuple[torch.Tensor, Dict[str, Any], int, float]:
+        # run the DIIS-accelerated self-consistent iterations and returns the
+        # self-consistent param with the options for the equilibrium that
+        # follows it, the number of iterations, and the final commutator error
+        diis_defopt = {
+            "f_tol": 1e-8,
+            "diis_space": 8,
+            "hybrid": "adiis",
+        }
+        diis_options = set_default_option(diis_defopt, fwd_options)
+        h = self.get_system().get_hamiltonian()
+        ovlp = h.get_overlap().fullmatrix().detach()
+        # the traces over the k-points are weighted as in the energy
+        wkpts = h.wkpts if isinstance(h, HamiltonCGTO_PBC) else None
+        scp, niter, err = diis_equilibrium(
+            scp0,
+            scp2dm=self._engine.scp2dm,
+            dm2scp=self._engine.dm2scp,
+            ovlp=ovlp,
+            dm2energy=self._engine.dm2energy,
+            wkpts=wkpts,
+            maxiter=diis_options["maxiter"],
+            f_tol=diis_options["f_tol"],
+            diis_space=diis_options["diis_space"],
+            hybrid=diis_options["hybrid"])
+
+        # the equilibrium uses broyden1 with the remaining options
+        eq_options = {k: v for (k, v) in fwd_options.items() if k not in ("diis_space", "hybrid")}
+        eq_options["method"] = "broyden1"
+        return scp, eq_options, niter, err
+
+    def _run_orbrot(self, dm: Union[torch.Tensor, SpinParam[torch.Tensor]],
+                    fwd_options: Dict[str, Any]) -> Union[torch.Tensor, SpinParam[torch.Tensor]]:
+        # run the trust-region quasi-Newton minimization of the energy over
+        # the orbital rotations and returns the density matrix at the minimum
+        orbrot_defopt = {
+            "g_tol": 1e-7,
+            "trust_radius": 0.5,
+            "max_trust_radius": 2.0,
+            "history": 10,
+        }
+        orbrot_options = set_default_option(orbrot_defopt, fwd_options)
+        system = self.get_system()
+        h = system.get_hamiltonian()
+        return orbrot_minimize(
+            dm,
+            dm2energy=self._engine.dm2energy,
+            dm2fock=self._engine.dm2scp,
+            ao_orb2dm=h.ao_orb2dm,
+            ovlp=h.get_overlap().fullmatrix().detach(),
+            orb_weight=system.get_orbweight(polarized=self._polarized),
+            maxiter=orbrot_options["maxiter"],
+            g_tol=orbrot_options["g_tol"],
+            trust_radius=orbrot_options["trust_radius"],
+            max_trust_radius=orbrot_options["max_trust_radius"],
+            history=orbrot_options["history"])
+
     def _get_zero_dm(self) -> Union[SpinParam[torch.Tensor], torch.Tensor]:
         # get the initial dm that are all zeros
         if not self._polarized:
@@ -310,6 +452,14 @@ class BaseSCFEngine(xt.EditableModule):
         """
         pass
 
+    def set_coarse_grid(self, coarse: bool) -> bool:
+        """
+        Use the coarse integration grid for the early self-consistent
+        iterations if ``coarse``, otherwise use the final grid.
+        Returns True if the engine has a coarse grid, False by default.
+        """
+        return False
+
     @abstractmethod
     def getparamnames(self, methodname: str, prefix: str = "") -> List[str]:
         """
@@ -5,7 +5,7 @@ import xitorch as xt
 from typing import List, Union, Optional, Tuple
 from dqc.hamilton.base_hamilton import BaseHamilton
 from dqc.grid.base_grid import BaseGrid
-from dqc.utils.datastruct import SpinParam, ZType, BasisInpType
+from dqc.utils.datastruct import SpinParam, ZType, BasisInpType, AtomCGTOBasis
 
 class BaseSystem(xt.EditableModule):
     """
@@ -68,6 +68,14 @@ class BaseSystem(xt.EditableModule):
         """
         pass
 
+    @abstractmethod
+    def build_grid(self, grid: Union[int, str]) -> BaseGrid:
+        """
+        Construct and returns a new integration grid for the system with the
+        given grid specification without changing the system's grid
+        """
+        pass
+
     @abstractmethod
     def requires_grid(self) -> bool:
         """
@@ -95,6 +103,13 @@ class BaseSystem(xt.EditableModule):
         """
         pass
 
+    @abstractproperty
+    def atombases(self) -> List[AtomCGTOBasis]:
+        """
+        Returns the list of the basis of every atom in the system
+        """
+        pass
+
     @abstractproperty
     def atommasses(self) -> torch.Tensor:
         """
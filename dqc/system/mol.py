@@ -71,6 +71,33 @@ class Mol(BaseSystem):
     * ao_parameterizer: str
         (computational option)
         Specifying the atomic orbital parameterizer.
+    * eri_mode: str
+        (computational option)
+        Specifying how the electron repulsion integrals are stored.
+        If ``"dense"``, the full ``(nao, nao, nao, nao)`` tensor is stored.
+        If ``"s8"``, only the 8-fold symmetry unique elements are stored
+        (about 8 times less memory, but slower to contract).
+        If ``"direct"``, the integrals are not stored and the Coulomb and
+        exchange matrices are recomputed from the screened shell quartets
+        in every SCF iteration (memory grows only as ``nao^2``).
+        The gradients w.r.t. the atomic positions and basis parameters are
+        not available with ``"direct"``.
+        It is ignored if density fitting is used.
+    * ao_grid_mode: str
+        (computational option)
+        Specifying how the basis values in the integration grid are stored.
+        If ``"cache"``, they are stored for the whole grid.
+        If ``"recompute"``, they are evaluated in chunks every time they are
+        needed (less memory, but more computation).
+        If ``"auto"``, they are recomputed only if storing them takes more
+        memory than ``config.THRESHOLD_MEMORY``.
+    * grid_ordering: str or None
+        (computational option)
+        Specifying the space-filling curve (``"morton"`` or ``"hilbert"``) to
+        order the integration grid points, so the blocks of the grid points
+        used in the xc evaluation are spatially compact and more basis
+        functions are screened out in every block.
+        If ``None``, the grid points are ordered per atom.
     """
 
     def __init__(self,
@@ -79,6 +106,9 @@ class Mol(BaseSystem):
                  *,
                  orthogonalize_basis: bool = True,
                  ao_parameterizer: str = "qr",
+                 eri_mode: str = "dense",
+                 ao_grid_mode: str = "auto",
+                 grid_ordering: Optional[str] = None,
 
                  grid: Union[int, str] = "sg3",
                  spin: Optional[ZType] = None,
@@ -92,6 +122,7 @@ class Mol(BaseSystem):
         self._dtype = dtype
         self._device = device
         self._grid_inp = grid
+        self._grid_ordering = grid_ordering
         self._basis_inp = basis
         self._grid: Optional[BaseGrid] = None
         self._vext = vext
@@ -117,9 +148,13 @@ class Mol(BaseSystem):
                                       vext=self._vext,
                                       cache=self._cache.add_prefix("hamilton"),
                                       orthozer=orthogonalize_basis,
-                                      aoparamzer=ao_parameterizer)
+                                      aoparamzer=ao_parameterizer,
+                                      eri_mode=eri_mode,
+                                      ao_grid_mode=ao_grid_mode)
         self._orthogonalize_basis = orthogonalize_basis
         self._aoparamzer = ao_parameterizer
+        self._eri_mode = eri_mode
+        self._ao_grid_mode = ao_grid_mode
         self._atompos = atompos  # (natoms, ndim)
         self._atomzs = atomzs  # (natoms,) int-type or dtype if floating point
         self._atomzs_int = atomzs_int  # (natoms,) int-type rounded from atomzs
@@ -203,7 +238,9 @@ class Mol(BaseSystem):
                                       vext=self._vext,
                                       cache=self._cache.add_prefix("hamilton"),
                                       orthozer=self._orthogonalize_basis,
-                                      aoparamzer=self._aoparamzer)
+                                      aoparamzer=self._aoparamzer,
+                                      eri_mode=self._eri_mode,
+                                      ao_grid_mode=self._ao_grid_mode)
         return self
 
     def get_hamiltonian(self) -> BaseHamilton:
@@ -261,8 +298,7 @@ class Mol(BaseSystem):
     def setup_grid(self) -> None:
         grid_inp = self._grid_inp
         logger.log("Constructing the integration grid")
-        self._grid = get_predefined_grid(self._grid_inp, self._atomzs_int, self._atompos,
-                                         dtype=self._dtype, device=self._device)
+        self._grid = self.build_grid(grid_inp)
         logger.log("Constructing the integration grid: done")
 
         # #        0,  1,  2,  3,  4,  5
@@ -276,6 +312,11 @@ class Mol(BaseSystem):
         # sphgrids = [sphgrid for _ in range(natoms)]
         # self._grid = BeckeGrid(sphgrids, self._atompos)
 
+    def build_grid(self, grid: Union[int, str]) -> BaseGrid:
+        return get_predefined_grid(grid, self._atomzs_int, self._atompos,
+                                   ordering=self._grid_ordering,
+                                   dtype=self._dtype, device=self._device)
+
     def get_grid(self) -> BaseGrid:
         if self._grid is None:
             raise RuntimeError("Please run mol.setup_grid() first before calling get_grid()")
@@ -303,6 +344,10 @@ class Mol(BaseSystem):
     def atomzs(self) -> torch.Tensor:
         return self._atomzs
 
+    @property
+    def atombases(self) -> List[AtomCGTOBasis]:
+        return self._atombases
+
     @property
     def atommasses(self) -> torch.Tensor:
         # returns the atomic mass (only for non-isotope for now)
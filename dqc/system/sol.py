@@ -48,6 +48,10 @@ class Sol(BaseSystem):
     * orb_weights: SpinParam[torch.Tensor] or None
         Specifiying the orbital occupancy (or weights) directly. If specified,
         ``spin`` and ``charge`` arguments are ignored.
+    * grid_ordering: str or None
+        Specifying the space-filling curve (``"morton"`` or ``"hilbert"``) to
+        order the integration grid points.
+        If ``None``, the grid points are ordered per atom.
     * dtype: torch.dtype
         The data type of tensors in this class.
     * device: torch.device
@@ -62,12 +66,14 @@ class Sol(BaseSystem):
                  grid: Union[int, str] = "sg3",
                  spin: Optional[ZType] = None,
                  lattsum_opt: Optional[Union[PBCIntOption, Dict]] = None,
+                 grid_ordering: Optional[str] = None,
                  dtype: torch.dtype = torch.float64,
                  device: torch.device = torch.device('cpu'),
                  ):
         self._dtype = dtype
         self._device = device
         self._grid_inp = grid
+        self._grid_ordering = grid_ordering
         self._grid: Optional[BaseGrid] = None
         charge = 0  # we can't have charged solids for now
 
@@ -225,9 +231,13 @@ class Sol(BaseSystem):
         return eii * 0.5
 
     def setup_grid(self) -> None:
-        self._grid = get_predefined_grid(self._grid_inp, self._atomzs, self._atompos,
-                                         lattice=self._lattice,
-                                         dtype=self._dtype, device=self._device)
+        self._grid = self.build_grid(self._grid_inp)
+
+    def build_grid(self, grid: Union[int, str]) -> BaseGrid:
+        return get_predefined_grid(grid, self._atomzs, self._atompos,
+                                   lattice=self._lattice,
+                                   ordering=self._grid_ordering,
+                                   dtype=self._dtype, device=self._device)
 
     def get_grid(self) -> BaseGrid:
         if self._grid is None:
@@ -249,6 +259,10 @@ class Sol(BaseSystem):
     def atomzs(self) -> torch.Tensor:
         return self._atomzs
 
+    @property
+    def atombases(self) -> List[AtomCGTOBasis]:
+        return self._atombases
+
     @property
     def atommasses(self) -> torch.Tensor:
         # returns the atomic mass (only for non-isotope for now)
@@ -3,8 +3,11 @@ import numpy as np
 import pytest
 from dqc.grid.radial_grid import RadialGrid
 from dqc.grid.lebedev_grid import LebedevGrid
-from dqc.grid.multiatoms_grid import BeckeGrid, PBCBeckeGrid
+from dqc.grid.multiatoms_grid import BeckeGrid, PBCBeckeGrid, _get_atom_weights_ssf
 from dqc.grid.factory import get_predefined_grid
+from dqc.grid.lebedev_grid import LebedevLoader
+import dqc.grid.grid_cache as grid_cache
+from dqc.utils.config import config
 from dqc.hamilton.intor.lattice import Lattice
 
 rgrid_combinations = [
@@ -131,3 +134,126 @@ def test_pbc_multiatoms_grid_dvol(rgrid_integrator, rgrid_transform):
 
     # TODO: rtol is relatively large, maybe inspect the Becke integration grid?
     assert torch.allclose(int1, int1 * 0 + val1, rtol=1e-2)
+
+@pytest.mark.parametrize(
+    "partition",
+    ["becke", "stratmann"]
+)
+def test_pbc_multiatoms_grid_partition(partition):
+    # test the grid in a periodic cell with more atoms and both partitions
+    dtype = torch.float64
+    radgrid = RadialGrid(40, "chebyshev2", "treutlerm4", dtype=dtype)
+    sphgrid = LebedevGrid(radgrid, prec=7)
+    atompos = torch.tensor([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0],
+                            [0.5, 2.0, 1.0], [2.5, 1.5, 2.0]], dtype=dtype)
+    natoms = atompos.shape[0]
+    lattice = Lattice(torch.eye(3, dtype=dtype) * 3)
+    grid = PBCBeckeGrid([sphgrid] * natoms, atompos, lattice=lattice, partition=partition)
+
+    dvol = grid.get_dvolume()  # (ngrid,)
+    rgrid = grid.get_rgrid()  # (ngrid, ndim)
+    ls = lattice.get_lattice_ls(rcut=5)  # (nls, ndim)
+    atomposs = (atompos.unsqueeze(1) + ls).reshape(-1, 1, 3)  # (natoms * nls, ndim)
+
+    # all the grid points are inside the cell
+    assert torch.all(rgrid >= 0) and torch.all(rgrid < 3)
+
+    # test gaussian integration
+    fcn = torch.exp(-((rgrid - atomposs) ** 2).sum(dim=-1)).sum(dim=0)  # (ngrid)
+    int1 = (fcn * dvol).sum()
+    val1 = int1 * 0 + natoms * np.pi ** 1.5  # analytical function
+    assert torch.allclose(int1, val1, rtol=1e-2)
+
+def test_multiatoms_grid_stratmann():
+    # test the screened Stratmann-Scuseria-Frisch partition weights form a
+    # partition of unity and give the accurate integration
+    dtype = torch.float64
+    torch.manual_seed(123)
+    atompos = torch.tensor([[0.0, 0.0, 0.0], [1.5, 0.0, 0.0], [0.0, 1.8, 0.3],
+                            [6.0, 1.0, -1.0], [20.0, 0.0, 0.0]], dtype=dtype)
+    natoms = atompos.shape[0]
+
+    # the weights of all atoms at the same points sum to one
+    xyz = (torch.rand((1000, 3), dtype=dtype) - 0.3) * 25
+    w = _get_atom_weights_ssf([xyz] * natoms, atompos).reshape(natoms, -1)
+    assert torch.allclose(w.sum(dim=0), torch.ones_like(w[0]))
+    assert torch.all(w >= 0)
+
+    # integrate gaussians centered on the atoms
+    radgrid = RadialGrid(60, "chebyshev2", "treutlerm4", dtype=dtype)
+    sphgrid = LebedevGrid(radgrid, prec=17)
+    grid = BeckeGrid([sphgrid] * natoms, atompos, partition="stratmann")
+    dvol = grid.get_dvolume()  # (ngrid,)
+    rgrid = grid.get_rgrid()  # (ngrid, ndim)
+    fcn = torch.exp(-((rgrid - atompos.unsqueeze(1)) ** 2).sum(dim=-1) * 0.5).sum(dim=0)  # (ngrid)
+    int1 = (fcn * dvol).sum()
+    val1 = natoms * (2 * np.sqrt(2 * np.pi) * np.pi)
+    assert torch.allclose(int1, int1 * 0 + val1, rtol=1e-4)
+
+def test_grid_cache(tmp_path):
+    # test the grids loaded from the cache files are the same as the
+    # constructed ones
+    dtype = torch.float64
+    atomzs = [1, 8, 1]
+    atompos = torch.tensor([[0.0, 0.0, 0.0], [1.0, 0.5, 0.0], [2.0, 0.0, 0.1]], dtype=dtype)
+    grid0 = get_predefined_grid(3, atomzs, atompos, dtype=dtype)
+
+    cache_dir0 = config.GRID_CACHE_DIR
+    cache_mol0 = config.GRID_CACHE_MOLECULAR
+    try:
+        config.GRID_CACHE_DIR = str(tmp_path)
+        for cache_mol in [False, True]:
+            config.GRID_CACHE_MOLECULAR = cache_mol
+            # the first one constructs and stores the grids, the second one
+            # loads them from the files
+            for _ in range(2):
+                grid_cache._ATOM_GRIDS.clear()
+                LebedevLoader.caches.clear()
+                grid1 = get_predefined_grid(3, atomzs, atompos, dtype=dtype)
+                assert torch.allclose(grid0.get_rgrid(), grid1.get_rgrid())
+                assert torch.allclose(grid0.get_dvolume(), grid1.get_dvolume())
+            assert (tmp_path / "molecules").exists() == cache_mol
+        assert len(list((tmp_path / "atoms").iterdir())) == 2
+        assert (tmp_path / "lebedev").exists()
+    finally:
+        config.GRID_CACHE_DIR = cache_dir0
+        config.GRID_CACHE_MOLECULAR = cache_mol0
+        grid_cache._ATOM_GRIDS.clear()
+        LebedevLoader.caches.clear()
+
+@pytest.mark.parametrize(
+    "ordering",
+    ["morton", "hilbert"]
+)
+def test_multiatoms_grid_ordering(ordering):
+    # test the grid ordered along the space-filling curve gives the same
+    # integration and more compact blocks than the unordered one
+    dtype = torch.float64
+    atomzs = [1, 8]
+    atompos = torch.tensor([[0.0, 0.0, 0.0], [1.0, 0.5, 0.0]], dtype=dtype)
+    grid0 = get_predefined_grid(3, atomzs, atompos, dtype=dtype)
+    grid1 = get_predefined_grid(3, atomzs, atompos, ordering=ordering, dtype=dtype)
+
+    rgrid0 = grid0.get_rgrid()  # (ngrid, ndim)
+    rgrid1 = grid1.get_rgrid()
+    assert rgrid0.shape == rgrid1.shape
+    fcn0 = torch.exp(-((rgrid0 - atompos.unsqueeze(1)) ** 2).sum(dim=-1) * 0.5).sum(dim=0)  # (ngrid)
+    fcn1 = torch.exp(-((rgrid1 - atompos.unsqueeze(1)) ** 2).sum(dim=-1) * 0.5).sum(dim=0)
+    int0 = (fcn0 * grid0.get_dvolume()).sum()
+    int1 = (fcn1 * grid1.get_dvolume()).sum()
+    assert torch.allclose(int0, int1)
+
+    # check the blocks metadata
+    blksize = 128
+    bounds0, _ = grid0.get_blocks(blksize)
+    bounds1, ranges1 = grid1.get_blocks(blksize)
+    assert ranges1[0, 0] == 0 and ranges1[-1, 1] == rgrid1.shape[0]
+    assert torch.all(ranges1[1:, 0] == ranges1[:-1, 1])
+    for i in range(ranges1.shape[0]):
+        rblock = rgrid1[ranges1[i, 0]:ranges1[i, 1]]
+        assert torch.all(rblock >= bounds1[i, 0]) and torch.all(rblock <= bounds1[i, 1])
+
+    # the ordered blocks must be more compact
+    size0 = (bounds0[:, 1] - bounds0[:, 0]).norm(dim=-1).mean()
+    size1 = (bounds1[:, 1] - bounds1[:, 0]).norm(dim=-1).mean()
+    assert size1 < size0
@@ -6,7 +6,12 @@ from dqc.hamilton.hcgto_pbc import HamiltonCGTO_PBC
 from dqc.hamilton.intor.lattice import Lattice
 from dqc.api.loadbasis import loadbasis
 from dqc.qccalc.hf import HF
-from dqc.utils.datastruct import DensityFitInfo, AtomCGTOBasis
+from dqc.utils.datastruct import DensityFitInfo, AtomCGTOBasis, ValGrad, SpinParam
+from dqc.hamilton.orbconverter import OrbitalOrthogonalizer
+from dqc.hamilton.intor.packed import pack_s8
+from dqc.utils.config import config
+from dqc.api.getxc import get_xc
+import dqc.hamilton.intor as intor
 
 import pyscf
 import pyscf.pbc
@@ -178,6 +183,265 @@ def test_cgto_ao_params(system1):
     assert torch.allclose(dm, dm2)
     assert torch.allclose(penalty, torch.zeros_like(penalty))
 
+@pytest.mark.parametrize(
+    "eri_mode",
+    ["s8", "direct"]
+)
+def test_cgto_elrep_exchange_eri_mode(eri_mode):
+    # test the coulomb and exchange matrices with different storage of the
+    # electron repulsion integrals against the dense one
+    torch.manual_seed(123)
+    poss = torch.tensor([[0.0, 0.0, 0.8], [0.0, 0.0, -0.8], [0.3, 1.2, 0.1]], dtype=dtype)
+    moldesc = ([1, 3, 8], poss)
+    hams = []
+    for mode in ["dense", eri_mode]:
+        m = Mol(moldesc, basis="3-21G", dtype=dtype, spin=0, eri_mode=mode)
+        hams.append(m.get_hamiltonian().build())
+
+    nao = hams[0].nao
+    dm = torch.rand((2, nao, nao), dtype=dtype)
+    dm = dm + dm.transpose(-2, -1)
+    elrep0 = hams[0].get_elrep(dm).fullmatrix()
+    exch0 = hams[0].get_exchange(dm).fullmatrix()
+    elrep1 = hams[1].get_elrep(dm).fullmatrix()
+    exch1 = hams[1].get_exchange(dm).fullmatrix()
+    assert torch.allclose(elrep0, elrep1)
+    assert torch.allclose(exch0, exch1)
+
+    # check the gradient w.r.t. the density matrix
+    def get_jk(dm):
+        return hams[1].get_elrep(dm).fullmatrix() + hams[1].get_exchange(dm).fullmatrix()
+
+    dm1 = dm[0].detach().requires_grad_()
+    torch.autograd.gradcheck(get_jk, (dm1,))
+
+@pytest.mark.parametrize(
+    "eri_mode",
+    ["dense", "s8", "direct"]
+)
+def test_cgto_get_jk(eri_mode):
+    # test the coulomb and exchange operators obtained together for a batch of
+    # density matrices against the ones obtained separately
+    torch.manual_seed(123)
+    poss = torch.tensor([[0.0, 0.0, 0.8], [0.0, 0.0, -0.8], [0.3, 1.2, 0.1]], dtype=dtype)
+    moldesc = ([1, 3, 8], poss)
+    m = Mol(moldesc, basis="3-21G", dtype=dtype, spin=0, eri_mode=eri_mode)
+    ham = m.get_hamiltonian().build()
+
+    nao = ham.nao
+    dm = torch.rand((3, nao, nao), dtype=dtype)
+    dm = dm + dm.transpose(-2, -1)
+    elrep, exch = ham.get_jk(dm)
+    assert torch.allclose(elrep.fullmatrix(), ham.get_elrep(dm).fullmatrix())
+    assert torch.allclose(exch.fullmatrix(), ham.get_exchange(dm).fullmatrix())
+
+    elrep, exch = ham.get_jk(dm, with_k=False)
+    assert exch is None
+    assert torch.allclose(elrep.fullmatrix(), ham.get_elrep(dm).fullmatrix())
+
+@pytest.mark.parametrize(
+    "chunk_memory",
+    [16 * 1024 ** 2, 1]
+)
+def test_orthozer_convert4(chunk_memory):
+    # test the quarter-transformations of the 4-index matrix against the
+    # direct contraction for the dense and the packed matrices
+    torch.manual_seed(123)
+    nao = 6
+    a = torch.rand((nao, nao), dtype=dtype)
+    ovlp = a @ a.T + 1e-2 * torch.eye(nao, dtype=dtype)
+    orthozer = OrbitalOrthogonalizer(ovlp, threshold=1e-2)
+    c = orthozer._orthozer
+
+    # random matrix with the 8-fold symmetry of the electron repulsion integrals
+    mat = torch.rand((nao, nao, nao, nao), dtype=dtype)
+    mat = mat + mat.transpose(0, 1)
+    mat = mat + mat.transpose(2, 3)
+    mat = mat + mat.permute(2, 3, 0, 1)
+    res0 = torch.einsum("ijkl,im,jn,kp,lq->mnpq", mat, c, c, c, c)
+
+    try:
+        chunk_memory0 = config.CHUNK_MEMORY
+        config.CHUNK_MEMORY = chunk_memory
+        res_dense = orthozer.convert4(mat)
+        res_packed = orthozer.convert4(pack_s8(mat), packed=True)
+        # non-symmetric matrix is supported in the dense form
+        mat1 = torch.rand((2, nao, nao, nao, nao), dtype=dtype)
+        res1 = orthozer.convert4(mat1)
+    finally:
+        config.CHUNK_MEMORY = chunk_memory0
+
+    assert torch.allclose(res0, res_dense)
+    assert torch.allclose(pack_s8(res0), res_packed)
+    assert torch.allclose(torch.einsum("...ijkl,im,jn,kp,lq->...mnpq", mat1, c, c, c, c), res1)
+
+@pytest.mark.parametrize(
+    "xcstr",
+    ["lda_x", "gga_x_pbe", "mgga_x_scan"]
+)
+def test_cgto_vxc_screening(xcstr):
+    # test the density information and the vxc matrix with the screened
+    # shells in the grid blocks against the unscreened ones
+    poss = torch.tensor([[0.0, 0.0, 4.0], [0.0, 0.0, -4.0], [0.3, 6.2, 0.1]], dtype=dtype)
+    moldesc = ([1, 1, 8], poss)
+    xc = get_xc(xcstr)
+    res = []
+    for thresh in [0.0, config.AO_SCREEN_THRESHOLD]:
+        try:
+            thresh0 = config.AO_SCREEN_THRESHOLD
+            config.AO_SCREEN_THRESHOLD = thresh
+            m = Mol(moldesc, basis="3-21G", dtype=dtype, grid=3)
+            m.setup_grid()
+            ham = m.get_hamiltonian().build()
+            ham.setup_grid(m.get_grid(), xc)
+        finally:
+            config.AO_SCREEN_THRESHOLD = thresh0
+
+        torch.manual_seed(123)
+        nao = ham.nao
+        dm = torch.rand((nao, nao), dtype=dtype)
+        dm = (dm + dm.transpose(-2, -1)).requires_grad_()
+        vxc = ham.get_vxc(dm).fullmatrix()
+        exc = ham.get_e_xc(dm)
+        dexc_ddm, = torch.autograd.grad(exc, dm)
+        res.append((ham._non0tab, vxc, exc, dexc_ddm))
+
+    # the screening must actually skip some (block, shell) pairs
+    assert np.all(res[0][0] == 1)
+    assert not np.all(res[1][0] == 1)
+    for r0, r1 in zip(res[0][1:], res[1][1:]):
+        assert torch.allclose(r0, r1, atol=1e-8)
+
+@pytest.mark.parametrize(
+    "xcstr",
+    ["lda_x", "gga_x_pbe", "mgga_x_scan"]
+)
+def test_cgto_ao_grid_recompute(xcstr):
+    # test the vxc and the xc energy (with its gradient w.r.t. the atomic
+    # positions) with the basis evaluated on the fly against the cached one
+    xc = get_xc(xcstr)
+    res = []
+    for ao_grid_mode in ["cache", "recompute"]:
+        poss = torch.tensor([[0.0, 0.0, 0.8], [0.0, 0.0, -0.8], [0.3, 1.2, 0.1]],
+                            dtype=dtype).requires_grad_()
+        moldesc = ([1, 1, 8], poss)
+        m = Mol(moldesc, basis="3-21G", dtype=dtype, grid=3, ao_grid_mode=ao_grid_mode)
+        m.setup_grid()
+        ham = m.get_hamiltonian().build()
+        try:
+            # small chunks to test the chunk boundaries
+            chunk_memory0 = config.CHUNK_MEMORY
+            config.CHUNK_MEMORY = 1
+            ham.setup_grid(m.get_grid(), xc)
+            assert hasattr(ham, "basis") == (ao_grid_mode == "cache")
+
+            torch.manual_seed(123)
+            nao = ham.nao
+            dm = torch.rand((nao, nao), dtype=dtype)
+            dm = dm + dm.transpose(-2, -1)
+            vxc = ham.get_vxc(dm).fullmatrix()
+            exc = ham.get_e_xc(dm)
+            dexc_dpos, = torch.autograd.grad(exc, poss)
+        finally:
+            config.CHUNK_MEMORY = chunk_memory0
+        res.append((vxc, exc, dexc_dpos))
+
+    for r0, r1 in zip(*res):
+        assert torch.allclose(r0, r1)
+
+@pytest.mark.parametrize(
+    "xcstr",
+    ["lda_x", "gga_x_pbe", "mgga_x_scan"]
+)
+def test_cgto_xc_kernels(xcstr):
+    # test the density information and the vxc matrix from the fused kernels
+    # against the direct contractions with the basis in the whole grid
+    torch.manual_seed(123)
+    poss = torch.tensor([[0.0, 0.0, 0.8], [0.0, 0.0, -0.8], [0.3, 1.2, 0.1]], dtype=dtype)
+    moldesc = ([1, 1, 8], poss)
+    m = Mol(moldesc, basis="3-21G", dtype=dtype, grid=3, orthogonalize_basis=False)
+    m.setup_grid()
+    ham = m.get_hamiltonian().build()
+    ham.setup_grid(m.get_grid(), get_xc(xcstr))
+    family = ham.xcfamily
+
+    # the reference basis values in the grid
+    wrapper = ham.libcint_wrapper
+    rgrid = ham.rgrid
+    dvol = ham.dvolume
+    ao = intor.eval_gto(wrapper, rgrid)  # (nao, ngrid)
+    gao = intor.eval_gradgto(wrapper, rgrid)  # (ndim, nao, ngrid)
+    lao = intor.eval_laplgto(wrapper, rgrid)  # (nao, ngrid)
+
+    nao = ham.nao
+    ngrid = rgrid.shape[0]
+    dm = torch.rand((2, nao, nao), dtype=dtype)
+    dm = dm + dm.transpose(-2, -1)
+
+    # density information
+    densinfo = ham._dm2densinfo(dm)
+    dens0 = torch.einsum("...ij,ir,jr->...r", dm, ao, ao)
+    assert torch.allclose(densinfo.value, dens0)
+    if family in [2, 4]:
+        gdens0 = 2 * torch.einsum("...ij,ir,djr->...dr", dm, ao, gao)
+        assert torch.allclose(densinfo.grad, gdens0)
+    if family == 4:
+        grad_grad = torch.einsum("...ij,dir,djr->...r", dm, gao, gao)
+        lapl0 = 2 * (torch.einsum("...ij,ir,jr->...r", dm, ao, lao) + grad_grad)
+        assert torch.allclose(densinfo.lapl, lapl0)
+        assert torch.allclose(densinfo.kin, 0.5 * grad_grad)
+
+    # vxc matrix from random potentials
+    pot = torch.rand((2, ngrid), dtype=dtype)
+    potgrad = torch.rand((2, 3, ngrid), dtype=dtype) if family in [2, 4] else None
+    potlapl = torch.rand((2, ngrid), dtype=dtype) if family == 4 else None
+    potkin = torch.rand((2, ngrid), dtype=dtype) if family == 4 else None
+    potinfo = ValGrad(value=pot, grad=potgrad, lapl=potlapl, kin=potkin)
+    vxc = ham._get_vxc_from_potinfo(potinfo).fullmatrix()
+
+    vb = pot.unsqueeze(-2) * ao  # (2, nao, ngrid)
+    if family in [2, 4]:
+        vb = vb + 2 * torch.einsum("...dr,dar->...ar", potgrad, gao)
+    if family == 4:
+        vb = vb + 2 * potlapl.unsqueeze(-2) * lao
+    vxc0 = torch.einsum("ar,...br,r->...ab", ao, vb, dvol)
+    if family == 4:
+        vxc0 = vxc0 + torch.einsum("...r,dar,dbr,r->...ab", 2 * potlapl + 0.5 * potkin, gao, gao, dvol)
+    vxc0 = (vxc0 + vxc0.transpose(-2, -1)) * 0.5
+    assert torch.allclose(vxc, vxc0)
+
+@pytest.mark.parametrize(
+    "xcstr",
+    ["lda_x", "gga_x_pbe", "mgga_x_scan"]
+)
+def test_cgto_vxc_polarized(xcstr):
+    # test the vxc and the xc energy of the polarized density matrices obtained
+    # in a single pass against the ones obtained per spin
+    torch.manual_seed(123)
+    poss = torch.tensor([[0.0, 0.0, 0.8], [0.0, 0.0, -0.8], [0.3, 1.2, 0.1]], dtype=dtype)
+    moldesc = ([1, 1, 8], poss)
+    m = Mol(moldesc, basis="3-21G", dtype=dtype, grid=3)
+    m.setup_grid()
+    ham = m.get_hamiltonian().build()
+    xc = get_xc(xcstr)
+    ham.setup_grid(m.get_grid(), xc)
+
+    nao = ham.nao
+    dm_u = torch.rand((nao, nao), dtype=dtype)
+    dm_d = torch.rand((nao, nao), dtype=dtype)
+    dm = SpinParam(u=dm_u + dm_u.T, d=dm_d + dm_d.T)
+    vxc = ham.get_vxc(dm)
+    exc = ham.get_e_xc(dm)
+
+    densinfo = SpinParam(u=ham._dm2densinfo(dm.u), d=ham._dm2densinfo(dm.d))
+    potinfo = xc.get_vxc(densinfo)
+    vxc_u0 = ham._get_vxc_from_potinfo(potinfo.u).fullmatrix()
+    vxc_d0 = ham._get_vxc_from_potinfo(potinfo.d).fullmatrix()
+    exc0 = torch.sum(ham.grid.get_dvolume() * xc.get_edensityxc(densinfo), dim=-1)
+    assert torch.allclose(vxc.u.fullmatrix(), vxc_u0)
+    assert torch.allclose(vxc.d.fullmatrix(), vxc_d0)
+    assert torch.allclose(exc, exc0)
+
 def test_pbc_cgto_nuclattr(pbc_h1):
     import numpy as np
     # nuc = pbc_h1.get_nuc()
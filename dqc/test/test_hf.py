@@ -5,6 +5,8 @@ import pytest
 import xitorch as xt
 from dqc.api.loadbasis import loadbasis
 from dqc.qccalc.hf import HF
+from dqc.qccalc.diis import diis_equilibrium
+from dqc.qccalc.guess import get_sad_dm, get_huckel_dm, get_projected_dm, get_extrapolated_dm
 from dqc.system.mol import Mol
 from dqc.system.sol import Sol
 from dqc.utils.safeops import safepow, safenorm
@@ -53,6 +55,50 @@ def test_rhf_energy(atomzs, dist, energy_true, variational):
     if atomzs == [1, 1]:
         xt.set_debug_mode(False)
 
+@pytest.mark.parametrize(
+    "atomzs,dist,energy_true",
+    [(*atomz_pos, energy) for (atomz_pos, energy) in zip(atomzs_poss, energies)]
+)
+def test_rhf_energy_eri_s8(atomzs, dist, energy_true):
+    # test the energy with the 8-fold symmetry packed electron repulsion integrals
+    torch.manual_seed(123)
+
+    poss = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype) * dist
+    mol = Mol((atomzs, poss), basis=basis, dtype=dtype, eri_mode="s8")
+    qc = HF(mol, restricted=True).run()
+    ene = qc.energy()
+    assert torch.allclose(ene, ene * 0 + energy_true, rtol=1e-7)
+
+@pytest.mark.parametrize(
+    "atomzs,dist,energy_true",
+    [(*atomz_pos, energy) for (atomz_pos, energy) in zip(atomzs_poss, energies)]
+)
+def test_rhf_energy_eri_direct(atomzs, dist, energy_true):
+    # test the energy with the direct calculation of the Coulomb and exchange
+    torch.manual_seed(123)
+
+    poss = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype) * dist
+    mol = Mol((atomzs, poss), basis=basis, dtype=dtype, eri_mode="direct")
+    qc = HF(mol, restricted=True).run()
+    ene = qc.energy()
+    assert torch.allclose(ene, ene * 0 + energy_true, rtol=1e-7)
+
+@pytest.mark.parametrize(
+    "atomzs,dist",
+    atomzs_poss[:2]
+)
+def test_rhf_grad_pos_eri_s8(atomzs, dist):
+    # test grad of energy w.r.t. atom's position with packed integrals
+    torch.manual_seed(123)
+
+    def get_energy(dist_tensor):
+        poss_tensor = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype) * dist_tensor
+        mol = Mol((atomzs, poss_tensor), basis=basis, dtype=dtype, eri_mode="s8")
+        qc = HF(mol, restricted=True).run()
+        return qc.energy()
+    dist_tensor = torch.tensor(dist, dtype=dtype, requires_grad=True)
+    torch.autograd.gradcheck(get_energy, (dist_tensor,))
+
 @pytest.mark.parametrize(
     "atomzs,dist,energy_true,variational",
     [(*atomz_pos, energy, False) for (atomz_pos, energy) in zip(atomzs_poss[:1], energies[:1])] +
@@ -110,6 +156,192 @@ def test_rhf_grad_pos(atomzs, dist, grad2, variational):
         else:
             torch.autograd.gradcheck(get_energy, (dist_tensor,))
 
+@pytest.mark.parametrize(
+    "atomzs,dist,energy_true,hybrid",
+    [(*atomz_pos, energy, hybrid) for ((atomz_pos, energy), hybrid) in \
+        product(zip(atomzs_poss, energies), ["adiis", "ediis", None])]
+)
+def test_rhf_energy_diis(atomzs, dist, energy_true, hybrid):
+    # test the DIIS-accelerated iterations converge to the same energy
+    poss = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype) * dist
+    mol = Mol((atomzs, poss), basis=basis, dtype=dtype)
+    qc = HF(mol, restricted=True).run(fwd_options={"method": "diis", "hybrid": hybrid})
+    ene = qc.energy()
+    assert torch.allclose(ene, ene * 0 + energy_true)
+
+@pytest.mark.parametrize(
+    "hybrid",
+    ["adiis", "ediis", None]
+)
+def test_diis_complex(hybrid):
+    # test DIIS on a model self-consistent problem with complex Hermitian
+    # matrices of 2 weighted k-points, F(D) = H + D / 2, E(D) = tr(H D) + tr(D D) / 4
+    torch.manual_seed(123)
+    nkpts, nao, nocc = 2, 6, 2
+    cdtype = torch.complex128
+    a = torch.randn((nkpts, nao, nao), dtype=cdtype)
+    hmat = (a + a.transpose(-2, -1).conj()) * 0.5
+    ovlp = torch.eye(nao, dtype=cdtype).expand(nkpts, nao, nao)
+    wkpts = torch.tensor([0.25, 0.75], dtype=dtype)
+
+    def scp2dm(fock):
+        _, evecs = torch.linalg.eigh(fock)
+        orb = evecs[..., :nocc]
+        return torch.matmul(orb, orb.transpose(-2, -1).conj())
+
+    def dm2scp(dm):
+        return hmat + 0.5 * dm
+
+    def dm2energy(dm):
+        return torch.einsum("kij,kji,k->", hmat + 0.25 * dm, dm, wkpts.to(cdtype)).real
+
+    fock, niter, err = diis_equilibrium(dm2scp(scp2dm(hmat)), scp2dm, dm2scp, ovlp,
+                                        dm2energy=dm2energy, wkpts=wkpts,
+                                        maxiter=100, f_tol=1e-10, hybrid=hybrid)
+    assert err < 1e-10
+    assert niter < 100
+    dm = scp2dm(fock)
+    assert torch.allclose(dm2scp(dm), fock)
+    fd = torch.matmul(fock, dm)
+    assert torch.allclose(fd, fd.transpose(-2, -1).conj(), atol=1e-9)
+
+@pytest.mark.parametrize(
+    "atomzs,dist,energy_true,dm0",
+    [(*atomz_pos, energy, dm0) for ((atomz_pos, energy), dm0) in \
+        product(zip(atomzs_poss, energies), ["sad", "huckel"])]
+)
+def test_rhf_energy_guess(atomzs, dist, energy_true, dm0):
+    # test the SCF starting from the atomic initial guesses
+    poss = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype) * dist
+    mol = Mol((atomzs, poss), basis=basis, dtype=dtype)
+    qc = HF(mol, restricted=True).run(dm0=dm0)
+    ene = qc.energy()
+    assert torch.allclose(ene, ene * 0 + energy_true)
+
+@pytest.mark.parametrize(
+    "atomzs,dist,energy_true",
+    [(*atomz_pos, energy) for (atomz_pos, energy) in zip(atomzs_poss, energies)]
+)
+def test_rhf_energy_warm_start(atomzs, dist, energy_true):
+    # test the SCF warm-started from the calculations with different geometry,
+    # basis, and orthogonalizer converges to the same energy
+    poss = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype)
+    mol_prev = Mol((atomzs, poss * (dist * 1.05)), basis="STO-3G", dtype=dtype,
+                   orthogonalize_basis=False)
+    qc_prev = HF(mol_prev, restricted=True).run()
+
+    mol = Mol((atomzs, poss * dist), basis=basis, dtype=dtype)
+    for dm0 in [qc_prev, [qc_prev]]:
+        qc = HF(mol, restricted=True).run(dm0=dm0)
+        ene = qc.energy()
+        assert torch.allclose(ene, ene * 0 + energy_true)
+
+def test_rhf_dm_extrapolation():
+    # test the extrapolation of the density matrices from the previous geometries
+    atomzs, dist = atomzs_poss[4]
+    poss = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype)
+    dists = [dist * 0.98, dist * 0.99, dist * 1.0]
+    qcs = [HF(Mol((atomzs, poss * d), basis=basis, dtype=dtype), restricted=True).run()
+           for d in dists]
+
+    # extrapolated density matrix is closer to the converged one than the
+    # projected density matrix from the latest geometry
+    mol = Mol((atomzs, poss * (dist * 1.01)), basis=basis, dtype=dtype)
+    qc = HF(mol, restricted=True).run(dm0=qcs)
+    dm_extrap = get_extrapolated_dm(qcs, mol, polarized=False)
+    dm_proj = get_projected_dm(qcs[-1], mol, polarized=False)
+    assert (dm_extrap - qc.aodm()).abs().max() < (dm_proj - qc.aodm()).abs().max()
+    assert torch.allclose(torch.trace(dm_extrap), torch.tensor(14.0, dtype=dtype))
+
+@pytest.mark.parametrize(
+    "atomzs,dist,energy_true",
+    [(*atomz_pos, energy) for (atomz_pos, energy) in zip(atomzs_poss, energies)]
+)
+def test_rhf_energy_davidson(atomzs, dist, energy_true):
+    # test the SCF with the warm-started davidson eigensolver and its gradient,
+    # max_frac = 1 forces the davidson iterations even in the small basis
+    def get_energy(dist_tensor):
+        poss_tensor = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype) * dist_tensor
+        mol = Mol((atomzs, poss_tensor), basis=basis, dtype=dtype)
+        qc = HF(mol, restricted=True).run(eigen_options={"method": "davidson", "min_eps": 1e-10,
+                                                         "max_frac": 1.0})
+        return qc.energy()
+
+    dist_tensor = torch.tensor(dist, dtype=dtype, requires_grad=True)
+    ene = get_energy(dist_tensor)
+    assert torch.allclose(ene, ene * 0 + energy_true)
+    torch.autograd.gradcheck(get_energy, (dist_tensor,))
+
+@pytest.mark.parametrize(
+    "atomzs,dist",
+    [([7, 7], 2.0), ([6, 8], 2.0)]
+)
+def test_rhf_davidson_iterations(atomzs, dist):
+    # test the davidson iterations (not the dense fallback) in a larger basis
+    # agree with the exact eigensolver and the warm start from the previous
+    # SCF iteration reduces the number of davidson iterations
+    poss = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype) * dist
+
+    def run(eigen_options):
+        mol = Mol((atomzs, poss), basis="6-311++G**", dtype=dtype)
+        with torch.no_grad():
+            return HF(mol, restricted=True).run(eigen_options=eigen_options).energy()
+
+    ene_exact = run({"method": "exacteig"})
+    info_warm = {}
+    ene_warm = run({"method": "davidson", "min_eps": 1e-10, "max_frac": 1.0, "info": info_warm})
+    info_cold = {}
+    ene_cold = run({"method": "davidson", "min_eps": 1e-10, "max_frac": 1.0, "info": info_cold,
+                    "v_init": "diag"})
+    assert torch.allclose(ene_warm, ene_exact, rtol=0, atol=1e-9)
+    assert torch.allclose(ene_cold, ene_exact, rtol=0, atol=1e-9)
+
+    # every diagonalization runs the davidson iterations
+    assert min(info_warm["niter"]) > 0 and min(info_cold["niter"]) > 0
+    # the first diagonalization has no previous eigenvectors
+    niter_warm = np.mean(info_warm["niter"][1:])
+    niter_cold = np.mean(info_cold["niter"][1:])
+    assert niter_warm < niter_cold
+
+@pytest.mark.parametrize(
+    "atomzs,dist,energy_true",
+    [(*atomz_pos, energy) for (atomz_pos, energy) in zip(atomzs_poss, energies)]
+)
+def test_rhf_energy_trust_region(atomzs, dist, energy_true):
+    # test the variational trust-region minimization over the orbital rotations
+    # and the implicit gradient at its minimum
+    torch.manual_seed(123)
+    bck_options = {
+        "rtol": 1e-10,
+        "atol": 1e-10,
+    }
+
+    def get_energy(dist_tensor):
+        poss_tensor = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype) * dist_tensor
+        mol = Mol((atomzs, poss_tensor), basis=basis, dtype=dtype)
+        qc = HF(mol, restricted=True, variational=True).run(
+            fwd_options={"method": "trust-region", "g_tol": 1e-10}, bck_options=bck_options)
+        return qc.energy()
+
+    dist_tensor = torch.tensor(dist, dtype=dtype, requires_grad=True)
+    ene = get_energy(dist_tensor)
+    assert torch.allclose(ene, ene * 0 + energy_true, rtol=1e-7)
+    torch.autograd.gradcheck(get_energy, (dist_tensor,), rtol=4e-3)
+
+@pytest.mark.parametrize(
+    "atomzs,dist",
+    atomzs_poss[:2]
+)
+def test_rhf_grad_pos_diis(atomzs, dist):
+    # test the gradients through the equilibrium after the DIIS iterations
+    def get_energy(dist_tensor):
+        poss_tensor = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype) * dist_tensor
+        mol = Mol((atomzs, poss_tensor), basis=basis, dtype=dtype)
+        qc = HF(mol, restricted=True).run(fwd_options={"method": "diis"})
+        return qc.energy()
+    dist_tensor = torch.tensor(dist, dtype=dtype, requires_grad=True)
+    torch.autograd.gradcheck(get_energy, (dist_tensor,))
+
 def test_rhf_basis_inputs():
     # test to see if the various basis inputs produce the same results
     atomzs = [1, 1]
@@ -205,6 +437,58 @@ def test_uhf_energy_mols(atomzs, dist, spin, energy_true, variational):
     ene = qc.energy()
     assert torch.allclose(ene, ene * 0 + energy_true, rtol=1e-8, atol=0.0)
 
+@pytest.mark.parametrize(
+    "atomzs,dist,spin,energy_true",
+    [(atomzs, dist, spin, energy) for ((atomzs, dist, spin), energy)
+        in zip(u_mols_dists_spins, u_mols_energies)]
+)
+def test_uhf_energy_mols_trust_region(atomzs, dist, spin, energy_true):
+    # check the energy of the open-shell molecules with the trust-region
+    # minimization over the orbital rotations
+    poss = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype) * dist
+    mol = Mol((atomzs, poss), basis=basis, dtype=dtype, spin=spin)
+    qc = HF(mol, restricted=False, variational=True).run(
+        fwd_options={"method": "trust-region", "g_tol": 1e-9})
+    ene = qc.energy()
+    assert torch.allclose(ene, ene * 0 + energy_true, rtol=1e-8, atol=0.0)
+
+@pytest.mark.parametrize(
+    "atomzs,dist,spin,energy_true",
+    [(atomzs, dist, spin, energy) for ((atomzs, dist, spin), energy)
+        in zip(u_mols_dists_spins, u_mols_energies)]
+)
+def test_uhf_energy_mols_diis(atomzs, dist, spin, energy_true):
+    # check the DIIS-accelerated iterations with the polarized fock matrices
+    poss = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype) * dist
+    mol = Mol((atomzs, poss), basis=basis, dtype=dtype, spin=spin)
+    qc = HF(mol, restricted=False).run(fwd_options={"method": "diis"})
+    ene = qc.energy()
+    assert torch.allclose(ene, ene * 0 + energy_true, rtol=1e-8, atol=0.0)
+
+@pytest.mark.parametrize(
+    "atomzs,dist,spin,energy_true,dm0",
+    [(atomzs, dist, spin, energy, dm0) for (((atomzs, dist, spin), energy), dm0)
+        in product(zip(u_mols_dists_spins, u_mols_energies), ["sad", "huckel"])]
+)
+def test_uhf_energy_mols_guess(atomzs, dist, spin, energy_true, dm0):
+    # check the atomic initial guesses for the polarized systems
+    poss = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype) * dist
+    mol = Mol((atomzs, poss), basis=basis, dtype=dtype, spin=spin)
+    qc = HF(mol, restricted=False).run(dm0=dm0)
+    ene = qc.energy()
+    assert torch.allclose(ene, ene * 0 + energy_true, rtol=1e-8, atol=0.0)
+
+def test_guess_dm_nelecs():
+    # the initial guesses must have the correct number of electrons
+    poss = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype) * 2.0
+    for orthogonalize_basis in [True, False]:
+        mol = Mol(([6, 8], poss), basis=basis, dtype=dtype,
+                  orthogonalize_basis=orthogonalize_basis)
+        h = mol.get_hamiltonian().build()
+        ovlp = h.get_overlap().fullmatrix()
+        for dm in [get_sad_dm(mol, False), get_huckel_dm(mol, False)]:
+            assert torch.allclose(torch.trace(dm @ ovlp), torch.tensor(14.0, dtype=dtype))
+
 ############## Fractional charge ##############
 def test_rhf_frac_energy():
     # test if fraction of atomz produces close/same results with integer atomz
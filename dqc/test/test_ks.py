@@ -136,6 +136,74 @@ def test_rks_grad_pos(xc, atomzs, dist, grad2):
     else:
         torch.autograd.gradcheck(get_energy, (dist_tensor,))
 
+@pytest.mark.parametrize(
+    "xc,atomzs,dist",
+    [("lda_x", *atomzs_poss[0]), ("gga_x_pbe", *atomzs_poss[4])]
+)
+def test_rks_coarse_grid(xc, atomzs, dist):
+    # test the SCF with the early iterations on a coarse grid gives the same
+    # energy and gradient as the SCF on the final grid only
+    def get_energy(dist_tensor, coarse_grid):
+        poss_tensor = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype) * dist_tensor
+        mol = Mol((atomzs, poss_tensor), basis="3-21G", dtype=dtype, grid=3)
+        qc = KS(mol, xc=xc, restricted=True, coarse_grid=coarse_grid).run()
+        return qc.energy()
+
+    res = []
+    for coarse_grid in [None, 1]:
+        dist_tensor = torch.tensor(dist, dtype=dtype, requires_grad=True)
+        ene = get_energy(dist_tensor, coarse_grid)
+        grad, = torch.autograd.grad(ene, dist_tensor)
+        res.append((ene, grad))
+
+    assert torch.allclose(res[0][0], res[1][0], rtol=0, atol=1e-8)
+    assert torch.allclose(res[0][1], res[1][1], rtol=0, atol=1e-6)
+
+def test_rks_coarse_grid_interrupted():
+    # test the final grid is restored if the iterations on the coarse grid
+    # are interrupted, so the energy is not evaluated on the coarse grid
+    atomzs, dist = atomzs_poss[0]
+    poss = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype) * dist
+    mol = Mol((atomzs, poss), basis="3-21G", dtype=dtype, grid=3)
+    qc = KS(mol, xc="lda_x", restricted=True, coarse_grid=1)
+
+    def run_coarse_scf(dm, fwd_options):
+        raise RuntimeError("Interrupted")
+    qc._run_coarse_scf = run_coarse_scf  # type: ignore
+    with pytest.raises(RuntimeError):
+        qc.run()
+
+    mol_ref = Mol((atomzs, poss), basis="3-21G", dtype=dtype, grid=3)
+    qc_ref = KS(mol_ref, xc="lda_x", restricted=True).run()
+    ene = qc.dm2energy(qc_ref.aodm())
+    assert torch.allclose(ene, qc_ref.energy(), rtol=0, atol=1e-10)
+
+@pytest.mark.parametrize(
+    "ordering,ao_grid_mode",
+    list(product(["morton", "hilbert"], ["cache", "recompute"]))
+)
+def test_rks_grid_ordering(ordering, ao_grid_mode):
+    # test the energy and the gradient with the grid points ordered along a
+    # space-filling curve are the same as the ones with the per-atom order
+    atomzs, dist = atomzs_poss[4]
+
+    def get_energy(dist_tensor, ordering):
+        poss_tensor = torch.tensor([[-0.5, 0.0, 0.0], [0.5, 0.0, 0.0]], dtype=dtype) * dist_tensor
+        mol = Mol((atomzs, poss_tensor), basis="3-21G", dtype=dtype, grid=3,
+                  ao_grid_mode=ao_grid_mode, grid_ordering=ordering)
+        qc = KS(mol, xc="gga_x_pbe", restricted=True).run()
+        return qc.energy()
+
+    res = []
+    for grid_ordering in [None, ordering]:
+        dist_tensor = torch.tensor(dist, dtype=dtype, requires_grad=True)
+        ene = get_energy(dist_tensor, grid_ordering)
+        grad, = torch.autograd.grad(ene, dist_tensor)
+        res.append((ene, grad))
+
+    assert torch.allclose(res[0][0], res[1][0], rtol=0, atol=1e-8)
+    assert torch.allclose(res[0][1], res[1][1], rtol=0, atol=1e-6)
+
 def test_rks_grad_basis():
     # test grad of energy w.r.t. bases
     torch.manual_seed(123)
@@ -570,6 +638,57 @@ def test_pbc_rks_energy(xc, atomzs, spin, alattice, energy_true, grid):
     # TODO: make a better grid
     assert torch.allclose(ene, energy_true, rtol=1e-3)
 
+@pytest.mark.parametrize(
+    "atomzs,spin,alattice,dm0",
+    [(*a, dm0) for a in pbc_atomz_spin_latt for dm0 in ["sad", "huckel"]]
+)
+def test_pbc_rks_energy_guess(atomzs, spin, alattice, dm0):
+    # test the atomic initial guesses converge to the same energy in PBC
+    alattice = torch.as_tensor(alattice, dtype=dtype)
+    poss = torch.tensor([[0.0, 0.0, 0.0]], dtype=dtype)
+    enes = []
+    for dm0_i in ["1e", dm0]:
+        mol = Sol((atomzs, poss), basis="3-21G", spin=spin, alattice=alattice, dtype=dtype, grid="sg3")
+        mol.densityfit(method="gdf", auxbasis="def2-sv(p)-jkfit")
+        qc = KS(mol, xc="lda_x", restricted=False).run(dm0=dm0_i)
+        enes.append(qc.energy())
+    assert torch.allclose(enes[0], enes[1])
+
+@pytest.mark.parametrize(
+    "atomzs,spin,alattice",
+    pbc_atomz_spin_latt
+)
+def test_pbc_rks_warm_start(atomzs, spin, alattice):
+    # the warm start from the previous calculation is not available in PBC
+    # and it must fail early with a clear error
+    alattice = torch.as_tensor(alattice, dtype=dtype)
+    poss = torch.tensor([[0.0, 0.0, 0.0]], dtype=dtype)
+    mol = Sol((atomzs, poss), basis="3-21G", spin=spin, alattice=alattice, dtype=dtype, grid="sg3")
+    mol.densityfit(method="gdf", auxbasis="def2-sv(p)-jkfit")
+    qc = KS(mol, xc="lda_x", restricted=False).run()
+    with pytest.raises(NotImplementedError, match="periodic"):
+        KS(mol, xc="lda_x", restricted=False).run(dm0=qc)
+    with pytest.raises(NotImplementedError, match="periodic"):
+        KS(mol, xc="lda_x", restricted=False).run(dm0=[qc, qc])
+
+@pytest.mark.parametrize(
+    "atomzs,spin,alattice",
+    pbc_atomz_spin_latt
+)
+def test_pbc_rks_energy_diis(atomzs, spin, alattice):
+    # test the DIIS iterations with the complex Fock matrices in PBC converge
+    # to the same energy
+    alattice = torch.as_tensor(alattice, dtype=dtype)
+    poss = torch.tensor([[0.0, 0.0, 0.0]], dtype=dtype)
+    enes = []
+    for fwd_options in [None, {"method": "diis"}, {"method": "diis", "hybrid": "ediis"}]:
+        mol = Sol((atomzs, poss), basis="3-21G", spin=spin, alattice=alattice, dtype=dtype, grid="sg3")
+        mol.densityfit(method="gdf", auxbasis="def2-sv(p)-jkfit")
+        qc = KS(mol, xc="lda_x", restricted=False).run(fwd_options=fwd_options)
+        enes.append(qc.energy())
+    assert torch.allclose(enes[0], enes[1])
+    assert torch.allclose(enes[0], enes[2])
+
 if __name__ == "__main__":
     import time
     xc = "lda_x"
@@ -8,6 +8,7 @@ from dqc.api.loadbasis import loadbasis
 import dqc.hamilton.intor as intor
 from dqc.utils.datastruct import AtomCGTOBasis, CGTOBasis
 from dqc.hamilton.intor.lattice import Lattice
+from dqc.utils.config import config
 
 # import pyscf
 try:
@@ -198,6 +199,243 @@ def test_integral_with_subset(intc_type):
     else:
         raise RuntimeError("Unknown integral type: %s" % intc_type)
 
+@pytest.mark.parametrize(
+    "thresh",
+    [1e-13, 1e-8]
+)
+def test_elrep_screening(thresh):
+    # check if the screened electron repulsion integrals agree with the
+    # unscreened ones for atoms that are far apart from each other
+    atomenv = get_atom_env(dtype, d=8.0)
+    env = get_wrapper(atomenv, spherical=True)
+    env1 = env[: len(env) // 2]
+
+    bounds = env.full_schwarz_bounds()
+    assert np.allclose(bounds, bounds.T)
+
+    try:
+        thresh0 = config.ERI_SCREEN_THRESHOLD
+        config.ERI_SCREEN_THRESHOLD = 0.0
+        mat_full = intor.elrep(env)
+        mat_sub = intor.elrep(env, other1=env1, other2=env1)
+
+        config.ERI_SCREEN_THRESHOLD = thresh
+        mat_full_screen = intor.elrep(env)
+        mat_sub_screen = intor.elrep(env, other1=env1, other2=env1)
+    finally:
+        config.ERI_SCREEN_THRESHOLD = thresh0
+
+    # some elements must be screened
+    assert torch.any((mat_full_screen == 0) & (mat_full != 0))
+    assert torch.allclose(mat_full, mat_full_screen, rtol=0, atol=thresh)
+    assert torch.allclose(mat_sub, mat_sub_screen, rtol=0, atol=thresh)
+
+def test_elrep_screening_deriv():
+    # check if the screened derivatives of the electron repulsion integrals,
+    # bounded by the Schwarz inequality of the derivative pairs, agree with
+    # the unscreened ones
+    thresh = 1e-8
+    atomenv = get_atom_env(dtype, d=8.0)
+    env = get_wrapper(atomenv, spherical=True)
+
+    try:
+        thresh0 = config.ERI_SCREEN_THRESHOLD
+        config.ERI_SCREEN_THRESHOLD = 0.0
+        mat_full = intor.int2e("ipar12b", env)
+
+        config.ERI_SCREEN_THRESHOLD = thresh
+        mat_screen = intor.int2e("ipar12b", env)
+    finally:
+        config.ERI_SCREEN_THRESHOLD = thresh0
+
+    # some elements must be screened
+    assert torch.any((mat_screen == 0) & (mat_full != 0))
+    assert torch.allclose(mat_full, mat_screen, rtol=0, atol=thresh)
+
+def test_elrep_screening_grad_pos():
+    # check if the gradients w.r.t. the atomic positions calculated with the
+    # screened derivative integrals agree with the unscreened ones
+    atomenv = get_atom_env(dtype, d=8.0)
+    poss = atomenv.poss
+    allbases = [
+        loadbasis("%d:%s" % (atomz, atomenv.basis), dtype=dtype, requires_grad=False)
+        for atomz in atomenv.atomzs
+    ]
+
+    def get_elrep(*poss):
+        atombases = [
+            AtomCGTOBasis(atomz=atomenv.atomzs[i], bases=allbases[i], pos=poss[i]) \
+            for i in range(len(poss))
+        ]
+        env = intor.LibcintWrapper(atombases, spherical=True)
+        return intor.elrep(env)
+
+    torch.manual_seed(123)
+    w = torch.rand_like(get_elrep(*poss))
+    try:
+        thresh0 = config.ERI_SCREEN_THRESHOLD
+        config.ERI_SCREEN_THRESHOLD = 0.0
+        grads0 = torch.autograd.grad((get_elrep(*poss) * w).sum(), poss)
+
+        config.ERI_SCREEN_THRESHOLD = 1e-13
+        grads1 = torch.autograd.grad((get_elrep(*poss) * w).sum(), poss)
+    finally:
+        config.ERI_SCREEN_THRESHOLD = thresh0
+
+    for (g0, g1) in zip(grads0, grads1):
+        assert torch.allclose(g0, g1)
+
+def test_elrep_packed():
+    # check if the packed electron repulsion integrals agree with the full ones
+    atomenv = get_atom_env(dtype)
+    env = get_wrapper(atomenv, spherical=True)
+    mat_full = intor.elrep(env)
+    mat_packed = intor.elrep(env, packed=True)
+
+    nao = env.nao()
+    npair = nao * (nao + 1) // 2
+    assert mat_packed.shape == (npair * (npair + 1) // 2,)
+    assert torch.allclose(intor.pack_s8(mat_full), mat_packed)
+    assert torch.allclose(intor.unpack_s8(mat_packed), mat_full)
+
+def test_elrep_packed_grad_pos():
+    atomenv = get_atom_env(dtype)
+    poss = atomenv.poss
+    allbases = [
+        loadbasis("%d:%s" % (atomz, atomenv.basis), dtype=dtype, requires_grad=False)
+        for atomz in atomenv.atomzs
+    ]
+
+    def get_elrep(*poss):
+        atombases = [
+            AtomCGTOBasis(atomz=atomenv.atomzs[i], bases=allbases[i], pos=poss[i]) \
+            for i in range(len(poss))
+        ]
+        env = intor.LibcintWrapper(atombases, spherical=True)
+        return intor.elrep(env, packed=True)
+
+    torch.autograd.gradcheck(get_elrep, (*poss,))
+    torch.autograd.gradgradcheck(get_elrep, (*poss,))
+
+@pytest.mark.parametrize(
+    "others",
+    [(None, "sub", None), (None, None, None), ("sub", None, "sub"), (None, "sub", "sub")]
+)
+def test_elrep_grad_pos_blocked(others):
+    # check the gradient of the electron repulsion integrals w.r.t. the atomic
+    # positions calculated in blocks against the one calculated at once, with
+    # the (partial) permutation symmetry of the wrappers
+    atomenv = get_atom_env(dtype)
+    poss = atomenv.poss
+    allbases = [
+        loadbasis("%d:%s" % (atomz, atomenv.basis), dtype=dtype, requires_grad=False)
+        for atomz in atomenv.atomzs
+    ]
+
+    def get_elrep(*poss):
+        atombases = [
+            AtomCGTOBasis(atomz=atomenv.atomzs[i], bases=allbases[i], pos=poss[i]) \
+            for i in range(len(poss))
+        ]
+        env = intor.LibcintWrapper(atombases, spherical=True)
+        env1 = env[: len(env) // 2]
+        other1, other2, other3 = [env1 if other == "sub" else None for other in others]
+        return intor.elrep(env, other1=other1, other2=other2, other3=other3)
+
+    torch.manual_seed(123)
+    w = torch.rand_like(get_elrep(*poss))
+    grads0 = torch.autograd.grad((get_elrep(*poss) * w).sum(), poss)
+    try:
+        chunk_memory0 = config.CHUNK_MEMORY
+        config.CHUNK_MEMORY = 1  # calculate the derivatives shell-by-shell
+        grads1 = torch.autograd.grad((get_elrep(*poss) * w).sum(), poss)
+        torch.autograd.gradgradcheck(get_elrep, (*poss,))
+    finally:
+        config.CHUNK_MEMORY = chunk_memory0
+
+    for (g0, g1) in zip(grads0, grads1):
+        assert torch.allclose(g0, g1)
+
+@pytest.mark.parametrize(
+    "int_type",
+    ["elrep", "coul3c", "coul2c"]
+)
+def test_integral_grad_basis_blocked(int_type):
+    # check the gradient of the integrals w.r.t. the basis parameters calculated
+    # in blocks against the one calculated at once
+    torch.manual_seed(123)
+    atomenv = get_atom_env(dtype, pos_requires_grad=False)
+    poss = atomenv.poss
+    natoms = len(poss)
+    nangmom, ncontr = 2, 2
+    alphas = torch.rand((natoms, nangmom, ncontr), dtype=dtype, requires_grad=True)
+    coeffs = torch.rand((natoms, nangmom, ncontr), dtype=dtype, requires_grad=True)
+
+    def get_int(alphas, coeffs):
+        atombases = [
+            AtomCGTOBasis(atomz=atomenv.atomzs[j], pos=poss[j], bases=[
+                CGTOBasis(angmom=i, alphas=alphas[j][i], coeffs=coeffs[j][i], normalized=True)
+                for i in range(nangmom)
+            ])
+            for j in range(natoms)
+        ]
+        env = intor.LibcintWrapper(atombases, spherical=True)
+        return getattr(intor, int_type)(env)
+
+    w = torch.rand_like(get_int(alphas, coeffs))
+    grads0 = torch.autograd.grad((get_int(alphas, coeffs) * w).sum(), (alphas, coeffs))
+    try:
+        chunk_memory0 = config.CHUNK_MEMORY
+        config.CHUNK_MEMORY = 1  # calculate the derivatives shell-by-shell
+        grads1 = torch.autograd.grad((get_int(alphas, coeffs) * w).sum(), (alphas, coeffs))
+        torch.autograd.gradcheck(get_int, (alphas, coeffs))
+    finally:
+        config.CHUNK_MEMORY = chunk_memory0
+
+    for (g0, g1) in zip(grads0, grads1):
+        assert torch.allclose(g0, g1)
+
+@pytest.mark.parametrize(
+    "others",
+    [(None, None, None), (None, "sub", None), ("sub", None, "sub"), (None, "sub", "sub")]
+)
+def test_elrep_grad_basis_blocked_symm(others):
+    # check the gradient of the electron repulsion integrals w.r.t. the basis
+    # parameters calculated in blocks with the (partial) permutation symmetry
+    # of the wrappers against the one calculated at once
+    torch.manual_seed(123)
+    atomenv = get_atom_env(dtype, pos_requires_grad=False)
+    poss = atomenv.poss
+    natoms = len(poss)
+    nangmom, ncontr = 2, 2
+    alphas = torch.rand((natoms, nangmom, ncontr), dtype=dtype, requires_grad=True)
+    coeffs = torch.rand((natoms, nangmom, ncontr), dtype=dtype, requires_grad=True)
+
+    def get_elrep(alphas, coeffs):
+        atombases = [
+            AtomCGTOBasis(atomz=atomenv.atomzs[j], pos=poss[j], bases=[
+                CGTOBasis(angmom=i, alphas=alphas[j][i], coeffs=coeffs[j][i], normalized=True)
+                for i in range(nangmom)
+            ])
+            for j in range(natoms)
+        ]
+        env = intor.LibcintWrapper(atombases, spherical=True)
+        env1 = env[: len(env) // 2]
+        other1, other2, other3 = [env1 if other == "sub" else None for other in others]
+        return intor.elrep(env, other1=other1, other2=other2, other3=other3)
+
+    w = torch.rand_like(get_elrep(alphas, coeffs))
+    grads0 = torch.autograd.grad((get_elrep(alphas, coeffs) * w).sum(), (alphas, coeffs))
+    try:
+        chunk_memory0 = config.CHUNK_MEMORY
+        config.CHUNK_MEMORY = 1  # calculate the derivatives shell-by-shell
+        grads1 = torch.autograd.grad((get_elrep(alphas, coeffs) * w).sum(), (alphas, coeffs))
+    finally:
+        config.CHUNK_MEMORY = chunk_memory0
+
+    for (g0, g1) in zip(grads0, grads1):
+        assert torch.allclose(g0, g1)
+
 def test_nuc_integral_frac_atomz():
     # test the nuclear integral with fractional atomz
     atomenv1 = get_atom_env(dtype, atomz=1)
@@ -1297,3 +1535,53 @@ def test_wrapper_concat():
         assert False
     except AssertionError:  # TODO: change into ValueError
         pass
+
+@pytest.mark.parametrize(
+    "int_type",
+    ["overlap", "elrep", "eval_gto"]
+)
+def test_wrapper_general_contraction(int_type):
+    # the bases with the shared alphas are put in one shell with multiple
+    # contractions, which must give the same results as separate shells
+    torch.manual_seed(123)
+    alphas = torch.tensor([3.4, 1.2, 0.3], dtype=dtype, requires_grad=True)
+    coeffs = torch.rand((3, 3), dtype=dtype, requires_grad=True)  # (ncontr, ngauss)
+    poss = [torch.tensor([0.1, 0.0, 0.2], dtype=dtype),
+            torch.tensor([0.0, 1.0, -0.4], dtype=dtype)]
+    rgrid = torch.rand((5, 3), dtype=dtype)
+
+    def get_int(alphas, coeffs, share: bool):
+        def get_alphas():
+            return alphas if share else alphas * 1.0
+        bases = [
+            CGTOBasis(angmom=0, alphas=get_alphas(), coeffs=coeffs[0]),
+            CGTOBasis(angmom=0, alphas=get_alphas(), coeffs=coeffs[1]),
+            CGTOBasis(angmom=1, alphas=get_alphas(), coeffs=coeffs[2]),
+        ]
+        atombases = [AtomCGTOBasis(atomz=1, bases=bases, pos=pos) for pos in poss]
+        env = intor.LibcintWrapper(atombases, spherical=True)
+        if share:
+            assert len(env) == 4
+            assert list(env.atm_bas_env[1][:, 3]) == [2, 1, 2, 1]
+        else:
+            assert len(env) == 6
+        env1 = env[1:] if share else env[2:]  # starting from the p shell of the first atom
+        if int_type == "overlap":
+            return intor.overlap(env, other=env1)
+        elif int_type == "elrep":
+            return intor.elrep(env, other2=env1)
+        elif int_type == "eval_gto":
+            return intor.eval_gto(env1, rgrid)
+        else:
+            raise RuntimeError("Unknown int_type: %s" % int_type)
+
+    res_sep = get_int(alphas, coeffs, share=False)
+    res_gen = get_int(alphas, coeffs, share=True)
+    assert torch.allclose(res_sep, res_gen)
+
+    # the gradients w.r.t. the parameters
+    w = torch.rand_like(res_sep)
+    grads_sep = torch.autograd.grad((res_sep * w).sum(), (alphas, coeffs))
+    grads_gen = torch.autograd.grad((res_gen * w).sum(), (alphas, coeffs))
+    for (g0, g1) in zip(grads_sep, grads_gen):
+        assert torch.allclose(g0, g1)
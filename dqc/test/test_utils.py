@@ -1,4 +1,7 @@
+import torch
+import xitorch as xt
 from dqc.utils.config import config
+from dqc.utils.davidson import davidson
 from dqc.utils.misc import logger
 
 def test_logger(capsys):
@@ -19,3 +22,41 @@ def test_logger(capsys):
 
     # restore the verbosity level to 0
     config.VERBOSE = 0
+
+def test_davidson():
+    # compare the davidson eigenpairs with the dense generalized eigendecomposition
+    torch.manual_seed(123)
+    na, neig = 200, 10
+    dtype = torch.float64
+    a = torch.randn((na, na), dtype=dtype) * 0.1
+    a = (a + a.T) * 0.5 + torch.diag(torch.arange(na, dtype=dtype))
+    m = torch.randn((na, na), dtype=dtype) * 0.01
+    m = m @ m.T + torch.eye(na, dtype=dtype)
+    alinop = xt.LinearOperator.m(a, is_hermitian=True)
+    mlinop = xt.LinearOperator.m(m, is_hermitian=True)
+
+    lmat = torch.linalg.cholesky(m)
+    linv = torch.inverse(lmat)
+    evals_true = torch.linalg.eigh(linv @ a @ linv.T)[0][:neig]
+    info_cold = {}
+    evals, evecs = davidson(alinop, neig, "lowest", M=mlinop, min_eps=1e-10, info=info_cold)
+    assert info_cold["niter"][0] > 1
+    assert torch.allclose(evals, evals_true)
+    assert torch.allclose(a @ evecs, m @ evecs * evals, atol=1e-8)
+    assert torch.allclose(evecs.T @ m @ evecs, torch.eye(neig, dtype=dtype), atol=1e-8)
+
+    # warm-start from the eigenvectors of a slightly perturbed matrix
+    a2 = a + torch.diag(torch.randn(na, dtype=dtype)) * 1e-3
+    alinop2 = xt.LinearOperator.m(a2, is_hermitian=True)
+    evals2_true = torch.linalg.eigh(linv @ a2 @ linv.T)[0][:neig]
+    info_warm = {}
+    evals2, _ = davidson(alinop2, neig, "lowest", M=mlinop, v_init=evecs, min_eps=1e-10,
+                         info=info_warm)
+    assert torch.allclose(evals2, evals2_true)
+    assert info_warm["niter"][0] < info_cold["niter"][0]
+
+    # the dense eigendecomposition is used if the block is too large
+    info_dense = {}
+    evals3, _ = davidson(alinop, neig, "lowest", M=mlinop, max_frac=0.01, info=info_dense)
+    assert info_dense["niter"][0] == 0
+    assert torch.allclose(evals3, evals_true)
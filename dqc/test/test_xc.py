@@ -1,10 +1,12 @@
 import torch
 import numpy as np
 import pytest
-from dqc.api.getxc import get_libxc
+from dqc.api.getxc import get_libxc, get_xc
+from dqc.xc.torch_xc import TorchXC, TORCH_XC_NAMES
 from dqc.xc.custom_xc import CustomXC
 from dqc.utils.datastruct import ValGrad, SpinParam
 from dqc.utils.safeops import safepow, safenorm
+from dqc.utils.config import config
 
 def test_libxc_lda_gradcheck():
     name = "lda_c_pw"
@@ -233,6 +235,139 @@ def test_libxc_gga_value():
     edens_pol_true = 0.5 * (pbe_e_true(2 * rho_u, 2 * gradn_u) + pbe_e_true(2 * rho_d, 2 * gradn_d))
     assert torch.allclose(edens_pol, edens_pol_true)
 
+@pytest.mark.parametrize(
+    "xcname",
+    ["lda_x", "gga_x_pbe"]
+)
+def test_libxc_dens_screening(xcname):
+    # test the grid points with density below the threshold give zero energy
+    # density, potentials, and gradients, while the others are unchanged
+    dtype = torch.float64
+    xc = get_libxc(xcname)
+
+    torch.manual_seed(123)
+    n = 10
+    small = torch.arange(n) % 3 == 0
+    rho_u = torch.rand((n,), dtype=dtype)
+    rho_d = torch.rand((n,), dtype=dtype)
+    rho_u[small] *= 1e-16
+    rho_d[small] *= 1e-16
+    rho_u.requires_grad_()
+    rho_d.requires_grad_()
+    grad_u = torch.rand((3, n), dtype=dtype) if xc.family == 2 else None
+    grad_d = torch.rand((3, n), dtype=dtype) if xc.family == 2 else None
+
+    res = []
+    for thresh in [0.0, 1e-14]:
+        try:
+            thresh0 = config.XC_DENS_THRESHOLD
+            config.XC_DENS_THRESHOLD = thresh
+            densinfo_u = ValGrad(value=rho_u, grad=grad_u)
+            densinfo_d = ValGrad(value=rho_d, grad=grad_d)
+            densinfo = SpinParam(u=densinfo_u, d=densinfo_d)
+            edens_unpol = xc.get_edensityxc(densinfo_u)
+            edens_pol = xc.get_edensityxc(densinfo)
+            vxc_unpol = xc.get_vxc(densinfo_u).value
+            vxc_pol = xc.get_vxc(densinfo).u.value
+            dedens = torch.autograd.grad(edens_pol.sum(), rho_u)[0]
+        finally:
+            config.XC_DENS_THRESHOLD = thresh0
+        res.append((edens_unpol, edens_pol, vxc_unpol, vxc_pol, dedens))
+
+    for r0, r1 in zip(*res):
+        assert torch.all(r1[small] == 0)
+        assert torch.allclose(r0[~small], r1[~small])
+
+@pytest.mark.parametrize(
+    "xcname",
+    ["lda_x", "gga_x_pbe", "mgga_x_scan"]
+)
+def test_libxc_multithread(xcname):
+    # test the multithreaded libxc calls on chunks of points give the same
+    # results as the single-threaded call
+    dtype = torch.float64
+    xc = get_libxc(xcname)
+
+    torch.manual_seed(123)
+    n = 10000
+    rho_u = torch.rand((n,), dtype=dtype)
+    rho_d = torch.rand((n,), dtype=dtype)
+    grad_u = torch.rand((3, n), dtype=dtype) if xc.family >= 2 else None
+    grad_d = torch.rand((3, n), dtype=dtype) if xc.family >= 2 else None
+    lapl_u = torch.rand((n,), dtype=dtype) if xc.family == 4 else None
+    lapl_d = torch.rand((n,), dtype=dtype) if xc.family == 4 else None
+    kin_u = torch.rand((n,), dtype=dtype) if xc.family == 4 else None
+    kin_d = torch.rand((n,), dtype=dtype) if xc.family == 4 else None
+    densinfo_u = ValGrad(value=rho_u, grad=grad_u, lapl=lapl_u, kin=kin_u)
+    densinfo_d = ValGrad(value=rho_d, grad=grad_d, lapl=lapl_d, kin=kin_d)
+    densinfo = SpinParam(u=densinfo_u, d=densinfo_d)
+
+    res = []
+    for nthreads in [1, 3]:
+        try:
+            nthreads0 = config.XC_NUM_THREADS
+            config.XC_NUM_THREADS = nthreads
+            edens_unpol = xc.get_edensityxc(densinfo_u)
+            edens_pol = xc.get_edensityxc(densinfo)
+            vxc_unpol = xc.get_vxc(densinfo_u).value
+            vxc_pol = xc.get_vxc(densinfo).d.value
+        finally:
+            config.XC_NUM_THREADS = nthreads0
+        res.append((edens_unpol, edens_pol, vxc_unpol, vxc_pol))
+
+    for r0, r1 in zip(*res):
+        assert torch.allclose(r0, r1)
+
+@pytest.mark.parametrize(
+    "xcname",
+    TORCH_XC_NAMES
+)
+def test_torchxc_value(xcname):
+    # test the native torch xc gives the same energy density and potentials as
+    # libxc for the polarized and unpolarized cases
+    dtype = torch.float64
+    xc = get_xc(xcname, backend="torch")
+    assert isinstance(xc, TorchXC)
+    libxc = get_libxc(xcname)
+
+    torch.manual_seed(123)
+    n = 100
+    rho_u = torch.rand((n,), dtype=dtype) + 1e-2
+    rho_d = torch.rand((n,), dtype=dtype) + 1e-2
+    rho_d[:5] = 0.0  # fully polarized points
+    grad_u = torch.rand((3, n), dtype=dtype) if xc.family == 2 else None
+    grad_d = torch.rand((3, n), dtype=dtype) if xc.family == 2 else None
+    densinfo_u = ValGrad(value=rho_u, grad=grad_u)
+    densinfo_d = ValGrad(value=rho_d, grad=grad_d)
+    densinfo = SpinParam(u=densinfo_u, d=densinfo_d)
+
+    for dinfo in [densinfo_u, densinfo]:
+        edens = xc.get_edensityxc(dinfo)
+        edens_libxc = libxc.get_edensityxc(dinfo)
+        assert torch.allclose(edens, edens_libxc)
+
+    # compare the potentials only at the partially polarized points, where the
+    # derivatives are not affected by the libxc's thresholds
+    vxc = xc.get_vxc(densinfo_u)
+    vxc_libxc = libxc.get_vxc(densinfo_u)
+    assert torch.allclose(vxc.value, vxc_libxc.value)
+    if xc.family == 2:
+        assert torch.allclose(vxc.grad, vxc_libxc.grad)
+
+    vxc_pol = xc.get_vxc(densinfo)
+    vxc_pol_libxc = libxc.get_vxc(densinfo)
+    for v, v_libxc in [(vxc_pol.u, vxc_pol_libxc.u), (vxc_pol.d, vxc_pol_libxc.d)]:
+        assert torch.allclose(v.value[5:], v_libxc.value[5:])
+        if xc.family == 2:
+            assert torch.allclose(v.grad[..., 5:], v_libxc.grad[..., 5:])
+
+def test_torchxc_fallback():
+    # test the xc that are not implemented natively are taken from libxc
+    xc = get_xc("gga_x_pbe + mgga_x_scan", backend="torch")
+    assert isinstance(xc.a, TorchXC)
+    assert not isinstance(xc.b, TorchXC)
+    assert xc.family == 4
+
 def test_libxc_mgga_value():
     # compare the calculated value of MGGA potential
     dtype = torch.float64
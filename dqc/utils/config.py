@@ -1,3 +1,4 @@
+from typing import Optional
 from dataclasses import dataclass
 
 __all__ = ["config"]
@@ -9,6 +10,33 @@ class _Config(object):
     # The memory for splitting big tensors into chunks
     CHUNK_MEMORY: int = 16 * 1024 ** 2  # in B
 
+    # Cutoff for the Schwarz screening of the 4-centre electron repulsion
+    # integrals (shell quartets with |(ij|kl)| bound below this are skipped)
+    # set to 0 to disable the screening
+    ERI_SCREEN_THRESHOLD: float = 1e-13
+
+    # Cutoff of the basis values in the grid blocks (shells with values below
+    # this in a block of grid points are not evaluated and set to zero)
+    # set to 0 to disable the screening
+    AO_SCREEN_THRESHOLD: float = 1e-13
+
+    # Cutoff of the total density for the xc calculation with libxc (the grid
+    # points with density below this are not passed to libxc and their xc
+    # energy density and potentials are set to zero)
+    # set to 0 to disable the screening
+    XC_DENS_THRESHOLD: float = 1e-14
+
+    # The number of threads to evaluate libxc on the chunks of grid points
+    # set to 0 to use torch.get_num_threads()
+    XC_NUM_THREADS: int = 0
+
+    # The directory to store the binary cache of the atomic grids (shared
+    # across processes), set to None to only cache them in memory
+    GRID_CACHE_DIR: Optional[str] = None
+    # Cache the full molecular grids in GRID_CACHE_DIR as well, the cached
+    # grids are not differentiable w.r.t. the atomic positions
+    GRID_CACHE_MOLECULAR: bool = False
+
     VERBOSE: int = 0  # verbosity level
 
 config = _Config()
@@ -26,6 +26,8 @@ def is_z_float(a: ZType):
 
 @dataclass
 class CGTOBasis:
+    # general contractions are represented by consecutive CGTOBasis with the
+    # same angmom sharing the same alphas tensor (as produced by loadbasis)
     angmom: int
     alphas: torch.Tensor  # (nbasis,)
     coeffs: torch.Tensor  # (nbasis,)
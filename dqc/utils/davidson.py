@@ -0,0 +1,205 @@
+from typing import Any, Dict, Optional, Tuple, Union
+import warnings
+import torch
+import xitorch as xt
+from dqc.utils.misc import logger
+
+# block Davidson eigensolver for the lowest eigenpairs of the generalized
+# eigenvalue problem A x = e M x with the diagonal preconditioner and an
+# initial subspace that can be given explicitly (e.g. the eigenvectors from
+# the previous self-consistent iteration)
+# it has the same signature as the methods of xitorch.linalg.symeig, so it can
+# be passed as the method to xitorch.linalg.lsymeig to keep the implicit
+# gradients of the eigendecomposition
+
+__all__ = ["davidson"]
+
+# the minimum number of the additional vectors in the block above neig
+DAVIDSON_MIN_EXTRA = 4
+# the maximum size of the subspace relative to the block size before restarting
+DAVIDSON_MAX_SUBSPACE = 4
+# below this fraction of the matrix size, the block is small enough to be
+# worth the iterations, otherwise the dense eigendecomposition is used
+# (the default of the max_frac option)
+DAVIDSON_MAX_FRAC = 0.25
+# threshold of the norms of the new directions to be added to the subspace
+DAVIDSON_ORTHO_EPS = 1e-8
+
+def davidson(A: xt.LinearOperator, neig: int, mode: str, M: Optional[xt.LinearOperator] = None,
+             max_niter: int = 100,
+             nguess: Optional[int] = None,
+             v_init: Union[str, torch.Tensor] = "diag",
+             max_addition: Optional[int] = None,
+             min_eps: float = 1e-6,
+             max_frac: float = DAVIDSON_MAX_FRAC,
+             info: Optional[Dict[str, Any]] = None,
+             **unused) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Calculate the ``neig`` lowest eigenpairs of the dense Hermitian matrix
+    ``A`` with the block Davidson method.
+    The maximum residual norm is printed in every iteration if
+    ``config.VERBOSE`` is larger than 1.
+
+    Arguments
+    ---------
+    A: xitorch.LinearOperator
+        The Hermitian linear operator with shape ``(*BA, na, na)``.
+    neig: int
+        The number of the eigenpairs to be calculated.
+    mode: str
+        Only ``"lowest"`` is supported.
+    M: xitorch.LinearOperator or None
+        The positive definite metric with shape ``(*BM, na, na)``.
+    max_niter: int
+        The maximum number of iterations.
+    nguess: int or None
+        The block size, i.e. the number of the Ritz vectors that are refined
+        in every iteration. If None, it is ``neig`` plus ``max(4, neig // 8)``.
+    v_init: str or torch.Tensor
+        The initial subspace. If a tensor with shape ``(*BA, na, nv)``, it is
+        used as the initial subspace and completed with the unit vectors of
+        the lowest diagonal elements of ``A`` (``"diag"``).
+    max_addition: int or None
+        The maximum number of the new vectors added to the subspace in every
+        iteration. If None, it is the block size.
+    min_eps: float
+        The tolerance of the norms of the residuals.
+    max_frac: float
+        If the block size is larger than this fraction of the matrix size,
+        the dense eigendecomposition is used instead of the iterations.
+    info: dict or None
+        If given, the number of iterations of every matrix in the batch is
+        appended to the list ``info["niter"]``, where 0 means the dense
+        eigendecomposition is used.
+    """
+    if mode != "lowest":
+        raise ValueError("Only the lowest eigenpairs are supported in davidson")
+
+    amat = A.fullmatrix()
+    mmat = M.fullmatrix() if M is not None else None
+    batch_shape = amat.shape[:-2] if mmat is None else \
+        torch.broadcast_shapes(amat.shape[:-2], mmat.shape[:-2])
+    na = amat.shape[-1]
+    amat = amat.expand(*batch_shape, na, na).reshape(-1, na, na)
+    if mmat is not None:
+        mmat = mmat.expand(*batch_shape, na, na).reshape(-1, na, na)
+    if isinstance(v_init, torch.Tensor):
+        v_init = v_init.expand(*batch_shape, *v_init.shape[-2:]).reshape(-1, *v_init.shape[-2:])
+
+    evals_list = []
+    evecs_list = []
+    for i in range(amat.shape[0]):
+        evals, evecs, niter = _davidson(
+            amat[i], neig, mmat[i] if mmat is not None else None,
+            max_niter=max_niter, nguess=nguess,
+            v_init=v_init[i] if isinstance(v_init, torch.Tensor) else v_init,
+            max_addition=max_addition, min_eps=min_eps, max_frac=max_frac)
+        if info is not None:
+            info.setdefault("niter", []).append(niter)
+        evals_list.append(evals)
+        evecs_list.append(evecs)
+    evals = torch.stack(evals_list, dim=0).reshape(*batch_shape, neig)
+    evecs = torch.stack(evecs_list, dim=0).reshape(*batch_shape, na, neig)
+    return evals, evecs
+
+def _davidson(amat: torch.Tensor, neig: int, mmat: Optional[torch.Tensor],
+              max_niter: int, nguess: Optional[int], v_init: Union[str, torch.Tensor],
+              max_addition: Optional[int], min_eps: float,
+              max_frac: float) -> Tuple[torch.Tensor, torch.Tensor, int]:
+    # the davidson iterations for a single matrix
+    # amat: (na, na)
+    # mmat: (na, na) or None
+    # returns: (neig,), (na, neig), and the number of iterations
+    na = amat.shape[-1]
+    if nguess is None:
+        nguess = neig + max(DAVIDSON_MIN_EXTRA, neig // 8)
+    nguess = min(max(nguess, neig), na)
+    nmax = min(DAVIDSON_MAX_SUBSPACE * nguess, na)
+    if nguess > max_frac * na:
+        # the iterations are not cheaper than the dense eigendecomposition
+        return (*_exacteig(amat, neig, mmat), 0)
+    if max_addition is None:
+        max_addition = nguess
+
+    adiag = amat.diagonal().real
+    mdiag = mmat.diagonal().real if mmat is not None else torch.ones_like(adiag)
+
+    # set up the initial subspace
+    idx_diag = torch.argsort(adiag / mdiag)[:nguess]
+    vdiag = torch.zeros((na, nguess), dtype=amat.dtype, device=amat.device)
+    vdiag[idx_diag, torch.arange(nguess, device=amat.device)] = 1.0
+    if isinstance(v_init, torch.Tensor):
+        v = torch.cat((v_init.to(amat.dtype), vdiag), dim=-1)
+    elif v_init == "diag":
+        v = vdiag
+    else:
+        raise ValueError("Unknown v_init: %s" % v_init)
+    v = _orthonormalize(v, mmat)[:, :nmax]
+
+    for i in range(max_niter):
+        av = torch.matmul(amat, v)  # (na, nv)
+        hmat = torch.matmul(v.transpose(-2, -1).conj(), av)
+        hmat = (hmat + hmat.transpose(-2, -1).conj()) * 0.5
+        theta, s = torch.linalg.eigh(hmat)
+        theta = theta[:nguess]
+        s = s[:, :nguess]
+        x = torch.matmul(v, s)  # (na, nguess) Ritz vectors
+        mx = torch.matmul(mmat, x) if mmat is not None else x
+        resid = torch.matmul(av, s) - mx * theta  # (na, nguess)
+        rnorms = resid.norm(dim=-2)  # (nguess,)
+        rmax = float(rnorms[:neig].max())
+        logger.log("Davidson iter %3d: subspace %4d, max residual %.3e" % (i + 1, v.shape[-1], rmax),
+                   vlevel=1)
+        if rmax < min_eps:
+            return theta[:neig], x[:, :neig], i + 1
+
+        # precondition the residuals of the unconverged vectors
+        idx = torch.nonzero(rnorms > min_eps).reshape(-1)[:max_addition]
+        denom = adiag.unsqueeze(-1) - theta[idx] * mdiag.unsqueeze(-1)  # (na, nadd)
+        denom = torch.where(denom.abs() < 1e-8, torch.full_like(denom, 1e-8), denom)
+        tvecs = -resid[:, idx] / denom
+
+        # restart the subspace with the Ritz vectors if it becomes too large
+        if v.shape[-1] + tvecs.shape[-1] > nmax:
+            v = x
+        vnew = _orthonormalize(tvecs, mmat, v)
+        if vnew.shape[-1] == 0:
+            break
+        v = torch.cat((v, vnew), dim=-1)
+
+    warnings.warn("Davidson does not converge after %d iterations, max residual: %.3e" %
+                  (i + 1, rmax))
+    return theta[:neig], x[:, :neig], i + 1
+
+def _exacteig(amat: torch.Tensor, neig: int, mmat: Optional[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+    # the dense eigendecomposition through the Cholesky factor of the metric
+    if mmat is None:
+        evals, evecs = torch.linalg.eigh(amat)
+        return evals[:neig], evecs[:, :neig]
+    lmat = torch.linalg.cholesky(mmat)
+    linv = torch.inverse(lmat)
+    amat2 = torch.matmul(linv, torch.matmul(amat, linv.transpose(-2, -1).conj()))
+    evals, evecs = torch.linalg.eigh(amat2)
+    evecs = torch.matmul(linv.transpose(-2, -1).conj(), evecs[:, :neig])
+    return evals[:neig], evecs
+
+def _orthonormalize(t: torch.Tensor, mmat: Optional[torch.Tensor],
+                    v: Optional[torch.Tensor] = None) -> torch.Tensor:
+    # orthonormalize the columns of t in the metric mmat and against the
+    # M-orthonormal columns of v (if given), dropping the linearly dependent
+    # columns
+    # t: (na, nt), v: (na, nv)
+    mt = torch.matmul(mmat, t) if mmat is not None else t
+    norms = torch.sum(t.conj() * mt, dim=-2).real.clamp(min=1e-30).sqrt()
+    t = t / norms
+    for _ in range(2):
+        if v is not None:
+            mt = torch.matmul(mmat, t) if mmat is not None else t
+            t = t - torch.matmul(v, torch.matmul(v.transpose(-2, -1).conj(), mt))
+        mt = torch.matmul(mmat, t) if mmat is not None else t
+        gram = torch.matmul(t.transpose(-2, -1).conj(), mt)
+        gram = (gram + gram.transpose(-2, -1).conj()) * 0.5
+        geval, gevec = torch.linalg.eigh(gram)
+        idx = geval > DAVIDSON_ORTHO_EPS
+        t = torch.matmul(t, gevec[:, idx] * geval[idx].rsqrt())
+    return t
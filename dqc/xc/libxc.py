@@ -9,6 +9,7 @@ from dqc.xc.base_xc import BaseXC
 from dqc.xc.libxc_wrapper import CalcLDALibXCPol, CalcLDALibXCUnpol, \
     CalcGGALibXCPol, CalcGGALibXCUnpol, CalcMGGALibXCUnpol, CalcMGGALibXCPol
 from dqc.utils.datastruct import ValGrad, SpinParam
+from dqc.utils.config import config
 
 
 ERRMSG = "This function cannot do broadcasting. " \
@@ -45,19 +46,20 @@ class LibXCLDA(BaseXC):
         # potentialinfo.grad: (*BD, nr, ndim)
 
         libxc_inps = _prepare_libxc_input(densinfo, xcfamily=self.family)
-        flatten_inps = tuple(inp.reshape(-1) for inp in libxc_inps)
+        idx = _get_significant_idx(densinfo)
+        flatten_inps = tuple(_select_points(inp.reshape(-1), idx) for inp in libxc_inps)
 
         # polarized case
         if not isinstance(densinfo, ValGrad):
             # outs are (vrho,) for LDA, (vrho, vsigma) for GGA each with shape
             # (nspin, *shape)
-            outs = self._calc_pol(flatten_inps, densinfo.u.value.shape, 1)
+            outs = self._calc_pol(flatten_inps, densinfo.u.value.shape, 1, idx)
 
         # unpolarized case
         else:
             # outs are (vrho,) for LDA, (vrho, vsigma) for GGA each with shape
             # (*shape)
-            outs = self._calc_unpol(flatten_inps, densinfo.value.shape, 1)
+            outs = self._calc_unpol(flatten_inps, densinfo.value.shape, 1, idx)
 
         potinfo = _postproc_libxc_voutput(densinfo, *outs)
         return potinfo
@@ -69,34 +71,37 @@ class LibXCLDA(BaseXC):
         # return: (*BD, nr)
 
         libxc_inps = _prepare_libxc_input(densinfo, xcfamily=self.family)
-        flatten_inps = tuple(inp.reshape(-1) for inp in libxc_inps)
+        idx = _get_significant_idx(densinfo)
+        flatten_inps = tuple(_select_points(inp.reshape(-1), idx) for inp in libxc_inps)
 
         # polarized case
         if not isinstance(densinfo, ValGrad):
             rho_u = densinfo.u.value
 
-            edens = self._calc_pol(flatten_inps, densinfo.u.value.shape, 0)[0]  # (*BD, nr)
+            edens = self._calc_pol(flatten_inps, densinfo.u.value.shape, 0, idx)[0]  # (*BD, nr)
             edens = edens.reshape(rho_u.shape)
             return edens
 
         # unpolarized case
         else:
-            edens = self._calc_unpol(flatten_inps, densinfo.value.shape, 0)[0]  # (*BD, nr)
+            edens = self._calc_unpol(flatten_inps, densinfo.value.shape, 0, idx)[0]  # (*BD, nr)
             return edens
 
-    def _calc_pol(self, flatten_inps: Tuple[torch.Tensor, ...], shape: torch.Size, deriv: int) ->\
-            Tuple[torch.Tensor, ...]:
+    def _calc_pol(self, flatten_inps: Tuple[torch.Tensor, ...], shape: torch.Size, deriv: int,
+                  idx: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, ...]:
 
         outs = self._polfcn_wrapper.apply(*flatten_inps, deriv, self.libxc_pol)
+        outs = tuple(_scatter_points(out, idx, shape.numel()) for out in outs)
 
         # tuple of (nderiv, *shape) where nderiv is the number of spin-dependent
         # values from libxc
         return tuple(out.reshape(-1, *shape) for out in outs)
 
-    def _calc_unpol(self, flatten_inps: Tuple[torch.Tensor, ...], shape: torch.Size, deriv: int) ->\
-            Tuple[torch.Tensor, ...]:
+    def _calc_unpol(self, flatten_inps: Tuple[torch.Tensor, ...], shape: torch.Size, deriv: int,
+                    idx: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, ...]:
 
         outs = self._unpolfcn_wrapper.apply(*flatten_inps, deriv, self.libxc_unpol)
+        outs = tuple(_scatter_points(out, idx, shape.numel()) for out in outs)
 
         # tuple of (*shape) where shape
         return tuple(out.reshape(shape) for out in outs)
@@ -121,6 +126,39 @@ def _all_same_shape(densinfo_u: ValGrad, densinfo_d: ValGrad) -> bool:
 def _get_polstr(polarized: bool) -> str:
     return "polarized" if polarized else "unpolarized"
 
+def _get_significant_idx(densinfo: Union[SpinParam[ValGrad], ValGrad]) -> Optional[torch.Tensor]:
+    # get the flattened indices of the grid points with the total density
+    # above config.XC_DENS_THRESHOLD
+    # returns None if all (or none) of the points are significant, where
+    # all the points are passed to libxc
+    thresh = config.XC_DENS_THRESHOLD
+    if thresh <= 0:
+        return None
+    if isinstance(densinfo, SpinParam):
+        rho = densinfo.u.value + densinfo.d.value
+    else:
+        rho = densinfo.value
+    mask = rho.detach().reshape(-1) >= thresh
+    if bool(mask.all()) or not bool(mask.any()):
+        return None
+    return torch.nonzero(mask, as_tuple=True)[0]
+
+def _select_points(inp: torch.Tensor, idx: Optional[torch.Tensor]) -> torch.Tensor:
+    # select the significant grid points from the flattened input
+    if idx is None:
+        return inp
+    return inp.index_select(-1, idx)
+
+def _scatter_points(out: torch.Tensor, idx: Optional[torch.Tensor], npoints: int) -> torch.Tensor:
+    # put the libxc outputs of the significant grid points back into all the
+    # grid points, the insignificant points are exact zeros (also in the gradients)
+    # out: (nderiv, nsig) or (nsig,)
+    # returns: (nderiv, npoints) or (npoints,)
+    if idx is None:
+        return out
+    res = torch.zeros((*out.shape[:-1], npoints), dtype=out.dtype, device=out.device)
+    return res.index_copy(-1, idx, out)
+
 def _prepare_libxc_input(densinfo: Union[SpinParam[ValGrad], ValGrad], xcfamily: int) -> Tuple[torch.Tensor, ...]:
     # convert the densinfo into tuple of tensors for libxc inputs
     # the elements in the tuple is arranged according to libxc manual
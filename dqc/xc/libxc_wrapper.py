@@ -1,8 +1,10 @@
 from __future__ import annotations
-from typing import Mapping, Tuple, Optional, Union, Iterator, List
+from typing import Mapping, Tuple, Optional, Union, Iterator, List, Dict
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import numpy as np
 import warnings
+from dqc.utils.config import config
 try:
     import pylibxc
 except (ImportError, ModuleNotFoundError) as e:
@@ -388,8 +390,9 @@ def _get_libxc_res(inp: Mapping[str, Union[np.ndarray, Tuple[np.ndarray, ...], t
     # deriv == 4 for v4rho4
     do_exc, do_vxc, do_fxc, do_kxc, do_lxc = _get_dos(deriv)
 
-    res = libxcfcn.compute(
-        inp,
+    inp_np = {key: _as_libxc_input(val) for (key, val) in inp.items()}
+    res = _libxc_compute(
+        libxcfcn, inp_np,
         do_exc=do_exc, do_vxc=do_vxc, do_fxc=do_fxc,
         do_kxc=do_kxc, do_lxc=do_lxc
     )
@@ -402,25 +405,78 @@ def _get_libxc_res(inp: Mapping[str, Union[np.ndarray, Tuple[np.ndarray, ...], t
     # everything else is represented by the energy density per unit volume
     # only.
     if deriv == 0:
-        rho = inp["rho"]
+        rho = inp_np["rho"]
         if polarized:
-            assert isinstance(rho, np.ndarray)
             start = np.zeros(1, dtype=rho.dtype)
             rho = sum(_unpack_input(rho), start)  # rho[:, 0] + rho[:, 1]
-        res0 = res[0] * rho
+        res0 = res[0] * torch.as_tensor(rho)
         res = (res0, *res[1:])
 
     return res
 
+def _libxc_compute(libxcfcn: pylibxc.functional.LibXCFunctional,
+                   inp: Mapping[str, np.ndarray], **kwargs) -> Dict[str, np.ndarray]:
+    # evaluate libxc on chunks of the points concurrently in a thread pool
+    # (libxc is called via ctypes which releases the GIL) and gather the
+    # results of the chunks into the full outputs
+    # NOTE: pylibxc allocates the outputs of every call, so gathering the
+    # chunks costs one extra copy of the outputs, only the inputs are not copied
+    # inp: dict of (ninps, ...) arrays in libxc's layout
+    # returns: dict of (ninps, ...) arrays like libxcfcn.compute
+    ninps = inp["rho"].shape[0]
+    nthreads = config.XC_NUM_THREADS if config.XC_NUM_THREADS > 0 else torch.get_num_threads()
+    nchunks = min(nthreads, (ninps + LIBXC_MIN_CHUNK - 1) // LIBXC_MIN_CHUNK)
+    if nchunks <= 1:
+        return libxcfcn.compute(inp, **kwargs)
+
+    # the input chunks are views of contiguous rows of the inputs, so no copy is made
+    bounds = np.linspace(0, ninps, nchunks + 1).astype(np.int64)
+    slices = [slice(int(i0), int(i1)) for (i0, i1) in zip(bounds[:-1], bounds[1:])]
+    fcn = lambda sl: libxcfcn.compute({key: val[sl] for (key, val) in inp.items()}, **kwargs)
+    res_chunks = list(_get_executor(nthreads).map(fcn, slices))
+
+    res: Dict[str, np.ndarray] = {}
+    for key, val in res_chunks[0].items():
+        res[key] = np.empty((ninps, *val.shape[1:]), dtype=val.dtype)
+        for sl, res_chunk in zip(slices, res_chunks):
+            res[key][sl] = res_chunk[key]
+    return res
+
+def _get_executor(nthreads: int) -> ThreadPoolExecutor:
+    # get the thread pool to evaluate libxc, it is only recreated if the
+    # number of threads changes
+    global _EXECUTOR, _EXECUTOR_NTHREADS
+    if _EXECUTOR is None or _EXECUTOR_NTHREADS != nthreads:
+        if _EXECUTOR is not None:
+            _EXECUTOR.shutdown(wait=False)
+        _EXECUTOR = ThreadPoolExecutor(max_workers=nthreads)
+        _EXECUTOR_NTHREADS = nthreads
+    return _EXECUTOR
+
+def _as_libxc_input(val: Union[np.ndarray, torch.Tensor]) -> np.ndarray:
+    # get the numpy array sharing the memory with the tensor
+    if isinstance(val, torch.Tensor):
+        val = val.detach().numpy()
+    return np.ascontiguousarray(val)
+
 def _pack_input(*vals: torch.Tensor) -> np.ndarray:
-    # arrange the values in a numpy array with fortran memory order
-    vals_np = np.asarray([val.detach().numpy() for val in vals])
-    return np.ascontiguousarray(vals_np.T)
+    # write the values directly into a buffer with libxc's layout, i.e.
+    # (ninps, nvals) in C order
+    vals_np = [val.detach().numpy() for val in vals]
+    buf = np.empty((vals_np[0].shape[-1], len(vals_np)), dtype=vals_np[0].dtype)
+    for i, val_np in enumerate(vals_np):
+        buf[:, i] = val_np
+    return buf
 
 def _unpack_input(inp: np.ndarray) -> Iterator[np.ndarray]:
     # unpack from libxc input format into tuple of inputs
     return (a for a in inp.T)
 
+# the minimum number of points per chunk of the multithreaded libxc calls
+LIBXC_MIN_CHUNK = 4096
+_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_EXECUTOR_NTHREADS = 0
+
 def _get_dos(deriv: int) -> Tuple[bool, ...]:
     do_exc = deriv == 0
     do_vxc = deriv == 1
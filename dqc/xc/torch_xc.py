@@ -0,0 +1,276 @@
+import math
+from typing import Callable, List, Mapping, Tuple, Union
+import torch
+from dqc.xc.base_xc import BaseXC
+from dqc.utils.datastruct import ValGrad, SpinParam
+from dqc.utils.config import config
+from dqc.utils.misc import get_option
+
+# native torch implementations of some LDA and GGA functionals, following
+# the definitions (and the parameters) of the functionals with the same name
+# in libxc.
+# All the functionals are written for the polarized case as functions of
+# (rho_u, rho_d, sigma_uu, sigma_ud, sigma_dd) returning the energy density
+# per unit volume, and the unpolarized case uses rho_u = rho_d = rho / 2.
+
+XcFcn = Callable[[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor],
+                 torch.Tensor]
+
+class TorchXC(BaseXC):
+    """
+    Native torch implementation of LDA and GGA xc functionals with the libxc
+    names (see ``TORCH_XC_NAMES``).
+    The potentials and the higher order derivatives are obtained with
+    autograd, so no libxc calls and no conversions to numpy are made.
+
+    Arguments
+    ---------
+    name: str
+        The libxc name of the functional, e.g. ``"gga_x_pbe"``
+    """
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._family, self._fcn = get_option("native xc", name, _TORCH_XC)
+
+    @property
+    def family(self) -> int:
+        return self._family
+
+    def get_edensityxc(self, densinfo: Union[ValGrad, SpinParam[ValGrad]]) -> \
+            torch.Tensor:
+        # densinfo.value: (*BD, nr)
+        # densinfo.grad: (*BD, ndim, nr)
+        # return: (*BD, nr)
+
+        # polarized case
+        if not isinstance(densinfo, ValGrad):
+            rho_u = densinfo.u.value
+            rho_d = densinfo.d.value
+            if self.family >= 2:
+                grad_u = densinfo.u.grad
+                grad_d = densinfo.d.grad
+                assert grad_u is not None
+                assert grad_d is not None
+                sigma_uu = torch.sum(grad_u * grad_u, dim=-2)
+                sigma_ud = torch.sum(grad_u * grad_d, dim=-2)
+                sigma_dd = torch.sum(grad_d * grad_d, dim=-2)
+            else:
+                sigma_uu = sigma_ud = sigma_dd = torch.zeros_like(rho_u)
+
+        # unpolarized case
+        else:
+            rho_u = rho_d = 0.5 * densinfo.value
+            if self.family >= 2:
+                assert densinfo.grad is not None
+                sigma_uu = 0.25 * torch.sum(densinfo.grad * densinfo.grad, dim=-2)
+                sigma_ud = sigma_dd = sigma_uu
+            else:
+                sigma_uu = sigma_ud = sigma_dd = torch.zeros_like(rho_u)
+
+        return self._fcn(rho_u, rho_d, sigma_uu, sigma_ud, sigma_dd)
+
+    def getparamnames(self, methodname: str, prefix: str = "") -> List[str]:
+        if methodname == "get_edensityxc":
+            return []
+        else:
+            return super().getparamnames(methodname, prefix=prefix)
+
+############################ helper functions ############################
+
+# small number added to the contracted gradient before taking the square root
+# to have finite derivatives at zero gradient
+SIGMA_EPS = 1e-30
+# the relative polarization is clipped to avoid infinite derivatives of the
+# spin functions at the fully polarized points
+ZETA_EPS = 1e-12
+
+def _masked_eval(fcn: Callable[..., torch.Tensor], rho: torch.Tensor,
+                 *inps: torch.Tensor) -> torch.Tensor:
+    # evaluate fcn(*inps) only at the points with rho above the density
+    # threshold and set the others to zero, the other points are filled with
+    # ones so the values and the derivatives stay finite
+    mask = rho > config.XC_DENS_THRESHOLD
+    safe_inps = tuple(torch.where(mask, inp, torch.ones_like(inp)) for inp in inps)
+    res = fcn(*safe_inps)
+    return torch.where(mask, res, torch.zeros_like(res))
+
+def _exchange(fcn: Callable[[torch.Tensor, torch.Tensor], torch.Tensor]) -> XcFcn:
+    # get the polarized exchange functional from the exchange energy density
+    # of a spin channel, fcn(rho_s, sigma_ss)
+    def ex(rho_u: torch.Tensor, rho_d: torch.Tensor, sigma_uu: torch.Tensor,
+           sigma_ud: torch.Tensor, sigma_dd: torch.Tensor) -> torch.Tensor:
+        return _masked_eval(fcn, rho_u, rho_u, sigma_uu) + \
+            _masked_eval(fcn, rho_d, rho_d, sigma_dd)
+    return ex
+
+def _correlation(fcn: XcFcn) -> XcFcn:
+    # mask the correlation functional with the total density
+    def ec(rho_u: torch.Tensor, rho_d: torch.Tensor, sigma_uu: torch.Tensor,
+           sigma_ud: torch.Tensor, sigma_dd: torch.Tensor) -> torch.Tensor:
+        return _masked_eval(fcn, rho_u + rho_d, rho_u, rho_d, sigma_uu, sigma_ud, sigma_dd)
+    return ec
+
+def _get_rs_zeta(rho_u: torch.Tensor, rho_d: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    # get the Wigner-Seitz radius and the relative polarization
+    rho = rho_u + rho_d
+    rs = (3 / (4 * math.pi * rho)) ** (1.0 / 3)
+    zeta = torch.clamp((rho_u - rho_d) / rho, -1 + ZETA_EPS, 1 - ZETA_EPS)
+    return rs, zeta
+
+def _fzeta(zeta: torch.Tensor) -> torch.Tensor:
+    # spin interpolation function of the correlation energy
+    return ((1 + zeta) ** (4.0 / 3) + (1 - zeta) ** (4.0 / 3) - 2) / (2 ** (4.0 / 3) - 2)
+
+############################ LDA exchange ############################
+
+# unpolarized Slater exchange energy density is -X_FACTOR * rho ** (4/3)
+X_FACTOR = 0.75 * (3 / math.pi) ** (1.0 / 3)
+# the same factor for a spin channel, -X_FACTOR_S * rho_s ** (4/3)
+X_FACTOR_S = X_FACTOR * 2 ** (1.0 / 3)
+
+def _slater_x(rho_s: torch.Tensor, sigma_ss: torch.Tensor) -> torch.Tensor:
+    return -X_FACTOR_S * rho_s ** (4.0 / 3)
+
+############################ LDA correlation ############################
+
+# PW92 parameters (A, alpha1, beta1, beta2, beta3, beta4) of the paramagnetic,
+# ferromagnetic, and the (negative) spin stiffness terms
+PW_PARAMS = [(0.031091, 0.21370, 7.5957, 3.5876, 1.6382, 0.49294),
+             (0.015545, 0.20548, 14.1189, 6.1977, 3.3662, 0.62517),
+             (0.016887, 0.11125, 10.357, 3.6231, 0.88026, 0.49671)]
+PW_FZ20 = 1.709921
+# modified parameters with more digits (used in PBE)
+PW_MOD_PARAMS = [(0.0310907, 0.21370, 7.5957, 3.5876, 1.6382, 0.49294),
+                 (0.01554535, 0.20548, 14.1189, 6.1977, 3.3662, 0.62517),
+                 (0.0168869, 0.11125, 10.357, 3.6231, 0.88026, 0.49671)]
+PW_MOD_FZ20 = 1.709920934161365617563962776245
+
+def _pw_g(rs: torch.Tensor, a: float, alpha1: float, beta1: float, beta2: float,
+          beta3: float, beta4: float) -> torch.Tensor:
+    rs12 = torch.sqrt(rs)
+    den = 2 * a * (beta1 * rs12 + beta2 * rs + beta3 * rs * rs12 + beta4 * rs * rs)
+    return -2 * a * (1 + alpha1 * rs) * torch.log(1 + 1 / den)
+
+def _pw_eps(rs: torch.Tensor, zeta: torch.Tensor,
+            params: List[Tuple[float, ...]], fz20: float) -> torch.Tensor:
+    # PW92 correlation energy per particle
+    g1, g2, g3 = [_pw_g(rs, *p) for p in params]
+    fz = _fzeta(zeta)
+    z4 = zeta ** 4
+    return g1 + z4 * fz * (g2 - g1 + g3 / fz20) - fz * g3 / fz20
+
+def _pw_c(rho_u: torch.Tensor, rho_d: torch.Tensor, sigma_uu: torch.Tensor,
+          sigma_ud: torch.Tensor, sigma_dd: torch.Tensor) -> torch.Tensor:
+    rs, zeta = _get_rs_zeta(rho_u, rho_d)
+    return (rho_u + rho_d) * _pw_eps(rs, zeta, PW_PARAMS, PW_FZ20)
+
+# VWN5 parameters (A, b, c, x0) of the paramagnetic, ferromagnetic, and the
+# spin stiffness terms
+VWN_PARAMS = [(0.0310907, 3.72744, 12.9352, -0.10498),
+              (0.01554535, 7.06042, 18.0578, -0.32500),
+              (-1 / (6 * math.pi ** 2), 1.13107, 13.0045, -0.0047584)]
+VWN_FPP = 4 / (9 * (2 ** (1.0 / 3) - 1))
+
+def _vwn_aux(rs: torch.Tensor, a: float, b: float, c: float, x0: float) -> torch.Tensor:
+    x = torch.sqrt(rs)
+    q = math.sqrt(4 * c - b * b)
+    xx = rs + b * x + c
+    f1 = 2 * b / q
+    f2 = b * x0 / (x0 * x0 + b * x0 + c)
+    f3 = 2 * (2 * x0 + b) / q
+    return a * (torch.log(rs / xx) + (f1 - f2 * f3) * torch.atan(q / (2 * x + b)) -
+                f2 * torch.log((x - x0) ** 2 / xx))
+
+def _vwn_c(rho_u: torch.Tensor, rho_d: torch.Tensor, sigma_uu: torch.Tensor,
+           sigma_ud: torch.Tensor, sigma_dd: torch.Tensor) -> torch.Tensor:
+    rs, zeta = _get_rs_zeta(rho_u, rho_d)
+    e1, e2, e3 = [_vwn_aux(rs, *p) for p in VWN_PARAMS]
+    fz = _fzeta(zeta)
+    z4 = zeta ** 4
+    eps = e1 * (1 - fz * z4) + e2 * fz * z4 + e3 * fz * (1 - z4) / VWN_FPP
+    return (rho_u + rho_d) * eps
+
+############################ GGA exchange ############################
+
+def _b88_x(rho_s: torch.Tensor, sigma_ss: torch.Tensor) -> torch.Tensor:
+    beta = 0.0042
+    rho43 = rho_s ** (4.0 / 3)
+    x = torch.sqrt(sigma_ss + SIGMA_EPS) / rho43
+    return -rho43 * (X_FACTOR_S + beta * x * x / (1 + 6 * beta * x * torch.asinh(x)))
+
+def _pbe_x(mu: float, kappa: float = 0.804) -> Callable[[torch.Tensor, torch.Tensor], torch.Tensor]:
+    # PBE-like exchange with the given parameters, evaluated from the
+    # unpolarized expression with the spin-scaling relation
+    # Ex[rho_u, rho_d] = (Ex[2 * rho_u] + Ex[2 * rho_d]) / 2
+    def ex(rho_s: torch.Tensor, sigma_ss: torch.Tensor) -> torch.Tensor:
+        rho = 2 * rho_s
+        sigma = 4 * sigma_ss
+        s2 = sigma / (4 * (3 * math.pi ** 2) ** (2.0 / 3) * rho ** (8.0 / 3))
+        fx = 1 + kappa - kappa / (1 + mu * s2 / kappa)
+        return -0.5 * X_FACTOR * rho ** (4.0 / 3) * fx
+    return ex
+
+############################ GGA correlation ############################
+
+def _lyp_c(rho_u: torch.Tensor, rho_d: torch.Tensor, sigma_uu: torch.Tensor,
+           sigma_ud: torch.Tensor, sigma_dd: torch.Tensor) -> torch.Tensor:
+    a, b, c, d = 0.04918, 0.132, 0.2533, 0.349
+    cf = 0.3 * (3 * math.pi ** 2) ** (2.0 / 3)
+    rho = rho_u + rho_d
+    rhom13 = rho ** (-1.0 / 3)
+    denom = 1 + d * rhom13
+    omega = torch.exp(-c * rhom13) / denom * rho ** (-11.0 / 3)
+    delta = c * rhom13 + d * rhom13 / denom
+    sigma = sigma_uu + 2 * sigma_ud + sigma_dd
+
+    t1 = -4 * a / denom * rho_u * rho_d / rho
+    inner = 2 ** (11.0 / 3) * cf * (rho_u ** (8.0 / 3) + rho_d ** (8.0 / 3)) + \
+        (47.0 / 18 - 7.0 / 18 * delta) * sigma - \
+        (2.5 - delta / 18) * (sigma_uu + sigma_dd) - \
+        (delta - 11) / 9 * (rho_u / rho * sigma_uu + rho_d / rho * sigma_dd)
+    rho2 = rho * rho
+    t2 = rho_u * rho_d * inner - 2.0 / 3 * rho2 * sigma + \
+        (2.0 / 3 * rho2 - rho_u * rho_u) * sigma_dd + \
+        (2.0 / 3 * rho2 - rho_d * rho_d) * sigma_uu
+    return t1 - a * b * omega * t2
+
+def _pbe_c(beta: float) -> XcFcn:
+    # PBE-like correlation with the given beta parameter
+    gamma = (1 - math.log(2)) / math.pi ** 2
+
+    def ec(rho_u: torch.Tensor, rho_d: torch.Tensor, sigma_uu: torch.Tensor,
+           sigma_ud: torch.Tensor, sigma_dd: torch.Tensor) -> torch.Tensor:
+        rho = rho_u + rho_d
+        rs, zeta = _get_rs_zeta(rho_u, rho_d)
+        eps_unif = _pw_eps(rs, zeta, PW_MOD_PARAMS, PW_MOD_FZ20)
+
+        phi = 0.5 * ((1 + zeta) ** (2.0 / 3) + (1 - zeta) ** (2.0 / 3))
+        phi3 = phi ** 3
+        kf = (3 * math.pi ** 2 * rho) ** (1.0 / 3)
+        ks = torch.sqrt(4 * kf / math.pi)
+        sigma = sigma_uu + 2 * sigma_ud + sigma_dd
+        t2 = sigma / (2 * phi * ks * rho) ** 2
+
+        aa = beta / gamma / torch.expm1(-eps_unif / (gamma * phi3))
+        at2 = aa * t2
+        h = gamma * phi3 * torch.log(1 + beta / gamma * t2 * (1 + at2) / (1 + at2 + at2 * at2))
+        return rho * (eps_unif + h)
+    return ec
+
+MU_PBE = 0.2195149727645171
+BETA_PBE = 0.06672455060314922
+
+# the family and the polarized functional of the implemented functionals
+_TORCH_XC: Mapping[str, Tuple[int, XcFcn]] = {
+    "lda_x": (1, _exchange(_slater_x)),
+    "lda_c_pw": (1, _correlation(_pw_c)),
+    "lda_c_vwn": (1, _correlation(_vwn_c)),
+    "gga_x_b88": (2, _exchange(_b88_x)),
+    "gga_x_pbe": (2, _exchange(_pbe_x(MU_PBE))),
+    "gga_x_pbe_sol": (2, _exchange(_pbe_x(10.0 / 81))),
+    "gga_c_lyp": (2, _correlation(_lyp_c)),
+    "gga_c_pbe": (2, _correlation(_pbe_c(BETA_PBE))),
+    "gga_c_pbe_sol": (2, _correlation(_pbe_c(0.046))),
+}
+
+TORCH_XC_NAMES = list(_TORCH_XC.keys())
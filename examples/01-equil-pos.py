@@ -4,10 +4,16 @@ import xitorch.optimize
 
 # This example shows how to get the equilibrium positions using DQC, xitorch, and pytorch
 
+# the last calculations are used to warm-start the self-consistent iterations
+# in the next geometry
+history = []
+
 def get_ene(atompos: torch.Tensor) -> torch.Tensor:
     atomzs = ["H", "H"]  # H2
     mol = dqc.Mol((atomzs, atompos), basis="3-21G")
-    qc = dqc.HF(mol).run()
+    qc = dqc.HF(mol).run(dm0=history if len(history) > 0 else "1e")
+    history.append(qc)
+    del history[:-3]
     ene = qc.energy()  # calculate the energy
     return ene
 